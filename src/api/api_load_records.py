@@ -1,82 +1,174 @@
 """Make requests for Queries based on processing state
 """
 import logging
-from api.authenticate import authenticate
-import coreapi
+from api.async_client import AsyncAPIClient, get_async_client
+from api.ingestion_manifest import file_checksum
+from api.session import CONNECTION_POOL_SIZE, get_session
+from api.feature_file import FeatureFile
+import asyncio
 import os
-import csv
-from requests import ConnectionError
-from time import sleep
+import threading
+
+# clips whose existing features are listed in one request
+BULK_LOOKUP_SIZE = 100
+# features posted in one bulk create request; a 1024 value feature is about 20 kB of JSON
+BULK_FEATURE_BATCH = 200
 
 
 class APILoadRecords:   # base_url is the api url.  The default is the dev default.
 
-    def __init__(self, base_url="http://127.0.0.1:8000/"):
+    def __init__(self, base_url="http://127.0.0.1:8000/", max_requests=None, write_sidecars=False):
+        """
+        :param max_requests: optional maximum number of concurrent requests of this loader, at most the
+                             session's CONNECTION_POOL_SIZE.  None shares the process-wide asyncio client and its limit.
+        :param write_sidecars: write a binary sidecar for each feature file parsed from csv, so it is read faster
+                               next time
+
+        A loader may be shared by threads loading different videos.  The videos of one name are loaded by one thread
+        at a time, so racing threads create no duplicate videos or clips.
+        """
         self.logger = logging.getLogger(__name__)
-        # Setup authenticated API client
-        self.client = coreapi.Client(auth=authenticate(base_url))
-        self.schema = self.client.get(os.path.join(base_url, "docs"))
+        # Use the shared authenticated API session
+        self.session = get_session(base_url)
+        if max_requests:
+            # requests beyond the connection pool would open connections that are closed after one use
+            self.async_client = AsyncAPIClient(self.session, min(max_requests, CONNECTION_POOL_SIZE))
+        else:
+            self.async_client = get_async_client(base_url)
+        self.write_sidecars = write_sidecars
+        self._video_locks = {}
+        self._video_locks_lock = threading.Lock()
+
+    def load_video(self, video_name, video_path, split_paths, duration, bulk=False, manifest=None):
+        """
+        Create or get the video, then load the features of its splits that the API does not have yet, with bulk
+        requests if bulk is true.  The video's existing clips and features are listed in one paged pass and compared
+        with the feature files, so only the missing ones are requested.
+        With an IngestionManifest, files whose checksum is the one recorded when they were last loaded are skipped,
+        and a video whose files are all unchanged is skipped without any request.
+
+        :return: (number of feature rows loaded, number of unchanged files skipped)
+        """
+        with self._video_lock(video_name):
+            files = []
+            nskipped = 0
+            for nsplit, path in self._feature_files(split_paths):
+                checksum = file_checksum(path) if manifest is not None else None
+                if checksum is not None and checksum == manifest.checksum(self.session.url, duration, video_name,
+                                                                          nsplit, os.path.basename(path)):
+                    nskipped += 1
+                else:
+                    files.append((nsplit, path, checksum))
+            if not files:
+                return 0, nskipped
+
+            video_object = self.create_or_get_video(video_name, video_path)
+            feature_files = [(nsplit, self._read_feature_file(path, video_object)) for nsplit, path, __ in files]
+            existing = self.existing_keys(video_object, duration)
+            if bulk:
+                self._load_bulk(video_object, feature_files, duration, existing)
+            else:
+                self._load_rows(video_object, feature_files, duration, existing)
+            if manifest is not None:
+                manifest.record(self.session.url, duration, video_name, [{
+                    "split": nsplit,
+                    "file_name": os.path.basename(path),
+                    "stream": feature_file["dnn_stream"],
+                    "checksum": checksum,
+                    "rows": len(feature_file["rows"]),
+                } for (nsplit, path, checksum), (__, feature_file) in zip(files, feature_files)])
+            return sum(len(feature_file["rows"]) for __, feature_file in feature_files), nskipped
 
     def create_or_get_video(self, video_name, video_path):
-        # check to see if video already exists, and create it if needed
-        action = ["videos", "list"]
-        params = {
-            "name": video_name,
-            "path": video_path
-        }
-        response = self._request(action, params)
-        if response["results"]:
-            assert len(response["results"]) == 1
-            action = ["videos", "read"]
-            params = {"id": response["results"][0]["id"]}
-        else:
-            action = ["videos", "create"]
+        with self._video_lock(video_name):
+            # check to see if video already exists, and create it if needed
+            action = ["videos", "list"]
             params = {
                 "name": video_name,
-                "path": video_path,
+                "path": video_path
             }
-        video_object = self._request(action, params)
-        return video_object
-
-    def create_video_clips_and_features(self, video_object, split_path, duration):
-        for csv_file in os.scandir(split_path):
-            nsplit = int(split_path[-1])
-
-            if csv_file.is_file() and csv_file.name.endswith('.csv') and not csv_file.name.startswith('.'):
-                with open(csv_file.path, 'r') as f:
-                    reader = csv.reader(f)
-                    header = next(reader)
-                    video_name = header[0].split('=')[-1]
-                    assert video_name == video_object["name"].split('.')[0]
-                    # video_uri = header[1].split('=')[-1]
-                    dnn_stream = header[2].split('=')[-1]
-                    feature_name = header[3].split('=')[-1]
-                    dnn_weights_file_uri = header[4].split('=')[-1]
-
-                    for row in reader:
-                        clip = int(row[0])
-                        feature_vector = [float(x) for x in row[1:]]
-                        clip_id = self._create_or_get_clip(clip, duration, video_object)
-                        self._create_feature(feature_vector, nsplit, feature_name, dnn_weights_file_uri,
-                                             clip_id, dnn_stream)
-
-    def _create_or_get_clip(self, clip, duration, video_object):
-
-        # check to see if video clip already exists, and create it if needed
-        action = ["video-clips", "list"]
-        params = {
-            "video__name": video_object["name"],
-            "clip": clip,
-            "duration": duration,
-        }
-        response = self._request(action, params)
+            response = self._request(action, params)
+            if response["results"]:
+                assert len(response["results"]) == 1
+                action = ["videos", "read"]
+                params = {"id": response["results"][0]["id"]}
+            else:
+                action = ["videos", "create"]
+                params = {
+                    "name": video_name,
+                    "path": video_path,
+                }
+            video_object = self._request(action, params)
+            return video_object
 
-        # if the video clip exists, read it.  Otherwise, create it
-        if response["results"]:
-            assert len(response["results"]) == 1
-            action = ["video-clips", "read"]
-            params = {"id": response["results"][0]["id"]}
-        else:
+    def existing_keys(self, video_object, duration):
+        """
+        Clips and features of the video already in the database, listed in one paged pass
+        :return: ({clip: video clip id}, set of (video clip id, dnn_stream, dnn_stream_split) of the features, or
+                 None if the API cannot list the features of a set of clips)
+        """
+        clips = self.async_client.run_list_pages(["video-clips", "list"],
+                                                 {"video__name": video_object["name"], "duration": duration})
+        clip_ids = {clip["clip"]: clip["id"] for clip in clips}
+        if not self._has_filter(["features", "list"], "video_clip__in"):
+            return clip_ids, None
+        return clip_ids, self._existing_features(list(clip_ids.values()))
+
+    def bulk_supported(self):
+        """
+        True if the API offers bulk creation of video clips and features, and lists features for a set of clips.
+        Otherwise videos are loaded row by row.
+        """
+        schema = self.session.schema
+        for resource in ("video-clips", "features"):
+            if resource not in schema or "bulk_create" not in schema[resource]:
+                return False
+        return self._has_filter(["features", "list"], "video_clip__in")
+
+    def _load_bulk(self, video_object, feature_files, duration, existing):
+        # the missing clips are created in one request, then the missing features in batches
+        clip_ids, existing_features = existing
+        clip_ids = dict(clip_ids)
+        existing_features = set(existing_features)
+        new_clips = sorted(set(row[0] for __, feature_file in feature_files for row in feature_file["rows"])
+                           - set(clip_ids))
+        if new_clips:
+            created = self._request(["video-clips", "bulk_create"], {"data": [{
+                "clip": clip,
+                "duration": duration,
+                "debug_video_uri": video_object["path"],
+                "video": video_object["id"],
+            } for clip in new_clips]})
+            clip_ids.update({clip["clip"]: clip["id"] for clip in created})
+
+        features = []
+        for nsplit, feature_file in feature_files:
+            for clip, feature_vector in feature_file["rows"]:
+                key = (clip_ids[clip], feature_file["dnn_stream"], nsplit)
+                if key in existing_features:
+                    continue
+                existing_features.add(key)
+                features.append(self._feature_params(feature_vector, nsplit, feature_file, clip_ids[clip]))
+        batches = [(["features", "bulk_create"], {"data": features[start:start + BULK_FEATURE_BATCH]})
+                   for start in range(0, len(features), BULK_FEATURE_BATCH)]
+        self.async_client.run_gather(batches)
+        return sum(len(feature_file["rows"]) for __, feature_file in feature_files), len(new_clips), len(features)
+
+    def _load_rows(self, video_object, feature_files, duration, existing):
+        # one create request per missing clip and per missing feature; clips already listed are not looked up again
+        clip_ids, existing_features = existing
+        clip_ids = dict(clip_ids)
+        for nsplit, feature_file in feature_files:
+            # rows are loaded concurrently, each row being a different clip of the video
+            rows = [self._load_missing_row(clip, feature_vector, duration, video_object, nsplit, feature_file,
+                                           clip_ids, existing_features)
+                    for clip, feature_vector in feature_file["rows"]]
+            self.async_client.run(_gather(rows))
+
+    async def _load_missing_row(self, clip, feature_vector, duration, video_object, nsplit, feature_file, clip_ids,
+                                existing_features):
+        if clip not in clip_ids:
+            # the video's lock is held, so no other thread creates the clip meanwhile
             action = ["video-clips", "create"]
             params = {
                 "clip": clip,
@@ -84,10 +176,78 @@ class APILoadRecords:   # base_url is the api url.  The default is the dev defau
                 "debug_video_uri": video_object["path"],
                 "video": video_object["id"],
             }
-        clip_object = self._request(action, params)
-        return clip_object["id"]
+            clip_object = await self.async_client.action(action, params)
+            clip_ids[clip] = clip_object["id"]
+        clip_id = clip_ids[clip]
+        if existing_features is None:
+            # the API cannot list the video's features, so each is looked up before it is created
+            await self._create_feature(feature_vector, nsplit, feature_file["feature_name"],
+                                       feature_file["dnn_weights_uri"], clip_id, feature_file["dnn_stream"])
+        elif (clip_id, feature_file["dnn_stream"], nsplit) not in existing_features:
+            await self.async_client.action(["features", "create"],
+                                           self._feature_params(feature_vector, nsplit, feature_file, clip_id))
+
+    @staticmethod
+    def _feature_files(split_paths):
+        # [(split number, path)] of the csv files of features in split_paths, each ending in the split number
+        files = []
+        for split_path in split_paths:
+            for csv_file in sorted(os.scandir(split_path), key=lambda entry: entry.name):
+                if csv_file.is_file() and csv_file.name.endswith('.csv') and not csv_file.name.startswith('.'):
+                    files.append((int(split_path[-1]), csv_file.path))
+        return files
+
+    @staticmethod
+    def _feature_params(feature_vector, nsplit, feature_file, clip_id):
+        return {
+            "dnn_stream_split": nsplit,
+            "name": feature_file["feature_name"],
+            "dnn_weights_uri": feature_file["dnn_weights_uri"],
+            "feature_vector": feature_vector,
+            "video_clip": clip_id,
+            "dnn_stream": feature_file["dnn_stream"],
+        }
+
+    def _read_feature_file(self, path, video_object):
+        """
+        :return: {"dnn_stream", "feature_name", "dnn_weights_uri", "rows": [(clip, feature vector), ...]} of a
+                 feature file, read from its binary sidecar if it has an up to date one
+        """
+        feature_file = FeatureFile.read_sidecar(path)
+        if feature_file is None:
+            feature_file = FeatureFile.read_csv(path)
+            if self.write_sidecars:
+                feature_file.write_sidecar(path)
+        assert feature_file.header["video"] == video_object["name"].split('.')[0]
+        return {
+            "dnn_stream": feature_file.header["dnn_stream"],
+            "feature_name": feature_file.header["feature_name"],
+            "dnn_weights_uri": feature_file.header["dnn_weights_uri"],
+            "rows": feature_file.rows(),
+        }
+
+    def _has_filter(self, action, name):
+        # True if the API schema offers parameter name for action
+        link = self.session.schema[action[0]][action[1]]
+        return name in [field.name for field in link.fields]
 
-    def _create_feature(self, feature_vector, split, feature_name, dnn_weights_file_uri, clip_id, dnn_stream):
+    def _video_lock(self, video_name):
+        # clips are looked up and created per video, so holding the video's lock makes create-or-get race free
+        with self._video_locks_lock:
+            return self._video_locks.setdefault(video_name, threading.RLock())
+
+    def _existing_features(self, video_clip_ids):
+        # { (video_clip, dnn_stream, dnn_stream_split) } of the features of video_clip_ids, listed in chunks
+        chunks = [video_clip_ids[start:start + BULK_LOOKUP_SIZE]
+                  for start in range(0, len(video_clip_ids), BULK_LOOKUP_SIZE)]
+        requests = [(["features", "list"], {"video_clip__in": ",".join(str(video_clip_id) for video_clip_id in chunk)})
+                    for chunk in chunks]
+        pages = self.async_client.run(_gather([self.async_client.list_pages(action, params)
+                                               for action, params in requests]))
+        return set((feature["video_clip"], feature["dnn_stream"], feature["dnn_stream_split"])
+                   for features in pages for feature in features)
+
+    async def _create_feature(self, feature_vector, split, feature_name, dnn_weights_file_uri, clip_id, dnn_stream):
         # check to see if feature already exists, and create it if needed
         action = ["features", "list"]
         params = {
@@ -95,7 +255,7 @@ class APILoadRecords:   # base_url is the api url.  The default is the dev defau
             "dnn_stream": dnn_stream,
             "dnn_stream_split": split,
         }
-        response = self._request(action, params)
+        response = await self.async_client.action(action, params)
 
         # if the feature already exists, validate there is only one.  If it does not exist, create it
         if response["results"]:
@@ -110,12 +270,12 @@ class APILoadRecords:   # base_url is the api url.  The default is the dev defau
                 "video_clip": clip_id,
                 "dnn_stream": dnn_stream,
             }
-            self._request(action, params)
+            await self.async_client.action(action, params)
 
     def _request(self, action, params):
-        while True:
-            try:
-                return self.client.action(self.schema, action, params=params)
-            except ConnectionError:
-                sleep(0.05)
-                print('Try again: action = {}, params = {}'.format(action, params))
+        return self.session.request(action, params)
+
+
+async def _gather(coroutines):
+    # asyncio.run takes a coroutine, not the future of asyncio.gather
+    return await asyncio.gather(*coroutines)
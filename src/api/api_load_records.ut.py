@@ -0,0 +1,108 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+# api_load_records imports the api package, so src/ is put on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from api.api_load_records import APILoadRecords  # noqa: E402
+from api.async_client import AsyncAPIClient  # noqa: E402
+
+FEATURE_DIMENSION = 1024
+
+
+class StubSession:
+    # videos, video clips and features in memory, answering the list, read and create actions of the per-row loader
+    def __init__(self, list_features_of_clips=True):
+        self.url = 'http://stub/'
+        self.records = {"videos": [], "video-clips": [], "features": []}
+        # the schema offers the filters the loader looks for
+        features_filters = ["video_clip", "dnn_stream", "dnn_stream_split"]
+        if list_features_of_clips:
+            features_filters.append("video_clip__in")
+        self.schema = {"features": {"list": SimpleNamespace(fields=[SimpleNamespace(name=name)
+                                                                    for name in features_filters])}}
+        # the loader's requests come from several threads
+        self._lock = threading.Lock()
+
+    def action(self, action, params=None, **kwargs):
+        with self._lock:
+            return self._action(action, dict(params or {}))
+
+    def _action(self, action, params):
+        resource, verb = action
+        records = self.records[resource]
+        if verb == "list":
+            params.pop("page", None)
+            video_name = params.pop("video__name", None)
+            video_clips = params.pop("video_clip__in", None)
+            videos = {video["id"]: video["name"] for video in self.records["videos"]}
+            results = [record for record in records if all(record.get(k) == v for k, v in params.items()) and
+                       (video_name is None or videos[record["video"]] == video_name) and
+                       (video_clips is None or str(record["video_clip"]) in video_clips.split(','))]
+            return {"results": results, "pagination": {"nextPage": None}}
+        if verb == "read":
+            return [record for record in records if record["id"] == params["id"]][0]
+        if verb == "create":
+            record = dict(params, id=len(records) + 1)
+            records.append(record)
+            return record
+        raise Exception("Error: unexpected action {}".format(action))
+
+    request = action
+
+
+class APILoadRecordsTest(unittest.TestCase):
+    """Tests for api_load_records.py."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.split_path = os.path.join(self.directory.name, 'Video0', 'UCF101_split1')
+        os.makedirs(self.split_path)
+        for stream in ('rgb', 'warped_optical_flow'):
+            with open(os.path.join(self.split_path, stream + '_global_pool_features.csv'), 'w') as f:
+                f.write('video =Video0, video url =Video0/, CNN stream ={}, feature blob =global_pool, '
+                        'caffe model =weights\n'.format(stream))
+                for clip in (1, 2, 3):
+                    f.write('{},'.format(clip) + ','.join([str(clip / 4)] * FEATURE_DIMENSION) + '\n')
+        self.session, self.loader = self._loader()
+
+    @staticmethod
+    def _loader(**kwargs):
+        session = StubSession(**kwargs)
+        with mock.patch('api.api_load_records.get_session', return_value=session), \
+                mock.patch('api.api_load_records.get_async_client', return_value=AsyncAPIClient(session)):
+            return session, APILoadRecords(session.url)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_rows_loaded_once(self):
+        self._assert_rows_loaded_once()
+
+    def test_rows_loaded_once_without_listing_features(self):
+        # an API that cannot list the features of a set of clips has each feature looked up before it is created
+        self.session, self.loader = self._loader(list_features_of_clips=False)
+        self._assert_rows_loaded_once()
+
+    def _assert_rows_loaded_once(self):
+        self.assertEqual(self.loader.load_video('Video0', 'Video0', [self.split_path], 10), (6, 0))
+        self.assertEqual([video["name"] for video in self.session.records["videos"]], ['Video0'])
+        self.assertEqual(sorted(clip["clip"] for clip in self.session.records["video-clips"]), [1, 2, 3])
+        features = self.session.records["features"]
+        self.assertEqual(len(features), 6)
+        self.assertEqual(set(feature["dnn_stream"] for feature in features), {'rgb', 'warped_optical_flow'})
+        clips = {clip["id"]: clip["clip"] for clip in self.session.records["video-clips"]}
+        for feature in features:
+            self.assertEqual(feature["feature_vector"][:2], [clips[feature["video_clip"]] / 4] * 2)
+        # loading again finds the video and every clip and feature, and creates none
+        self.loader.load_video('Video0', 'Video0', [self.split_path], 10)
+        self.assertEqual(len(self.session.records["videos"]), 1)
+        self.assertEqual(len(self.session.records["video-clips"]), 3)
+        self.assertEqual(len(self.session.records["features"]), 6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,26 +1,27 @@
 """Make requests for Queries to process based on processing state
 """
 import logging
-from api.authenticate import authenticate
-from requests import ConnectionError
-import coreapi
-import os
-import json
-from time import sleep
+from api.async_client import get_async_client
+from api.session import get_session
+from api.target_encoding import decode_target, encode_target
+
+# query-state list actions for each type of update, requested concurrently by get_status
+QUERY_STATE_ACTIONS = {
+    'revise': ["query-state", "compute-revised", "list"],
+    'new': ["query-state", "compute-new", "list"],
+    'finalize': ["query-state", "compute-finalize", "list"],
+}
+# process_state of a query waiting for each type of update, i.e. listed by its QUERY_STATE_ACTIONS action
+WAITING_PROCESS_STATES = {'new': 1, 'revise': 2, 'finalize': 6}
 
 
 class APIRepository:   # base_url is the api url.  The default is the dev default.
     def __init__(self, base_url="http://127.0.0.1:8000/"):
         self.logger = logging.getLogger(__name__)
-        # Setup authenticated API client
+        # Use the shared authenticated API session; its token and schema are reused across polls
         self.url = base_url
-        self.client = coreapi.Client(auth=authenticate(self.url))
-        try:
-            self.schema = self.client.get(os.path.join(self.url, "docs"))
-        except ConnectionError:
-            sleep(0.05)
-            msg = 'Try again to GET schema for APIRepository instance'
-            logging.warning(msg)
+        self.session = get_session(self.url)
+        self.async_client = get_async_client(self.url)
 
     def get_status(self):
         """Request queries that meet processing_state requirements
@@ -42,37 +43,109 @@ class APIRepository:   # base_url is the api url.  The default is the dev defaul
             }
         """
         try:
-            return {
-                'revise': self._get_query_ready_for_revision(),
-                'new': self._get_query_ready_for_new_matches(),
-                'finalize': self._get_query_ready_for_finalize()
-            }
+            update_types = list(QUERY_STATE_ACTIONS)
+            results = self.async_client.run_gather([(QUERY_STATE_ACTIONS[update_type], None)
+                                                    for update_type in update_types])
+            updates = dict(zip(update_types, results))
+            updates['revise'] = self._convert_split_key(updates['revise'])
+            updates['finalize'] = self._convert_split_key(updates['finalize'])
+            return updates
         except Exception as e:
             logging.error(e)
 
-    def _get_query_ready_for_revision(self):
-        action = ["query-state", "compute-revised", "list"]
-        return self._load_plus_convert_split_key(action)
+    def claim_pending(self, limit, leases=None):
+        """
+        Drain the queries waiting for an update, in the order revise, new, finalize.  Each query is claimed
+        by setting its process_state to 3 (in progress) before the next one is listed, so the query-state
+        lists move on to the next waiting query and no query is handed out twice.  A query whose lease is held by
+        another broker is skipped with the exclude parameter of the query-state lists, if the API offers it.
+
+        :param limit: maximum number of queries to claim
+        :param leases: optional services.LeaseManager shared with other brokers.  A query is only claimed if its
+                       lease can be taken, so two brokers listing the same query cannot both process it.
+        :return: list of (update_type, update_object), with update_object as described in get_status, and its
+                 "process_state" set to 3
+        """
+        claimed = []
+        for update_type, action in QUERY_STATE_ACTIONS.items():
+            seen = set()
+            refused = []
+            while len(claimed) < limit:
+                params = {"exclude": ','.join(str(query_id) for query_id in refused)} if refused else None
+                update_object = self.session.request(action, params)
+                # stop if nothing is waiting, or if the claim did not move the list on to another query
+                if not update_object or update_object["query_id"] in seen:
+                    break
+                seen.add(update_object["query_id"])
+                if leases is not None and not leases.claim(update_type, update_object):
+                    # another broker holds the query.  The next query is listed if the API can skip this one.
+                    if not self._has_param(action, "exclude"):
+                        break
+                    refused.append(update_object["query_id"])
+                    continue
+                if update_type != 'new':
+                    update_object = self._convert_split_key(update_object)
+                self.session.request(["queries", "partial_update"],
+                                     {"id": update_object["query_id"], "process_state": 3})
+                # the ticket need not set the state again
+                update_object["process_state"] = 3
+                claimed.append((update_type, update_object))
+        return claimed
+
+    def release(self, claimed, leases=None):
+        """
+        Hand back claimed queries that were not processed: each is set back to the process_state in which it waits
+        for its update, and its lease is released, so this or another broker claims it again.
+        :param claimed: list of (update_type, update_object), as returned by claim_pending
+        """
+        for update_type, update_object in claimed:
+            try:
+                self.session.request(["queries", "partial_update"],
+                                     {"id": update_object["query_id"],
+                                      "process_state": WAITING_PROCESS_STATES[update_type]})
+            except Exception as e:
+                logging.error('Could not release query {}: {}'.format(update_object["query_id"], e))
+                continue
+            update_object["process_state"] = WAITING_PROCESS_STATES[update_type]
+            if leases is not None:
+                leases.release(update_type, update_object)
 
-    def _get_query_ready_for_new_matches(self):
-        action = ["query-state", "compute-new", "list"]
-        return self.client.action(self.schema, action)
+    def reclaim_expired(self, leases):
+        """
+        :param leases: services.LeaseManager
+        :return: list of (update_type, update_object) for queries whose broker stopped renewing its lease
+        """
+        return [(update_type, self._convert_split_key(update_object) if update_type != 'new' else update_object)
+                for update_type, update_object in leases.reclaim_expired()]
 
-    def _get_query_ready_for_finalize(self):
-        action = ["query-state", "compute-finalize", "list"]
-        return self._load_plus_convert_split_key(action)
+    def _has_param(self, action, name):
+        # True if the API schema offers parameter name for action
+        link = self.session.schema
+        for key in action:
+            link = link[key]
+        return name in [field.name for field in link.fields]
+
+    @staticmethod
+    def as_listed(result):
+        """
+        :param result: update object as returned by get_status or claim_pending
+        :return: a copy of result as listed by the API, with its bootstrapped target encoded again, e.g. for a JSON
+                 lease payload.  _convert_split_key decodes it.
+        """
+        latest_query_result = result.get("latest_query_result")
+        if not latest_query_result or not latest_query_result["bootstrapped_target"] or \
+                isinstance(latest_query_result["bootstrapped_target"], str):
+            return result
+        return dict(result, latest_query_result=dict(
+            latest_query_result, bootstrapped_target=encode_target(latest_query_result["bootstrapped_target"])))
 
-    def _load_plus_convert_split_key(self, action):
+    @staticmethod
+    def _convert_split_key(result):
         # Check if the result exists (i.e. is not None), and if it exists, if it contains a bootstrapped
-        # target. If it does, convert the retrieved target dictionary so splits are integers rather than
-        # strings, to be consistent with api models.
-        result = self.client.action(self.schema, action)
+        # target. If it does, decode the retrieved target into arrays keyed by integer splits, to be consistent
+        # with api models.  Targets of earlier results are JSON text, whose splits are strings.
         if result:
             if result["latest_query_result"]["bootstrapped_target"]:
-                target_dict = json.loads(result["latest_query_result"]["bootstrapped_target"])
-                for stream, split_dict in target_dict.items():
-                    for split in split_dict:
-                        target_dict[stream][int(split)] = \
-                            target_dict[stream].pop(split)
-                result["latest_query_result"]["bootstrapped_target"] = target_dict
+                result["latest_query_result"]["bootstrapped_target"] = \
+                    decode_target(result["latest_query_result"]["bootstrapped_target"])
         return result
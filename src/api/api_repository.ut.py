@@ -0,0 +1,55 @@
+import os
+import sys
+import tempfile
+import unittest
+
+# api_repository imports the api package, and the test runs against the API stand-in of the benchmarks package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("API_CLIENT_USERNAME", "u")
+os.environ.setdefault("API_CLIENT_PASSWORD", "p")
+os.environ["API_SCHEMA_CACHE_DIR"] = tempfile.mkdtemp()
+from api.api_repository import APIRepository  # noqa: E402
+from benchmarks.api_standin import IN_PROGRESS, NEW, StandinServer, StandinStore  # noqa: E402
+from benchmarks.synthetic import FeatureStatistics, SyntheticSearchSet  # noqa: E402
+from services import LeaseManager, SQLiteLeaseBackend  # noqa: E402
+
+
+class APIRepositoryTest(unittest.TestCase):
+    """Tests for api_repository.py."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = StandinStore()
+        video, search_set, __ = self.store.seed_synthetic(SyntheticSearchSet(FeatureStatistics.default(dimension=8),
+                                                                             10))
+        self.query_ids = [self.store.create_query('q{}'.format(k), video, '0:00:00', search_set)["id"]
+                          for k in range(3)]
+        self.server = StandinServer(self.store)
+        self.server.start()
+        self.repository = APIRepository(self.server.url)
+        backend = SQLiteLeaseBackend(os.path.join(self.directory.name, 'leases.sqlite'))
+        self.broker_1 = LeaseManager(backend, 'broker-1')
+        self.broker_2 = LeaseManager(backend, 'broker-2')
+
+    def tearDown(self):
+        self.server.stop()
+        self.directory.cleanup()
+
+    def test_claim_pending_skips_queries_leased_elsewhere(self):
+        # another broker holds the first query, but has not marked it in progress yet
+        self.broker_2.claim('new', self.store.waiting_query('compute-new'))
+        claimed = self.repository.claim_pending(3, self.broker_1)
+        self.assertEqual([update_object["query_id"] for __, update_object in claimed], self.query_ids[1:])
+        self.assertEqual(self.store.queries_in_state(NEW), self.query_ids[:1])
+
+    def test_release(self):
+        claimed = self.repository.claim_pending(2, self.broker_1)
+        self.assertEqual(len(self.store.queries_in_state(IN_PROGRESS)), 2)
+        self.repository.release(claimed, self.broker_1)
+        self.assertEqual(self.store.queries_in_state(NEW), self.query_ids)
+        self.assertEqual(self.broker_1.held, set())
+        self.assertEqual(len(self.repository.claim_pending(3, self.broker_2)), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
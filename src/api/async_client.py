@@ -0,0 +1,94 @@
+"""asyncio interface to the Video Query API, so independent requests can run concurrently
+"""
+from api.session import get_session
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import contextvars
+import math
+import threading
+
+# maximum number of requests in flight at the same time, per API url
+MAX_CONCURRENT_REQUESTS = 8
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_async_client(base_url="http://127.0.0.1:8000/"):
+    # return the shared asyncio client for base_url, creating it on first use
+    with _clients_lock:
+        if base_url not in _clients:
+            _clients[base_url] = AsyncAPIClient(get_session(base_url))
+        return _clients[base_url]
+
+
+class AsyncAPIClient:
+    def __init__(self, session, max_concurrency=MAX_CONCURRENT_REQUESTS):
+        """
+        :param session: APISession whose pooled keep-alive connections carry the requests
+        :param max_concurrency: maximum number of requests in flight at the same time
+
+        coreapi is synchronous, so each request runs on a bounded thread pool and is awaited from the event loop.
+        The run_* methods are synchronous wrappers for callers that are not coroutines.
+        """
+        self.session = session
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    async def action(self, action, params=None, deadline=None, **kwargs):
+        # retries, backoff and the circuit breaker are handled by APISession.request, which stops at the caller's
+        # deadline.  The request runs in a copy of the caller's context, so its response bytes are counted for the
+        # caller's work.
+        loop = asyncio.get_running_loop()
+        request = partial(self.session.request, action, params, deadline=deadline, **kwargs)
+        return await loop.run_in_executor(self._executor, contextvars.copy_context().run, request)
+
+    async def gather(self, requests, deadline=None):
+        """
+        :param requests: list of (action, params) tuples
+        :param deadline: time.time() after which no request is retried, as in APISession.request
+        :return: list of responses, in the same order as requests
+        """
+        return await asyncio.gather(*[self.action(action, params, deadline=deadline) for action, params in requests])
+
+    async def list_pages(self, action, params=None, deadline=None):
+        """
+        :param deadline: time.time() after which no request is retried, as in APISession.request
+        :return: list of the "results" of every page of a paginated list action
+
+        If the first page reports a total "count", the remaining pages are requested concurrently.
+        Otherwise the pages are followed one at a time through "nextPage".
+        """
+        params = dict(params or {})
+        first = await self.action(action, dict(params, page=1), deadline=deadline)
+        results = list(first["results"])
+        pagination = first["pagination"]
+        if pagination["nextPage"] is None:
+            return results
+
+        count = pagination.get("count")
+        if count is not None and results:
+            npages = math.ceil(count / len(results))
+            pages = await self.gather([(action, dict(params, page=page)) for page in range(2, npages + 1)],
+                                     deadline=deadline)
+            for page in pages:
+                results.extend(page["results"])
+            return results
+
+        page = pagination["nextPage"]
+        while page is not None:
+            response = await self.action(action, dict(params, page=page), deadline=deadline)
+            results.extend(response["results"])
+            page = response["pagination"]["nextPage"]
+        return results
+
+    @staticmethod
+    def run(coroutine):
+        return asyncio.run(coroutine)
+
+    def run_gather(self, requests, deadline=None):
+        return self.run(self.gather(requests, deadline))
+
+    def run_list_pages(self, action, params=None, deadline=None):
+        return self.run(self.list_pages(action, params, deadline))
@@ -3,9 +3,10 @@ import os
 import coreapi
 
 
-def authenticate(api_url="http://127.0.0.1:8000/"):
-    # Request a token
-    response = requests.post(
+def authenticate(api_url="http://127.0.0.1:8000/", session=None):
+    # Request a token, on the pooled connection of session (a requests.Session) if one is given
+    http = session if session is not None else requests
+    response = http.post(
         os.path.join(api_url, 'api-token-auth/'),
         data={
             'username': os.environ['API_CLIENT_USERNAME'],
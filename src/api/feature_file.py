@@ -0,0 +1,109 @@
+"""Feature files written by calcSig_wOF.writeFeatures, and their binary sidecars.
+
+A feature file is a csv file whose first row describes the video and model,
+    video =<name>, video url =<url>, CNN stream =<stream>, feature blob =<name>, caffe model =<weights uri>
+followed by one row per clip: the clip number, then the values of its feature.
+
+The values of a csv file are read as float64, and posted to the API as they were written.  The sidecar of <file>.csv is
+<file>.csv.npy, the features as float32 to halve its size, and <file>.csv.json, the header, the clip numbers and the
+size and modification time of the csv file.  A sidecar is only read while they match the csv file.
+"""
+import io
+import json
+import numpy as np
+import os
+
+# dimension of the global_pool features of the TSN models
+FEATURE_DIMENSION = 1024
+HEADER_FIELDS = ("video", "video_url", "dnn_stream", "feature_name", "dnn_weights_uri")
+
+
+class FeatureFile:
+    def __init__(self, header, clips, features):
+        """
+        :param header: dict of HEADER_FIELDS
+        :param clips: integer array of the clip numbers
+        :param features: float64 array read from a csv file, or float32 array read from a sidecar, one row per clip
+        """
+        self.header = header
+        self.clips = clips
+        self.features = features
+
+    @classmethod
+    def read(cls, path, dimension=FEATURE_DIMENSION, use_sidecar=True):
+        # from the sidecar of path if it is up to date, otherwise from the csv file
+        if use_sidecar:
+            feature_file = cls.read_sidecar(path, dimension)
+            if feature_file is not None:
+                return feature_file
+        return cls.read_csv(path, dimension)
+
+    @classmethod
+    def read_csv(cls, path, dimension=FEATURE_DIMENSION):
+        with open(path, 'r') as f:
+            header = parse_header(f.readline())
+            body = f.read().strip()
+        try:
+            values = np.loadtxt(io.StringIO(body), delimiter=',', ndmin=2) if body else np.zeros((0, dimension + 1))
+        except ValueError as e:
+            raise Exception("Error: {} should have rows of a clip number and {} values: {}".format(path, dimension, e))
+        if values.shape[1] != dimension + 1:
+            raise Exception("Error: {} should have rows of a clip number and {} values, but has rows of {} values"
+                            .format(path, dimension, values.shape[1] - 1))
+        clips = values[:, 0].astype(np.int64)
+        _check_clips(path, clips, values[:, 0])
+        return cls(header, clips, values[:, 1:])
+
+    @classmethod
+    def read_sidecar(cls, path, dimension=FEATURE_DIMENSION):
+        # None if path has no sidecar, or if the csv file changed since the sidecar was written
+        if not (os.path.exists(path + '.json') and os.path.exists(path + '.npy')):
+            return None
+        with open(path + '.json', 'r') as f:
+            description = json.load(f)
+        if description["csv_stat"] != _stat(path):
+            return None
+        features = np.load(path + '.npy')
+        clips = np.array(description["clips"], dtype=np.int64)
+        if features.shape != (len(clips), dimension):
+            raise Exception("Error: the sidecar of {} has features of shape {}, expected ({}, {})".format(
+                path, features.shape, len(clips), dimension))
+        return cls(description["header"], clips, features)
+
+    def write_sidecar(self, path):
+        # write the sidecar of the csv file at path, which this feature file was read from
+        np.save(path + '.npy', self.features.astype(np.float32))
+        with open(path + '.json', 'w') as f:
+            json.dump({"header": self.header, "clips": self.clips.tolist(), "csv_stat": _stat(path)}, f)
+
+    def rows(self):
+        # [(clip number, feature vector as a list)], as they are posted to the API.  float32 values of a sidecar are
+        # posted in their shortest decimal form, rather than with the digits of their float64 conversion.
+        if self.features.dtype == np.float32:
+            return [(clip, [float(str(value)) for value in feature])
+                    for clip, feature in zip(self.clips.tolist(), self.features)]
+        return list(zip(self.clips.tolist(), self.features.tolist()))
+
+
+def parse_header(line):
+    # dict of HEADER_FIELDS from the first row of a feature file
+    values = [field.partition('=')[2] for field in line.rstrip('\n').split(',')]
+    if len(values) < len(HEADER_FIELDS):
+        raise Exception("Error: feature file header should have {} fields: {}".format(len(HEADER_FIELDS), line))
+    return dict(zip(HEADER_FIELDS, values))
+
+
+def _check_clips(path, clips, values):
+    # clip numbers are distinct positive integers
+    if not np.array_equal(clips, values):
+        raise Exception("Error: {} has clip numbers that are not integers".format(path))
+    if clips.size and clips.min() < 1:
+        raise Exception("Error: {} has clip numbers below 1".format(path))
+    if np.unique(clips).size != clips.size:
+        raise Exception("Error: {} has repeated clip numbers".format(path))
+
+
+def _stat(path):
+    # [size, modification time in ns] of the file at path
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from feature_file import FeatureFile, parse_header
+
+HEADER = ('video =clips, video url =../clips/, CNN stream =rgb, feature blob =global_pool, '
+          'caffe model =/m/rgb.caffemodel\n')
+
+
+class FeatureFileTest(unittest.TestCase):
+    """Tests for feature_file.py."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'rgb_global_pool_features.csv')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _write(self, rows):
+        with open(self.path, 'w') as f:
+            f.write(HEADER + ''.join(rows))
+
+    def test_parse_header(self):
+        header = parse_header(HEADER)
+        self.assertEqual((header["video"], header["dnn_stream"], header["feature_name"], header["dnn_weights_uri"]),
+                         ('clips', 'rgb', 'global_pool', '/m/rgb.caffemodel'))
+
+    def test_read_csv(self):
+        self._write(['1,0.5,1.25,3.0\n', '2,0.090244897902,0.2,0.3\n'])
+        feature_file = FeatureFile.read_csv(self.path, dimension=3)
+        self.assertEqual(feature_file.clips.tolist(), [1, 2])
+        self.assertEqual(feature_file.features.dtype, np.float64)
+        # values are posted as they were written
+        self.assertEqual(feature_file.rows(), [(1, [0.5, 1.25, 3.0]), (2, [0.090244897902, 0.2, 0.3])])
+
+    def test_invalid_files(self):
+        for rows in (['1,0.5,1.25\n'], ['1,0.5,1.25,3.0\n', '1,0.1,0.2,0.3\n'], ['1.5,0.5,1.25,3.0\n'],
+                     ['1,0.5,1.25,3.0\n', '2,0.5,1.25\n'], ['1,0.5,x,3.0\n']):
+            self._write(rows)
+            with self.assertRaises(Exception):
+                FeatureFile.read_csv(self.path, dimension=3)
+
+    def test_sidecar(self):
+        self._write(['3,0.090244897902,1.25,3.0\n'])
+        self.assertIsNone(FeatureFile.read_sidecar(self.path, dimension=3))
+        FeatureFile.read_csv(self.path, dimension=3).write_sidecar(self.path)
+        feature_file = FeatureFile.read_sidecar(self.path, dimension=3)
+        self.assertEqual((feature_file.clips.tolist(), feature_file.header["video"]), ([3], 'clips'))
+        # the float32 values of the sidecar are posted in their shortest form
+        self.assertEqual(feature_file.features.dtype, np.float32)
+        self.assertEqual(feature_file.rows(), [(3, [0.0902449, 1.25, 3.0])])
+        # a sidecar is not used once its csv file changes
+        self._write(['3,0.5,1.25,3.0\n', '4,0.5,1.25,3.0\n'])
+        self.assertIsNone(FeatureFile.read_sidecar(self.path, dimension=3))
+        self.assertEqual(FeatureFile.read(self.path, dimension=3).clips.tolist(), [3, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+"""Local manifest of the feature files loaded into the Video Query API by load_db.py, so files that have not
+changed since they were loaded are skipped without any request.
+"""
+import hashlib
+import sqlite3
+import time
+
+CHECKSUM_BLOCK_SIZE = 1 << 20
+
+
+class IngestionManifest:
+    def __init__(self, path):
+        """
+        :param path: SQLite database file of the manifest.  Only the path is kept, so threads loading different
+                     videos can share the manifest.
+        """
+        self.path = path
+        connection = self._connect()
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS files (api_url TEXT, duration INTEGER, video TEXT, "
+                               "split INTEGER, file_name TEXT, stream TEXT, checksum TEXT, rows INTEGER, loaded REAL, "
+                               "PRIMARY KEY (api_url, duration, video, split, file_name))")
+        connection.close()
+
+    def checksum(self, api_url, duration, video, split, file_name):
+        # checksum of the file when it was last loaded, or None if it never was
+        connection = self._connect()
+        row = connection.execute("SELECT checksum FROM files WHERE api_url = ? AND duration = ? AND video = ? AND "
+                                 "split = ? AND file_name = ?", (api_url, duration, video, split, file_name)).fetchone()
+        connection.close()
+        return row[0] if row is not None else None
+
+    def record(self, api_url, duration, video, files):
+        """
+        Record that files of video were loaded
+        :param files: list of {"split", "file_name", "stream", "checksum", "rows"}
+        """
+        connection = self._connect()
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [
+                (api_url, duration, video, f["split"], f["file_name"], f["stream"], f["checksum"], f["rows"],
+                 time.time()) for f in files])
+        connection.close()
+
+    def files(self, api_url=None):
+        # every file recorded, for api_url if given
+        connection = self._connect()
+        connection.row_factory = sqlite3.Row
+        if api_url is None:
+            rows = connection.execute("SELECT * FROM files ORDER BY video, split, file_name").fetchall()
+        else:
+            rows = connection.execute("SELECT * FROM files WHERE api_url = ? ORDER BY video, split, file_name",
+                                      (api_url,)).fetchall()
+        connection.close()
+        return [dict(row) for row in rows]
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+
+def file_checksum(path):
+    # sha256 of the content of the file at path
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHECKSUM_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,45 @@
+import os
+import tempfile
+import unittest
+from ingestion_manifest import IngestionManifest, file_checksum
+
+
+class IngestionManifestTest(unittest.TestCase):
+    """Tests for ingestion_manifest.py."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.manifest = IngestionManifest(os.path.join(self.directory.name, 'manifest.sqlite'))
+        self.csv_path = os.path.join(self.directory.name, 'rgb_global_pool_features.csv')
+        with open(self.csv_path, 'w') as f:
+            f.write('video =v\n1,0.5,0.25\n')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _record(self, api_url='http://api/'):
+        self.manifest.record(api_url, 10, 'v', [{"split": 1, "file_name": 'rgb_global_pool_features.csv',
+                                                 "stream": 'rgb', "checksum": file_checksum(self.csv_path),
+                                                 "rows": 1}])
+
+    def test_recorded_checksum(self):
+        self.assertIsNone(self.manifest.checksum('http://api/', 10, 'v', 1, 'rgb_global_pool_features.csv'))
+        self._record()
+        self.assertEqual(self.manifest.checksum('http://api/', 10, 'v', 1, 'rgb_global_pool_features.csv'),
+                         file_checksum(self.csv_path))
+        # the same file loaded into another API, or as clips of another duration, is not recorded
+        self.assertIsNone(self.manifest.checksum('http://other/', 10, 'v', 1, 'rgb_global_pool_features.csv'))
+        self.assertIsNone(self.manifest.checksum('http://api/', 5, 'v', 1, 'rgb_global_pool_features.csv'))
+
+    def test_changed_file(self):
+        self._record()
+        with open(self.csv_path, 'a') as f:
+            f.write('2,0.5,0.75\n')
+        self.assertNotEqual(self.manifest.checksum('http://api/', 10, 'v', 1, 'rgb_global_pool_features.csv'),
+                            file_checksum(self.csv_path))
+        self._record()
+        self.assertEqual(len(self.manifest.files('http://api/')), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+"""Retry with backoff, deadlines and a circuit breaker for requests to the Video Query API
+"""
+from coreapi.exceptions import ErrorMessage
+from requests import ConnectionError, ConnectTimeout, Timeout
+from urllib3.exceptions import NewConnectionError
+import random
+import threading
+import time
+
+# seconds a single call may keep retrying before RequestDeadlineExceeded is raised
+DEFAULT_CALL_DEADLINE = 120.0
+# consecutive failed requests that open the circuit, and seconds it stays open before a trial request
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30.0
+# seconds to wait before checking again whether the trial request in flight has closed the circuit
+BREAKER_TRIAL_WAIT = 1.0
+# HTTP statuses that indicate the API is temporarily unavailable
+RETRY_STATUSES = ('502', '503', '504')
+# actions that can be sent again without changing the outcome.  Other actions, e.g. create and bulk_create, are only
+# retried if the request never reached the API, since a timeout or a 504 may come after the API saved the records.
+IDEMPOTENT_ACTIONS = ('list', 'read', 'features', 'partial_update')
+
+
+class RequestDeadlineExceeded(Exception):
+    pass
+
+
+class RetryPolicy:
+    def __init__(self, base_delay=0.05, max_delay=10.0, multiplier=2.0, call_deadline=DEFAULT_CALL_DEADLINE):
+        """
+        :param base_delay: seconds to wait before the first retry
+        :param max_delay: upper limit of the wait between retries
+        :param multiplier: growth of the wait with each retry
+        :param call_deadline: seconds a call may keep retrying, counted from its first attempt
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.call_deadline = call_deadline
+        # separate generator, so jitter does not disturb the seeded global random numbers used by the algorithms
+        self._random = random.Random()
+
+    def delay(self, attempt):
+        # exponential backoff with full jitter
+        return self._random.uniform(0, min(self.max_delay, self.base_delay * self.multiplier ** attempt))
+
+    @staticmethod
+    def is_retryable(error, action=None):
+        """
+        :param action: list of keys of the API action, e.g. ["matches", "create"].  None for an idempotent request.
+        """
+        if action is not None and action[-1] not in IDEMPOTENT_ACTIONS:
+            return _not_sent(error)
+        if isinstance(error, (ConnectionError, Timeout)):
+            return True
+        return isinstance(error, ErrorMessage) and str(error.error.title).startswith(RETRY_STATUSES)
+
+
+def _not_sent(error):
+    # True if no connection to the API could be opened, so the request was never sent
+    if isinstance(error, ConnectTimeout):
+        return True
+    if not isinstance(error, ConnectionError) or not error.args:
+        return False
+    # requests wraps the urllib3 error in a MaxRetryError, whose reason is the error
+    reason = getattr(error.args[0], 'reason', error.args[0])
+    return isinstance(reason, NewConnectionError)
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT,
+                 trial_wait=BREAKER_TRIAL_WAIT):
+        """
+        Closed: requests flow.  Open: after failure_threshold consecutive failures, requests are held back
+        for reset_timeout seconds.  Half open: one trial request is let through; its outcome closes or re-opens.
+        Other requests wait trial_wait seconds at a time while the trial is in flight.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.trial_wait = trial_wait
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self.opened_at is not None and time.time() - self.opened_at < self.reset_timeout
+
+    def seconds_until_trial(self):
+        with self._lock:
+            if self.opened_at is None:
+                return 0
+            remaining = self.reset_timeout - (time.time() - self.opened_at)
+            if remaining <= 0 and self._trial_in_flight:
+                # the trial's outcome is not known yet
+                return self.trial_wait
+            return max(remaining, 0)
+
+    def allow_request(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at < self.reset_timeout or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
@@ -0,0 +1,57 @@
+import time
+import unittest
+from coreapi import Error
+from coreapi.exceptions import ErrorMessage
+from requests import ConnectionError, ConnectTimeout, ReadTimeout
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+from request_policy import CircuitBreaker, RetryPolicy
+
+
+class RetryPolicyTest(unittest.TestCase):
+    """Tests for request_policy.py."""
+
+    def setUp(self):
+        self.unreachable = ConnectionError(MaxRetryError(None, '/matches/', NewConnectionError(None, 'refused')))
+        self.unavailable = ErrorMessage(Error(title='504 Gateway Timeout'))
+
+    def test_idempotent_actions_retried(self):
+        for error in (self.unreachable, ReadTimeout(), ConnectionError(ProtocolError('reset')), self.unavailable):
+            self.assertTrue(RetryPolicy.is_retryable(error, ["matches", "list"]))
+            self.assertTrue(RetryPolicy.is_retryable(error, ["queries", "partial_update"]))
+        self.assertFalse(RetryPolicy.is_retryable(ErrorMessage(Error(title='400 Bad Request')), ["matches", "list"]))
+
+    def test_creates_retried_only_if_not_sent(self):
+        for action in (["matches", "create"], ["query-results", "create"], ["features", "bulk_create"]):
+            self.assertTrue(RetryPolicy.is_retryable(self.unreachable, action))
+            self.assertTrue(RetryPolicy.is_retryable(ConnectTimeout(), action))
+            # the API may have saved the records before the response was lost
+            self.assertFalse(RetryPolicy.is_retryable(ReadTimeout(), action))
+            self.assertFalse(RetryPolicy.is_retryable(ConnectionError(ProtocolError('reset')), action))
+            self.assertFalse(RetryPolicy.is_retryable(self.unavailable, action))
+
+    def test_circuit_breaker_opens(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow_request())
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+        self.assertFalse(breaker.allow_request())
+
+    def test_wait_while_trial_in_flight(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05, trial_wait=0.5)
+        breaker.record_failure()
+        self.assertGreater(breaker.seconds_until_trial(), 0)
+        time.sleep(0.1)
+        self.assertEqual(breaker.seconds_until_trial(), 0)
+        # one request is let through as the trial, the others wait for its outcome
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+        self.assertEqual(breaker.seconds_until_trial(), 0.5)
+        # a failed trial re-opens the circuit for reset_timeout
+        breaker.record_failure()
+        self.assertGreater(breaker.seconds_until_trial(), 0)
+        self.assertFalse(breaker.allow_request())
+
+
+if __name__ == '__main__':
+    unittest.main()
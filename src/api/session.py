@@ -0,0 +1,268 @@
+"""Process-wide authenticated session for the Video Query API.
+
+All API clients in a process share one APISession per API url, so the token request, the schema download and
+the HTTP connection pool are paid for once rather than by every Ticket, APIRepository and APILoadRecords.
+"""
+from api.authenticate import authenticate
+from api.request_policy import CircuitBreaker, RequestDeadlineExceeded, RetryPolicy
+from api.telemetry import RequestTelemetry
+from coreapi.codecs import CoreJSONCodec
+from coreapi.exceptions import ErrorMessage, LinkLookupError
+from coreapi.transports import HTTPTransport
+from requests.adapters import HTTPAdapter
+import coreapi
+import requests
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+# maximum number of pooled keep-alive connections to the API host
+CONNECTION_POOL_SIZE = 16
+# seconds to connect and to wait for each response of a request, unless the deadline of the call comes earlier
+REQUEST_TIMEOUT = float(os.environ.get("API_REQUEST_TIMEOUT", 60.0))
+# shortest timeout given to a request whose call deadline is nearly past
+MIN_REQUEST_TIMEOUT = 1.0
+# seconds a token is reused before requesting a new one.  None reuses it until the API rejects it.
+TOKEN_LIFETIME = float(os.environ["API_TOKEN_LIFETIME"]) if os.environ.get("API_TOKEN_LIFETIME") else None
+# on-disk schema cache; entries older than SCHEMA_CACHE_MAX_AGE seconds are downloaded again
+SCHEMA_CACHE_DIR = os.environ.get("API_SCHEMA_CACHE_DIR",
+                                  os.path.join(os.path.expanduser("~"), ".cache", "video-query-algorithms"))
+SCHEMA_CACHE_MAX_AGE = 24 * 3600
+SCHEMA_CACHE_VERSION = 1
+SCHEMA_MEDIA_TYPES = "application/coreapi+json, application/vnd.coreapi+json"
+
+# count of the API response bytes received for the work of the current context, e.g. one ticket.  Requests sent on
+# executor threads on behalf of that work run in a copy of its context, so they add to the same count.
+_byte_count = contextvars.ContextVar("byte_count", default=None)
+
+
+class _ByteCount:
+    def __init__(self):
+        self.received = 0
+        self._lock = threading.Lock()
+
+    def add(self, nbytes):
+        with self._lock:
+            self.received += nbytes
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(base_url="http://127.0.0.1:8000/"):
+    # return the shared session for base_url, creating it on first use
+    with _sessions_lock:
+        if base_url not in _sessions:
+            _sessions[base_url] = APISession(base_url)
+        return _sessions[base_url]
+
+
+class APISession:
+    def __init__(self, base_url="http://127.0.0.1:8000/"):
+        """
+        :param base_url: url of the Video Query API
+
+        The token is requested on first use and cached until TOKEN_LIFETIME passes or the API answers 401.
+        The parsed schema is cached in memory and in SCHEMA_CACHE_DIR, where it is checked against its sha256.
+        """
+        self.url = base_url
+        self.http = requests.Session()
+        adapter = _TimeoutHTTPAdapter(self._request_timeout, pool_connections=1, pool_maxsize=CONNECTION_POOL_SIZE)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+        self.client = coreapi.Client(transports=[HTTPTransport(session=self.http)])
+        self._lock = threading.RLock()
+        self._token_time = None
+        self._schema = None
+        # how the schema was found each time it was needed, for the broker status
+        self.schema_cache_stats = {"memory_hits": 0, "disk_hits": 0, "downloads": 0}
+        self.retry_policy = RetryPolicy()
+        self.breaker = CircuitBreaker()
+        self.telemetry = RequestTelemetry()
+        # name of the action each thread is currently sending, so response sizes can be attributed to it
+        self._current = threading.local()
+        self.http.hooks["response"].append(self._record_bytes)
+
+    @property
+    def schema(self):
+        with self._lock:
+            if self._schema is None:
+                self._schema = self._load_schema()
+            else:
+                self.schema_cache_stats["memory_hits"] += 1
+            return self._schema
+
+    def request(self, action, params=None, deadline=None, **kwargs):
+        """
+        Send an API action, retrying when the API is unreachable or temporarily unavailable.
+        Retries back off exponentially with jitter, and no request is sent while the circuit breaker is open.
+        Actions that are not idempotent are only retried if the request was never sent, see RetryPolicy.is_retryable.
+        Each request times out after REQUEST_TIMEOUT seconds or at the deadline, whichever comes first.
+
+        :param deadline: time.time() after which to stop retrying.  The earlier of this and the retry policy's
+                         per-call deadline applies.
+        """
+        action_name = "/".join(action)
+        call_deadline = time.time() + self.retry_policy.call_deadline
+        deadline = call_deadline if deadline is None else min(deadline, call_deadline)
+        attempt = 0
+        while True:
+            if self.breaker.allow_request():
+                start = time.time()
+                self._current.action_name = action_name
+                self._current.deadline = deadline
+                try:
+                    result = self.action(action, params, **kwargs)
+                except Exception as e:
+                    self.telemetry.record_request(action_name, time.time() - start, failed=True)
+                    if not self.retry_policy.is_retryable(e, action):
+                        # the API answered, so it is up even though the request failed
+                        self.breaker.record_success()
+                        raise
+                    self.breaker.record_failure()
+                    error = e
+                    wait = self.retry_policy.delay(attempt)
+                else:
+                    self.telemetry.record_request(action_name, time.time() - start)
+                    self.breaker.record_success()
+                    return result
+                finally:
+                    self._current.action_name = None
+                    self._current.deadline = None
+            else:
+                error = 'circuit breaker is open'
+                wait = max(self.breaker.seconds_until_trial(), self.retry_policy.base_delay)
+
+            if time.time() + wait > deadline:
+                raise RequestDeadlineExceeded('Gave up on API request after {} retries: action = {}, params = {}, '
+                                              'last error = {}'.format(attempt, action, params, error))
+            attempt += 1
+            self.telemetry.record_retry(action_name)
+            logging.warning('Try API request again in {:.2f} s: action = {}, error = {}'.format(wait, action, error))
+            time.sleep(wait)
+
+    def action(self, action, params=None, **kwargs):
+        """
+        Same as coreapi.Client.action, with the cached schema.  A rejected token is renewed and a stale schema
+        is downloaded again, each at most once per call.
+        """
+        self.authenticate()
+        try:
+            return self.client.action(self.schema, action, params=params, **kwargs)
+        except ErrorMessage as e:
+            if not str(e.error.title).startswith("401"):
+                raise
+            logging.warning('API rejected the cached token, authenticating again')
+            self.authenticate(force=True)
+        except LinkLookupError:
+            logging.warning('Action {} is not in the cached API schema, downloading schema again'.format(action))
+            self.refresh_schema()
+        return self.client.action(self.schema, action, params=params, **kwargs)
+
+    def authenticate(self, force=False):
+        with self._lock:
+            expired = TOKEN_LIFETIME is not None and self._token_time is not None \
+                and time.time() - self._token_time > TOKEN_LIFETIME
+            if self.http.auth is not None and not force and not expired:
+                return
+            # the token request must not carry the rejected token, which the API would answer with 401
+            self.http.auth = None
+            self.http.auth = authenticate(self.url, session=self.http)
+            self._token_time = time.time()
+
+    def refresh_schema(self):
+        with self._lock:
+            self._schema = self._load_schema(use_cache=False)
+
+    def _load_schema(self, use_cache=True):
+        content = self._read_cached_schema() if use_cache else None
+        if content is None:
+            self.authenticate()
+            response = self.http.get(os.path.join(self.url, "docs"), headers={"Accept": SCHEMA_MEDIA_TYPES})
+            response.raise_for_status()
+            content = response.content
+            self._write_cached_schema(content)
+            self.schema_cache_stats["downloads"] += 1
+        else:
+            self.schema_cache_stats["disk_hits"] += 1
+        return CoreJSONCodec().decode(content, base_url=os.path.join(self.url, "docs"))
+
+    def _request_timeout(self):
+        # timeout of the calling thread's next HTTP request
+        deadline = getattr(self._current, "deadline", None)
+        if deadline is None:
+            return REQUEST_TIMEOUT
+        return max(min(REQUEST_TIMEOUT, deadline - time.time()), MIN_REQUEST_TIMEOUT)
+
+    def bytes_received(self):
+        # bytes of API responses received so far for the work of the calling context, including the requests it
+        # sent through AsyncAPIClient or a WriteBehindQueue, for attributing payload sizes to its work
+        return self._context_byte_count().received
+
+    @staticmethod
+    def _context_byte_count():
+        count = _byte_count.get()
+        if count is None:
+            count = _ByteCount()
+            _byte_count.set(count)
+        return count
+
+    def _record_bytes(self, response, *args, **kwargs):
+        action_name = getattr(self._current, "action_name", None) or "other"
+        body = response.request.body
+        sent = len(body) if isinstance(body, (bytes, str)) else 0
+        self.telemetry.record_bytes(action_name, sent, len(response.content))
+        self._context_byte_count().add(len(response.content))
+
+    def _cache_file(self):
+        url_key = hashlib.sha1(self.url.encode('utf-8')).hexdigest()
+        return os.path.join(SCHEMA_CACHE_DIR, 'schema_{}.json'.format(url_key))
+
+    def _read_cached_schema(self):
+        try:
+            with open(self._cache_file(), 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        content = cached.get("content", "").encode('utf-8')
+        if cached.get("version") != SCHEMA_CACHE_VERSION or cached.get("url") != self.url \
+                or cached.get("sha256") != hashlib.sha256(content).hexdigest() \
+                or time.time() - cached.get("fetched", 0) > SCHEMA_CACHE_MAX_AGE:
+            return None
+        return content
+
+    def _write_cached_schema(self, content):
+        cached = {
+            "version": SCHEMA_CACHE_VERSION,
+            "url": self.url,
+            "fetched": time.time(),
+            "sha256": hashlib.sha256(content).hexdigest(),
+            "content": content.decode('utf-8'),
+        }
+        try:
+            os.makedirs(SCHEMA_CACHE_DIR, exist_ok=True)
+            # write to a temporary file and rename it, so concurrent brokers never read a partial file
+            temp_file = '{}.{}.tmp'.format(self._cache_file(), os.getpid())
+            with open(temp_file, 'w') as f:
+                json.dump(cached, f)
+            os.replace(temp_file, self._cache_file())
+        except OSError as e:
+            logging.warning('Could not write API schema cache: {}'.format(e))
+
+
+class _TimeoutHTTPAdapter(HTTPAdapter):
+    # coreapi sends requests without a timeout, so the adapter gives every request one
+    def __init__(self, timeout, **kwargs):
+        """
+        :param timeout: function returning the timeout of the next request, in seconds
+        """
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout if timeout is not None else self.timeout(), **kwargs)
@@ -0,0 +1,82 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+# session imports the api package, and the test runs against the API stand-in of the benchmarks package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("API_CLIENT_USERNAME", "u")
+os.environ.setdefault("API_CLIENT_PASSWORD", "p")
+os.environ["API_SCHEMA_CACHE_DIR"] = tempfile.mkdtemp()
+from api.async_client import AsyncAPIClient  # noqa: E402
+from api.request_policy import RequestDeadlineExceeded  # noqa: E402
+from api.session import APISession  # noqa: E402
+from benchmarks.api_standin import StandinServer, StandinStore  # noqa: E402
+
+
+class APISessionTest(unittest.TestCase):
+    """Tests for session.py."""
+
+    def setUp(self):
+        self.store = StandinStore()
+        self.store.create("videos", {"name": "a", "path": "a"})
+        self.server = StandinServer(self.store)
+        self.server.start()
+        self.session = APISession(self.server.url)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_token_reused(self):
+        self.session.request(["videos", "list"])
+        self.session.request(["videos", "list"])
+        self.assertEqual(len(self.server.tokens), 1)
+
+    def test_rejected_token_renewed(self):
+        self.session.request(["videos", "list"])
+        # the API forgets the token, e.g. because it expired
+        self.server.tokens.clear()
+        videos = self.session.request(["videos", "list"])
+        self.assertEqual([video["name"] for video in videos["results"]], ["a"])
+        self.assertEqual(len(self.server.tokens), 1)
+
+    def test_bytes_counted_for_caller(self):
+        self.session.request(["videos", "list"])
+        start = self.session.bytes_received()
+        self.session.request(["videos", "list"])
+        response_size = self.session.bytes_received() - start
+        self.assertGreater(response_size, 0)
+        # requests sent on the async client's executor threads count for the caller
+        AsyncAPIClient(self.session).run_gather([(["videos", "list"], None)] * 3)
+        self.assertEqual(self.session.bytes_received() - start, 4 * response_size)
+        # requests of another thread do not
+        thread = threading.Thread(target=self.session.request, args=(["videos", "list"],))
+        thread.start()
+        thread.join()
+        self.assertEqual(self.session.bytes_received() - start, 4 * response_size)
+
+    def test_hung_request_bounded_by_deadline(self):
+        self.session.request(["videos", "list"])
+        # every response now takes longer than the call may wait
+        self.server.latency = 3.0
+        start = time.time()
+        with self.assertRaises(RequestDeadlineExceeded):
+            self.session.request(["videos", "list"], deadline=time.time() + 1.0)
+        self.assertLess(time.time() - start, 2.5)
+
+    def test_async_requests_bounded_by_deadline(self):
+        client = AsyncAPIClient(self.session)
+        client.run_gather([(["videos", "list"], None)])
+        self.server.latency = 3.0
+        start = time.time()
+        with self.assertRaises(RequestDeadlineExceeded):
+            client.run_gather([(["videos", "list"], None)] * 3, deadline=time.time() + 1.0)
+        with self.assertRaises(RequestDeadlineExceeded):
+            client.run_list_pages(["videos", "list"], deadline=time.time() + 1.0)
+        self.assertLess(time.time() - start, 5.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""Compact encoding of the bootstrapped target of a query result.
+
+A target is { <stream type>: {<split #>: <feature>, ...} }.  It was stored as its JSON text, about 20 bytes per value.
+It is now stored as a small JSON object, with the float32 values of every feature in base64, optionally zlib
+compressed, about 5.3 bytes per value:
+
+    {"version": 1, "dtype": "float32", "compression": null, "dimension": 1024,
+     "keys": [[<stream type>, <split #>], ...], "data": "<base64>"}
+
+decode_target reads both the compact encoding and the JSON text of earlier results.
+"""
+import base64
+import json
+import zlib
+import numpy as np
+
+TARGET_ENCODING_VERSION = 1
+
+
+def encode_target(target_features, compress=False):
+    """
+    :param target_features: { <stream type>: {<split #>: <feature as a list or array>, ...} }
+    :param compress: zlib compress the values
+    :return: text of the compact encoding, or the JSON text of target_features if its features differ in length
+    """
+    keys = [[stream, split] for stream, split_features in target_features.items() for split in split_features]
+    features = [np.asarray(target_features[stream][split], dtype=np.float32) for stream, split in keys]
+    if len(set(feature.shape for feature in features)) > 1 or any(feature.ndim != 1 for feature in features):
+        return json.dumps({stream: {split: np.asarray(feature).tolist() for split, feature in split_features.items()}
+                           for stream, split_features in target_features.items()})
+    data = np.stack(features).tobytes() if features else b''
+    if compress:
+        data = zlib.compress(data)
+    return json.dumps({
+        "version": TARGET_ENCODING_VERSION,
+        "dtype": "float32",
+        "compression": "zlib" if compress else None,
+        "dimension": features[0].size if features else 0,
+        "keys": keys,
+        "data": base64.b64encode(data).decode('ascii'),
+    })
+
+
+def decode_target(text):
+    """
+    :param text: bootstrapped_target of a query result, in the compact encoding or as JSON text
+    :return: { <stream type>: {<split # as an integer>: <feature as an array>, ...} }, or None if text is empty
+    """
+    if not text:
+        return None
+    encoded = json.loads(text)
+    if not _is_compact(encoded):
+        # JSON text of earlier results, whose split keys are strings
+        return {stream: {int(split): np.array(feature) for split, feature in split_features.items()}
+                for stream, split_features in encoded.items()}
+    if encoded["version"] != TARGET_ENCODING_VERSION:
+        raise Exception("Error: bootstrapped_target has encoding version {}, expected {}".format(
+            encoded["version"], TARGET_ENCODING_VERSION))
+    data = base64.b64decode(encoded["data"])
+    if encoded["compression"] == "zlib":
+        data = zlib.decompress(data)
+    features = np.frombuffer(data, dtype=np.float32).reshape(len(encoded["keys"]), encoded["dimension"])
+    target = {}
+    for (stream, split), feature in zip(encoded["keys"], features):
+        target.setdefault(stream, {})[int(split)] = feature
+    return target
+
+
+def _is_compact(encoded):
+    return isinstance(encoded, dict) and "version" in encoded and "data" in encoded
@@ -0,0 +1,41 @@
+import json
+import unittest
+import numpy as np
+from target_encoding import decode_target, encode_target
+
+
+class TargetEncodingTest(unittest.TestCase):
+    """Tests for target_encoding.py."""
+
+    def setUp(self):
+        self.target = {'rgb': {1: [0.5, 0.25, 0.125], 2: np.array([1.0, 2.0, 3.0])},
+                       'warped_optical_flow': {1: [0.1, 0.2, 0.3]}}
+
+    def _assert_target_equal(self, decoded):
+        self.assertEqual({stream: sorted(split_features) for stream, split_features in decoded.items()},
+                         {'rgb': [1, 2], 'warped_optical_flow': [1]})
+        for stream, split_features in self.target.items():
+            for split, feature in split_features.items():
+                np.testing.assert_allclose(decoded[stream][split], feature, rtol=1e-6)
+
+    def test_round_trip(self):
+        for compress in (False, True):
+            self._assert_target_equal(decode_target(encode_target(self.target, compress=compress)))
+
+    def test_json_targets_of_earlier_results(self):
+        text = json.dumps({stream: {split: np.asarray(feature).tolist() for split, feature in split_features.items()}
+                           for stream, split_features in self.target.items()})
+        self._assert_target_equal(decode_target(text))
+
+    def test_features_of_different_lengths_stay_json(self):
+        self.target['rgb'][3] = [1.0]
+        decoded = decode_target(encode_target(self.target))
+        self.assertEqual(decoded['rgb'][3].tolist(), [1.0])
+
+    def test_empty(self):
+        self.assertIsNone(decode_target(''))
+        self.assertEqual(decode_target(encode_target({})), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""Per-action counters for requests to the Video Query API
+"""
+import threading
+
+# upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+
+class ActionStats:
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency_sum = 0.0
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "failures": self.failures,
+            "retries": self.retries,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "latency_sum": self.latency_sum,
+            "latency_buckets": dict(zip(LATENCY_BUCKETS, self.latency_buckets)),
+        }
+
+
+class RequestTelemetry:
+    def __init__(self):
+        # statistics are keyed by action name, e.g. "query-state/compute-new/list"
+        self.actions = {}
+        self._lock = threading.Lock()
+
+    def record_request(self, action_name, latency, failed=False):
+        with self._lock:
+            stats = self._stats(action_name)
+            stats.count += 1
+            stats.failures += 1 if failed else 0
+            stats.latency_sum += latency
+            for k, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    stats.latency_buckets[k] += 1
+                    break
+
+    def record_retry(self, action_name):
+        with self._lock:
+            self._stats(action_name).retries += 1
+
+    def record_bytes(self, action_name, sent, received):
+        with self._lock:
+            stats = self._stats(action_name)
+            stats.bytes_sent += sent
+            stats.bytes_received += received
+
+    def snapshot(self):
+        with self._lock:
+            return {name: stats.as_dict() for name, stats in self.actions.items()}
+
+    def summary(self):
+        # one line per action, busiest first, for the broker log
+        lines = []
+        for name, stats in sorted(self.snapshot().items(), key=lambda item: -item[1]["latency_sum"]):
+            mean_ms = 1000 * stats["latency_sum"] / stats["count"] if stats["count"] else 0
+            lines.append('{}: {} requests, {:.1f} ms mean, {} retries, {} failures, {} bytes sent, {} bytes received'
+                         .format(name, stats["count"], mean_ms, stats["retries"], stats["failures"],
+                                 stats["bytes_sent"], stats["bytes_received"]))
+        return "\n".join(lines)
+
+    def _stats(self, action_name):
+        if action_name not in self.actions:
+            self.actions[action_name] = ActionStats()
+        return self.actions[action_name]
@@ -0,0 +1,84 @@
+"""Collect the writes a Ticket makes to the API and send them at commit points
+"""
+from concurrent.futures import ThreadPoolExecutor, wait
+import contextvars
+import logging
+
+# maximum number of independent writes, e.g. match creates, that are sent to the API at the same time
+MAX_CONCURRENT_WRITES = 8
+
+
+class WriteBehindQueue:
+    def __init__(self, request, query_id, max_concurrent_writes=MAX_CONCURRENT_WRITES):
+        """
+        :param request: function with signature request(action, params) that sends one request to the API
+        :param query_id: primary key of the query whose record receives the merged partial updates
+        :param max_concurrent_writes: number of independent writes that may be in flight at once
+
+        Partial updates of the query record and notes for the query are held until the next flush, and then sent
+        as a single queries/partial_update.  Independent writes are sent immediately on a thread pool.
+        A flush waits for all independent writes before sending the query update, so a process_state
+        is never visible before the writes that preceded it.
+        """
+        self.request = request
+        self.query_id = query_id
+        self.max_concurrent_writes = max_concurrent_writes
+        self.pending_update = {}
+        self.pending_notes = []
+        self._executor = None
+        self._futures = []
+
+    def update_query(self, **fields):
+        # A pending process_state is sent before it can be replaced by a different one, so every state
+        # transition still reaches the API, and in the order it was requested.
+        new_state = fields.get("process_state")
+        pending_state = self.pending_update.get("process_state")
+        if new_state is not None and pending_state is not None and new_state != pending_state:
+            self.flush()
+        self.pending_update.update(fields)
+
+    def add_note(self, note):
+        self.pending_notes.append(note)
+
+    def submit(self, action, params):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrent_writes)
+        # the write runs in a copy of the caller's context, e.g. so its response bytes are counted for the ticket
+        self._futures.append(self._executor.submit(contextvars.copy_context().run, self.request, action, params))
+
+    def flush(self):
+        """
+        Commit point: wait for independent writes, then send the merged query update.
+        :return: the updated query record, or None if there was no query update to send
+        """
+        self._wait_for_writes()
+        if not self.pending_update and not self.pending_notes:
+            return None
+
+        params = {"id": self.query_id}
+        params.update(self.pending_update)
+        if self.pending_notes:
+            params["notes"] = self._merged_notes()
+        result = self.request(["queries", "partial_update"], params)
+        self.pending_update = {}
+        self.pending_notes = []
+        return result
+
+    def _merged_notes(self):
+        # Get current notes by interacting with API, and add all pending notes to them
+        result = self.request(["queries", "read"], {"id": self.query_id})
+        notes = [result["notes"]] if result["notes"] else []
+        return '\n\n'.join(notes + self.pending_notes)
+
+    def _wait_for_writes(self):
+        if self._executor is None:
+            return
+        futures = self._futures
+        self._futures = []
+        wait(futures)
+        self._executor.shutdown(wait=True)
+        self._executor = None
+        for future in futures:
+            if future.exception() is not None:
+                logging.error('Write to API failed for query {}: {}'.format(self.query_id, future.exception()))
+                raise future.exception()
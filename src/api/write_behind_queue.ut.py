@@ -0,0 +1,98 @@
+import logging
+import threading
+import unittest
+from unittest import mock
+from write_behind_queue import WriteBehindQueue
+
+
+class WriteBehindQueueTest(unittest.TestCase):
+    """Tests for write_behind_queue.py."""
+
+    def setUp(self):
+        self.session = mock.Mock()
+        self.session.request.side_effect = self.request
+        self.notes = ''
+        self.queue = WriteBehindQueue(self.session.request, 7)
+
+    def request(self, action, params):
+        if action == ["queries", "read"]:
+            return {"id": 7, "notes": self.notes}
+        return dict(params)
+
+    def actions(self):
+        return [call.args for call in self.session.request.call_args_list]
+
+    def test_updates_merged(self):
+        self.queue.update_query(process_state=3)
+        self.queue.update_query(message='running')
+        self.assertEqual(self.session.request.call_count, 0)
+        self.assertEqual(self.queue.flush(), {"id": 7, "process_state": 3, "message": 'running'})
+        self.assertEqual(self.actions(), [(["queries", "partial_update"], {"id": 7, "process_state": 3,
+                                                                           "message": 'running'})])
+        # nothing is sent when nothing is pending
+        self.assertIsNone(self.queue.flush())
+        self.assertEqual(self.session.request.call_count, 1)
+
+    def test_notes_appended(self):
+        self.notes = 'first note'
+        self.queue.add_note('second note')
+        self.queue.add_note('third note')
+        self.queue.flush()
+        self.assertEqual(self.actions(), [
+            (["queries", "read"], {"id": 7}),
+            (["queries", "partial_update"], {"id": 7, "notes": 'first note\n\nsecond note\n\nthird note'})])
+
+    def test_state_change_flushes(self):
+        # every process_state transition reaches the API, in order
+        self.queue.update_query(process_state=3)
+        self.queue.update_query(process_state=3)
+        self.assertEqual(self.session.request.call_count, 0)
+        self.queue.update_query(process_state=4)
+        self.queue.flush()
+        self.assertEqual([params["process_state"] for action, params in self.actions()], [3, 4])
+
+    def test_writes_sent_before_update(self):
+        release = threading.Event()
+
+        def request(action, params):
+            if action == ["matches", "create"]:
+                release.wait(5.0)
+            return dict(params)
+
+        self.session.request.side_effect = request
+        for video_clip in (1, 2, 3):
+            self.queue.submit(["matches", "create"], {"video_clip": video_clip})
+        self.queue.update_query(process_state=4)
+        flushed = threading.Thread(target=self.queue.flush)
+        flushed.start()
+        # the query update waits for the match creates
+        flushed.join(0.1)
+        self.assertTrue(flushed.is_alive())
+        self.assertNotIn(["queries", "partial_update"], [action for action, params in self.actions()])
+        release.set()
+        flushed.join(5.0)
+        self.assertEqual(self.actions()[-1], (["queries", "partial_update"], {"id": 7, "process_state": 4}))
+        self.assertEqual(sorted(params["video_clip"] for action, params in self.actions()[:-1]), [1, 2, 3])
+
+    def test_write_error_raised(self):
+        def request(action, params):
+            if params.get("video_clip") == 2:
+                raise ValueError('API error')
+            return dict(params)
+
+        self.session.request.side_effect = request
+        for video_clip in (1, 2, 3):
+            self.queue.submit(["matches", "create"], {"video_clip": video_clip})
+        self.queue.update_query(process_state=4)
+        logging.disable(logging.ERROR)
+        try:
+            with self.assertRaises(ValueError):
+                self.queue.flush()
+        finally:
+            logging.disable(logging.NOTSET)
+        # the query update is not sent after a failed write
+        self.assertNotIn(["queries", "partial_update"], [action for action, params in self.actions()])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+"""
+Runs many queries offline, without the API or the broker: the search set is read once from feature files in the
+directory tree of load_db.py, every reference clip is scored against it with the first round math of a query and the
+default weights, and the top scoring and above threshold clips of each reference are written as JSON lines, e.g.
+
+    python batch_queries.py ../data/features/stock-video-clips_features --reference_video DowntownBrooklynDrive_480p
+    python batch_queries.py <src_dir> --references Video0:3,Video1:12 --top_k 50 --output results.jsonl
+
+The references are scored REFERENCE_BLOCK at a time, against CANDIDATE_BLOCK candidate clips at a time.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+os.environ.setdefault("COMPUTE_EPS", "0.000003")  # read by models.hyperparameter on import
+
+from api.feature_file import FeatureFile  # noqa: E402
+from load_db import scan_videos  # noqa: E402
+from models import BatchScorer, FeatureSet, Hyperparameter  # noqa: E402
+from models.batch_scoring import CANDIDATE_BLOCK, REFERENCE_BLOCK  # noqa: E402
+
+# hyperparameter defaults of broker.py
+DEFAULT_WEIGHTS = {
+    'rgb': 1.0,
+    'warped_optical_flow': 1.5
+}
+DEFAULT_THRESHOLD = 0.8
+FEATURE_NAME = 'global_pool'
+
+
+def main(args):
+    weights = parse_weights(args.weights) if args.weights else DEFAULT_WEIGHTS
+    hyperparameters = Hyperparameter(weights, args.threshold, streams=tuple(weights), feature_name=args.feature_name)
+
+    start = time.time()
+    candidates = read_feature_set(args.src_dir, hyperparameters.streams, hyperparameters.feature_name)
+    logging.info('read {} clips of {} in {:.1f} s'.format(len(candidates), args.src_dir, time.time() - start))
+    if args.reference_dir:
+        reference_set = read_feature_set(args.reference_dir, hyperparameters.streams, hyperparameters.feature_name)
+    else:
+        reference_set = candidates
+    positions = reference_positions(reference_set, args)
+    if not positions:
+        raise Exception("Error: no reference clips found")
+
+    scorer = BatchScorer(candidates, hyperparameters.default_weights, hyperparameters.streams)
+    # one more clip is ranked when the reference itself is left out of its results
+    exclude_self = reference_set is candidates and not args.include_self
+    top_k = args.top_k + 1 if exclude_self else args.top_k
+    start = time.time()
+    with open(args.output, 'w') as f:
+        for block_start in range(0, len(positions), args.reference_block):
+            block = positions[block_start:block_start + args.reference_block]
+            results = scorer.rank(reference_set.subset(block), top_k, hyperparameters.threshold, args.candidate_block)
+            for position, (top, above) in zip(block, results):
+                if exclude_self:
+                    top = [item for item in top if item[0] != position][:args.top_k]
+                    above = [item for item in above if item[0] != position]
+                f.write(json.dumps({
+                    "reference": list(reference_set.keys[position]),
+                    "top": [list(candidates.keys[candidate]) + [score] for candidate, score in top],
+                    "above_threshold": [list(candidates.keys[candidate]) + [score] for candidate, score in above],
+                }) + '\n')
+            elapsed = time.time() - start
+            nqueries = block_start + len(block)
+            logging.info('{}/{} references against {} clips in {:.1f} s: {:.1f} queries/s'.format(
+                nqueries, len(positions), len(candidates), elapsed, nqueries / elapsed if elapsed else 0))
+    logging.info('wrote the results of {} references to {}'.format(len(positions), args.output))
+
+
+def read_feature_set(src_dir, streams, feature_name):
+    """
+    :param src_dir: directory tree of feature files, <src_dir>/<video name>/<split name>/<csv files>, as load_db.py
+                    reads it.  Feature files are read from their binary sidecars if they have up to date ones.
+    :return: FeatureSet of every clip, keyed by (video name, clip number)
+    """
+    blocks = []
+    for video_name, __, split_paths in scan_videos(src_dir, 'relative'):
+        for split_path in split_paths:
+            for entry in sorted(os.scandir(split_path), key=lambda entry: entry.name):
+                if not (entry.is_file() and entry.name.endswith('.csv') and not entry.name.startswith('.')):
+                    continue
+                feature_file = FeatureFile.read(entry.path)
+                if feature_file.header["dnn_stream"] in streams and feature_file.header["feature_name"] == feature_name:
+                    # each split directory ends in the split number, as in APILoadRecords._feature_files
+                    blocks.append(([(video_name, clip) for clip in feature_file.clips.tolist()],
+                                   feature_file.header["dnn_stream"], int(split_path[-1]), feature_file.features))
+    return FeatureSet.from_blocks(blocks)
+
+
+def reference_positions(reference_set, args):
+    # positions in reference_set of the clips of args.references, args.reference_file and args.reference_videos
+    keys = []
+    if args.references:
+        keys += [parse_key(key) for key in args.references.split(',')]
+    if args.reference_file:
+        with open(args.reference_file, 'r') as f:
+            keys += [parse_key(line.strip()) for line in f if line.strip()]
+    positions = []
+    for key in keys:
+        position = reference_set.index(key)
+        if position is None:
+            raise Exception("Error: reference clip {}:{} has no features".format(*key))
+        positions.append(position)
+    if args.reference_videos:
+        videos = set(args.reference_videos.split(','))
+        positions += [position for position, key in enumerate(reference_set.keys) if key[0] in videos]
+    return positions
+
+
+def parse_key(text):
+    # (video name, clip number) of "<video name>:<clip number>"
+    video, separator, clip = text.rpartition(':')
+    if not separator:
+        raise Exception("Error: reference clip should be <video name>:<clip number>, not {}".format(text))
+    return video, int(clip)
+
+
+def parse_weights(text):
+    # {<stream>: weight} of "<stream>=<weight>,..."
+    weights = {}
+    for item in text.split(','):
+        stream, __, weight = item.partition('=')
+        weights[stream] = float(weight)
+    return weights
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Score reference clips against a search set of feature files")
+    parser.add_argument("src_dir", help="directory with the feature files of the search set, as read by load_db.py")
+    parser.add_argument("--references", type=str, default=None,
+                        help='comma separated reference clips, <video name>:<clip number>')
+    parser.add_argument("--reference_file", type=str, default=None,
+                        help='file with one reference clip per line, <video name>:<clip number>')
+    parser.add_argument("--reference_videos", "--reference_video", type=str, default=None,
+                        help='comma separated videos whose clips are all references')
+    parser.add_argument("--reference_dir", type=str, default=None,
+                        help='directory with the feature files of the references, default src_dir')
+    parser.add_argument("--include_self", action='store_true',
+                        help='keep each reference in its own results, when the references are taken from src_dir')
+    parser.add_argument("--top_k", type=int, default=20, help='number of top scoring clips written per reference')
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help='clips scoring at least the threshold are written per reference')
+    parser.add_argument("--weights", type=str, default=None,
+                        help='comma separated <stream>=<weight>, default rgb=1.0,warped_optical_flow=1.5')
+    parser.add_argument("--feature_name", type=str, default=FEATURE_NAME)
+    parser.add_argument("--reference_block", type=int, default=REFERENCE_BLOCK,
+                        help='number of references scored together')
+    parser.add_argument("--candidate_block", type=int, default=CANDIDATE_BLOCK,
+                        help='number of search set clips scored together')
+    parser.add_argument("--output", type=str, default='batch_query_results.jsonl', help='JSON lines file of results')
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    main(arguments)
@@ -0,0 +1,3 @@
+from .synthetic import *
+from .api_standin import *
+from .recording import *
@@ -0,0 +1,631 @@
+"""Local stand-in for the Video Query API, for running the broker and compute_matches end to end without Postgres.
+
+Implements the subset of the API the algorithms use, as coreapi actions described by a CoreJSON schema at /docs:
+token auth, the query-state lists, list/create/read/partial_update of videos, video-clips, features, search-sets,
+queries, query-results and matches, the video-clips/features and search-sets/features actions, and bulk_create of
+video-clips and features, which the real API may not offer, for load_db.py's bulk path, as is the exclude parameter of
+the query-state lists.  Records are kept
+in SQLite, in memory by default, and are seeded from feature files laid out as for load_db.py or from a
+benchmarks.synthetic search set.
+
+Query process states follow the API: 1 new, 2 revise, 3 in progress, 4 processed, 5 error, 6 finalize, 7 finalized.
+Each state change is timestamped, so the latency of every query round can be measured.
+
+    python -m benchmarks.api_standin --port 8000 --features-dir ../data/features --latency 0.005
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from email.parser import BytesParser
+from email import policy
+from urllib.parse import parse_qsl, urlsplit
+import argparse
+import csv
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+# process states of a query
+NEW, REVISE, IN_PROGRESS, PROCESSED, ERROR, FINALIZE, FINALIZED = 1, 2, 3, 4, 5, 6, 7
+# query-state list of each state in which a query waits for the algorithms
+QUERY_STATE_LISTS = {'compute-new': NEW, 'compute-revised': REVISE, 'compute-finalize': FINALIZE}
+DEFAULT_PAGE_SIZE = 100
+DEFAULT_CLIP_DURATION = 10
+# columns of each resource, besides its primary key "id"
+RESOURCES = {
+    "videos": ("name TEXT", "path TEXT"),
+    "video-clips": ("video INTEGER", "clip INTEGER", "duration INTEGER", "notes TEXT", "debug_video_uri TEXT"),
+    "features": ("video_clip INTEGER", "dnn_stream TEXT", "dnn_stream_split INTEGER", "name TEXT",
+                 "dnn_weights_uri TEXT", "feature_vector TEXT"),
+    "search-sets": ("name TEXT", "videos TEXT"),
+    "queries": ("name TEXT", "video INTEGER", "reference_time TEXT", "search_set_to_query INTEGER",
+                "max_matches_for_review INTEGER", "use_dynamic_target_adjustment INTEGER", "notes TEXT",
+                "process_state INTEGER", "final_report_file TEXT"),
+    "query-results": ("query INTEGER", "round INTEGER", "match_criterion REAL", "weights TEXT",
+                      "bootstrapped_target TEXT"),
+    "matches": ("query_result INTEGER", "score REAL", "user_match INTEGER", "video_clip INTEGER", "is_match INTEGER"),
+}
+# filters offered by the list action of each resource
+FILTERS = {
+    "videos": ("name", "path"),
+    "video-clips": ("id__in", "video", "video__name", "clip", "duration"),
+    "features": ("video_clip", "video_clip__in", "dnn_stream", "dnn_stream_split"),
+    "search-sets": ("name",),
+    "queries": ("process_state",),
+    "query-results": ("query", "round"),
+    "matches": ("query_result", "user_match"),
+}
+# resources whose records can be created many at a time, with a POST of a JSON list to <resource>/bulk/
+BULK_RESOURCES = ("video-clips", "features")
+JSON_COLUMNS = ("feature_vector", "weights", "videos")
+BOOLEAN_COLUMNS = ("use_dynamic_target_adjustment", "user_match", "is_match")
+
+
+class StandinStore:
+    def __init__(self, path=':memory:'):
+        """
+        :param path: SQLite database file, or ':memory:'.  One connection is shared by the server's threads.
+        """
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        with self._lock, self._connection:
+            for resource, columns in RESOURCES.items():
+                self._connection.execute('CREATE TABLE IF NOT EXISTS {} (id INTEGER PRIMARY KEY, {})'.format(
+                    _table(resource), ', '.join(columns)))
+            self._connection.execute('CREATE TABLE IF NOT EXISTS state_changes (query INTEGER, process_state INTEGER, '
+                                     'time REAL)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS features_clip ON features (video_clip)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS clips_video ON video_clips (video, clip)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS matches_result ON matches (query_result)')
+
+    def seed_from_directory(self, features_dir, duration=DEFAULT_CLIP_DURATION):
+        """
+        Load features as load_db.py does, from <features_dir>/<source>/<video>/<split>/<stream>_<name>_features.csv,
+        and create a search set for each source directory and one, "all", with every video.
+        :return: { <search set name>: search set id }
+        """
+        search_sets = {}
+        all_videos = []
+        for source in sorted(os.listdir(features_dir)):
+            source_path = os.path.join(features_dir, source)
+            if not os.path.isdir(source_path) or source.startswith('.'):
+                continue
+            videos = []
+            for video_name in sorted(os.listdir(source_path)):
+                video_path = os.path.join(source_path, video_name)
+                if not os.path.isdir(video_path) or video_name.startswith('.'):
+                    continue
+                video = self.create("videos", {"name": video_name, "path": video_name})["id"]
+                self._load_video_features(video, video_path, duration)
+                videos.append(video)
+            if videos:
+                search_sets[source] = self.create("search-sets", {"name": source, "videos": videos})["id"]
+                all_videos += videos
+        search_sets["all"] = self.create("search-sets", {"name": "all", "videos": all_videos})["id"]
+        return search_sets
+
+    def seed_synthetic(self, search_set, name='synthetic', feature_name='global_pool',
+                       duration=DEFAULT_CLIP_DURATION):
+        """
+        Load a benchmarks.synthetic.SyntheticSearchSet as one video with a clip for each synthetic clip.
+        :return: (video id, search set id, { <synthetic clip id>: video clip id })
+        """
+        video = self.create("videos", {"name": name, "path": name})["id"]
+        clip_ids = {}
+        with self._lock, self._connection:
+            for synthetic_ids, features in search_set.features():
+                rows = []
+                for k, synthetic_id in enumerate(synthetic_ids.tolist()):
+                    cursor = self._connection.execute(
+                        'INSERT INTO video_clips (video, clip, duration, notes, debug_video_uri) '
+                        'VALUES (?, ?, ?, ?, ?)', (video, synthetic_id - 1, duration, '', name))
+                    clip_ids[synthetic_id] = cursor.lastrowid
+                    for stream, split_features in features.items():
+                        for split, feature_vectors in split_features.items():
+                            rows.append((cursor.lastrowid, stream, split, feature_name, '',
+                                         json.dumps(feature_vectors[k].tolist())))
+                self._connection.executemany('INSERT INTO features (video_clip, dnn_stream, dnn_stream_split, name, '
+                                             'dnn_weights_uri, feature_vector) VALUES (?, ?, ?, ?, ?, ?)', rows)
+        search_set_id = self.create("search-sets", {"name": name, "videos": [video]})["id"]
+        return video, search_set_id, clip_ids
+
+    def create_query(self, name, video, reference_time, search_set, max_matches_for_review=20,
+                     use_dynamic_target_adjustment=False):
+        # a new query, waiting in the compute-new list.  reference_time is "H:MM:SS" into the video.
+        return self.create("queries", {
+            "name": name, "video": video, "reference_time": reference_time, "search_set_to_query": search_set,
+            "max_matches_for_review": max_matches_for_review,
+            "use_dynamic_target_adjustment": use_dynamic_target_adjustment, "notes": "", "process_state": NEW})
+
+    def list(self, resource, filters=None, page=1, page_size=DEFAULT_PAGE_SIZE):
+        # one page of a list action, { "results": [...], "pagination": {...} }
+        where, values = self._where(resource, filters or {})
+        with self._lock:
+            count = self._connection.execute('SELECT COUNT(*) FROM {} {}'.format(_table(resource), where),
+                                             values).fetchone()[0]
+            rows = self._connection.execute('SELECT * FROM {} {} ORDER BY id LIMIT ? OFFSET ?'.format(
+                _table(resource), where), values + [page_size, (page - 1) * page_size]).fetchall()
+        columns = self._columns(resource)
+        npages = max((count + page_size - 1) // page_size, 1)
+        return {
+            "results": [_record(columns, row) for row in rows],
+            "pagination": {
+                "count": count,
+                "currentPage": page,
+                "nextPage": page + 1 if page < npages else None,
+                "previousPage": page - 1 if page > 1 else None,
+            },
+        }
+
+    def read(self, resource, record_id):
+        with self._lock:
+            row = self._connection.execute('SELECT * FROM {} WHERE id = ?'.format(_table(resource)),
+                                           (record_id,)).fetchone()
+        return _record(self._columns(resource), row) if row is not None else None
+
+    def create(self, resource, fields):
+        fields = self._fields(resource, fields)
+        if resource == "matches" and "is_match" not in fields:
+            # the API infers whether a match is above the match criterion of its query result
+            result = self.read("query-results", fields["query_result"])
+            fields["is_match"] = result is not None and fields["score"] >= result["match_criterion"]
+        with self._lock, self._connection:
+            cursor = self._connection.execute('INSERT INTO {} ({}) VALUES ({})'.format(
+                _table(resource), ', '.join(fields), ', '.join('?' * len(fields))), _values(fields))
+            record_id = cursor.lastrowid
+            if resource == "queries":
+                self._state_changed(record_id, fields.get("process_state"))
+        return self.read(resource, record_id)
+
+    def bulk_create(self, resource, records):
+        # create every record of the list records in one transaction, and return them in the same order
+        records = [self._fields(resource, fields) for fields in records]
+        with self._lock, self._connection:
+            record_ids = [self._connection.execute('INSERT INTO {} ({}) VALUES ({})'.format(
+                _table(resource), ', '.join(fields), ', '.join('?' * len(fields))), _values(fields)).lastrowid
+                for fields in records]
+        return [self.read(resource, record_id) for record_id in record_ids]
+
+    def partial_update(self, resource, record_id, fields):
+        fields = self._fields(resource, fields)
+        if fields:
+            with self._lock, self._connection:
+                cursor = self._connection.execute('UPDATE {} SET {} WHERE id = ?'.format(
+                    _table(resource), ', '.join('{} = ?'.format(name) for name in fields)),
+                    _values(fields) + [record_id])
+                if cursor.rowcount and resource == "queries":
+                    self._state_changed(record_id, fields.get("process_state"))
+        return self.read(resource, record_id)
+
+    def clip_features(self, video_clip):
+        # response of video-clips/features, as JSON text
+        with self._lock:
+            rows = self._connection.execute('SELECT video_clip, dnn_stream, dnn_stream_split, name, feature_vector '
+                                            'FROM features WHERE video_clip = ? ORDER BY id', (video_clip,)).fetchall()
+        return _features_json(rows)
+
+    def search_set_features(self, search_set):
+        # response of search-sets/features, the features of every clip of the search set's videos, as JSON text
+        record = self.read("search-sets", search_set)
+        if record is None:
+            return None
+        videos = record["videos"] or []
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT f.video_clip, f.dnn_stream, f.dnn_stream_split, f.name, f.feature_vector FROM features f '
+                'JOIN video_clips c ON f.video_clip = c.id WHERE c.video IN ({}) ORDER BY f.id'.format(
+                    ', '.join('?' * len(videos))), videos).fetchall()
+        return _features_json(rows)
+
+    def waiting_query(self, list_name, exclude=None):
+        """
+        :param list_name: name of a query-state list, e.g. 'compute-new'
+        :param exclude: optional comma separated ids of queries to skip
+        :return: update object of the first query waiting in the list, as described in APIRepository.get_status,
+                 or None
+        """
+        excluded = [int(query_id) for query_id in exclude.split(',')] if exclude else []
+        with self._lock:
+            row = self._connection.execute('SELECT id FROM queries WHERE process_state = ? AND id NOT IN ({}) '
+                                           'ORDER BY id LIMIT 1'.format(', '.join('?' * len(excluded))),
+                                           [QUERY_STATE_LISTS[list_name]] + excluded).fetchone()
+            return self.update_object(row[0]) if row is not None else None
+
+    def update_object(self, query_id):
+        query = self.read("queries", query_id)
+        ref_clip, ref_clip_id = self._reference_clip(query)
+        update_object = {
+            "query_id": query["id"],
+            "video_id": query["video"],
+            "ref_clip": ref_clip,
+            "ref_clip_id": ref_clip_id,
+            "search_set": query["search_set_to_query"],
+            "number_of_matches_to_review": query["max_matches_for_review"],
+            "dynamic_target_adjustment": query["use_dynamic_target_adjustment"],
+        }
+        if query["process_state"] == NEW:
+            return update_object
+        results = self.list("query-results", {"query": query_id}, page_size=2 ** 31)["results"]
+        latest = max(results, key=lambda result: result["round"]) if results else None
+        user_matches = {}
+        for result in sorted(results, key=lambda result: result["round"]):
+            for match in self.matches(result["id"]):
+                if match["user_match"] is not None:
+                    user_matches[str(match["video_clip"])] = match["user_match"]
+        update_object["latest_query_result"] = latest
+        update_object["matches"] = self.matches(latest["id"]) if latest else []
+        update_object["user_matches"] = user_matches
+        return update_object
+
+    def matches(self, query_result):
+        return self.list("matches", {"query_result": query_result}, page_size=2 ** 31)["results"]
+
+    def queries_in_state(self, process_state):
+        with self._lock:
+            rows = self._connection.execute('SELECT id FROM queries WHERE process_state = ? ORDER BY id',
+                                            (process_state,)).fetchall()
+        return [row[0] for row in rows]
+
+    def round_latencies(self):
+        """
+        :return: list of {"query", "update_type", "started", "latency"}, one per finished query round: seconds from
+                 the query entering a query-state list until it is processed, finalized or in error
+        """
+        update_types = {NEW: 'new', REVISE: 'revise', FINALIZE: 'finalize'}
+        with self._lock:
+            rows = self._connection.execute('SELECT query, process_state, time FROM state_changes '
+                                            'ORDER BY query, time').fetchall()
+        rounds = []
+        waiting = {}
+        for query, process_state, changed in rows:
+            if process_state in update_types:
+                waiting[query] = (update_types[process_state], changed)
+            elif process_state in (PROCESSED, ERROR, FINALIZED) and query in waiting:
+                update_type, started = waiting.pop(query)
+                rounds.append({"query": query, "update_type": update_type, "started": started,
+                               "latency": changed - started})
+        return rounds
+
+    def _load_video_features(self, video, video_path, duration):
+        clips = {}
+        rows = []
+        for split_dir in sorted(os.listdir(video_path)):
+            split_path = os.path.join(video_path, split_dir)
+            if not os.path.isdir(split_path) or split_dir.startswith('.'):
+                continue
+            split = int(split_dir[-1])
+            for file_name in sorted(os.listdir(split_path)):
+                if not file_name.endswith('.csv') or file_name.startswith('.'):
+                    continue
+                with open(os.path.join(split_path, file_name), 'r') as f:
+                    reader = csv.reader(f)
+                    # header: video =..., video url =..., CNN stream =..., feature blob =..., caffe model =...
+                    header = [item.split('=')[-1] for item in next(reader)]
+                    for row in reader:
+                        clip = int(row[0])
+                        if clip not in clips:
+                            clips[clip] = self.create("video-clips", {
+                                "video": video, "clip": clip, "duration": duration, "notes": "",
+                                "debug_video_uri": header[1]})["id"]
+                        rows.append((clips[clip], header[2], split, header[3], header[4],
+                                     '[' + ','.join(row[1:]) + ']'))
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT INTO features (video_clip, dnn_stream, dnn_stream_split, name, '
+                                         'dnn_weights_uri, feature_vector) VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def _reference_clip(self, query):
+        # clip n of a video starts at n * clip duration
+        seconds = 0
+        for part in str(query["reference_time"]).split(':'):
+            seconds = 60 * seconds + float(part)
+        with self._lock:
+            row = self._connection.execute('SELECT duration FROM video_clips WHERE video = ? LIMIT 1',
+                                           (query["video"],)).fetchone()
+            if row is None:
+                return None, None
+            ref_clip = int(seconds // row[0])
+            row = self._connection.execute('SELECT id FROM video_clips WHERE video = ? AND clip = ?',
+                                           (query["video"], ref_clip)).fetchone()
+        return ref_clip, row[0] if row is not None else None
+
+    def _state_changed(self, query_id, process_state):
+        if process_state is not None:
+            self._connection.execute('INSERT INTO state_changes VALUES (?, ?, ?)',
+                                     (query_id, process_state, time.time()))
+
+    def _where(self, resource, filters):
+        clauses, values = [], []
+        for name, value in filters.items():
+            if name not in FILTERS[resource]:
+                continue
+            if name.endswith('__in'):
+                ids = [int(item) for item in str(value).split(',') if item]
+                clauses.append('{} IN ({})'.format(name[:-len('__in')], ', '.join('?' * len(ids))))
+                values += ids
+            elif name == 'video__name':
+                clauses.append('video IN (SELECT id FROM videos WHERE name = ?)')
+                values.append(value)
+            else:
+                clauses.append('{} = ?'.format(name))
+                values.append(_boolean(value) if name in BOOLEAN_COLUMNS else value)
+        return ('WHERE ' + ' AND '.join(clauses) if clauses else ''), values
+
+    def _fields(self, resource, fields):
+        # the writable fields of resource that are in fields, in the form they are stored
+        columns = self._columns(resource)[1:]
+        stored = {}
+        for name, value in fields.items():
+            if name not in columns:
+                continue
+            if name in JSON_COLUMNS and not isinstance(value, str):
+                value = json.dumps(value)
+            elif name in BOOLEAN_COLUMNS and value is not None:
+                value = _boolean(value)
+            stored[name] = value
+        return stored
+
+    @staticmethod
+    def _columns(resource):
+        return ("id",) + tuple(column.split()[0] for column in RESOURCES[resource])
+
+
+class StandinServer:
+    def __init__(self, store, host='127.0.0.1', port=0, latency=0.0, page_size=DEFAULT_PAGE_SIZE, users=None):
+        """
+        :param store: StandinStore with the records served
+        :param port: port to listen on, 0 for any free port
+        :param latency: seconds added to every response, to stand in for the network and the API's own work
+        :param page_size: number of records in a page of a list action
+        :param users: optional {username: password} accepted by api-token-auth.  None accepts any credentials.
+        """
+        self.store = store
+        self.latency = latency
+        self.page_size = page_size
+        self.users = users
+        self.tokens = set()
+        # number of requests of each action, e.g. "queries/partial_update"
+        self.request_counts = {}
+        self._counts_lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(self._server.server_address[0], self.port)
+
+    def start(self):
+        self._thread.start()
+        logging.info('Video Query API stand-in at {}'.format(self.url))
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def schema(self, base_url):
+        # CoreJSON document describing the actions, with urls under base_url
+        def link(url, method, fields=(), encoding=None):
+            node = {"_type": "link", "url": base_url + url, "action": method, "fields": list(fields)}
+            if encoding:
+                node["encoding"] = encoding
+            return node
+
+        id_field = {"name": "id", "required": True, "location": "path"}
+        document = {"_type": "document", "_meta": {"url": base_url + "docs/", "title": "Video Query API stand-in"}}
+        for resource in RESOURCES:
+            form_fields = [{"name": name, "location": "form"} for name in self._columns(resource)[1:]]
+            document[resource] = {
+                "list": link(resource + "/", "get", [{"name": "page", "location": "query"}] +
+                             [{"name": name, "location": "query"} for name in FILTERS[resource]]),
+                "create": link(resource + "/", "post", form_fields, "application/json"),
+                "read": link(resource + "/{id}/", "get", [id_field]),
+                "partial_update": link(resource + "/{id}/", "patch", [id_field] + form_fields, "application/json"),
+            }
+        for resource in BULK_RESOURCES:
+            document[resource]["bulk_create"] = link(resource + "/bulk/", "post",
+                                                     [{"name": "data", "location": "body"}], "application/json")
+        for resource in ("video-clips", "search-sets"):
+            document[resource]["features"] = link(resource + "/{id}/features/", "get", [id_field])
+        document["query-state"] = {name: {"list": link("query-state/{}/".format(name), "get",
+                                                       [{"name": "exclude", "location": "query"}])}
+                                   for name in QUERY_STATE_LISTS}
+        return document
+
+    def _columns(self, resource):
+        return self.store._columns(resource)
+
+    def _count(self, action_name):
+        with self._counts_lock:
+            self.request_counts[action_name] = self.request_counts.get(action_name, 0) + 1
+
+    def _handler_class(self):
+        server = self
+
+        class StandinHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def do_PATCH(self):
+                self._handle('PATCH')
+
+            def _handle(self, method):
+                url = urlsplit(self.path)
+                parts = [part for part in url.path.split('/') if part]
+                query = dict(parse_qsl(url.query))
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if server.latency:
+                    time.sleep(server.latency)
+                try:
+                    if parts == ['api-token-auth'] and method == 'POST':
+                        # as with DRF TokenAuthentication, a request carrying an invalid token is rejected on
+                        # every endpoint, the token endpoint included
+                        if self.headers.get('Authorization') and not self._authorized():
+                            self._reply(401, {"detail": "Invalid token."})
+                            return
+                        self._authenticate(body)
+                        return
+                    if not self._authorized():
+                        self._reply(401, {"detail": "Invalid token."})
+                        return
+                    if parts == ['docs']:
+                        base_url = 'http://{}/'.format(self.headers.get('Host'))
+                        self._reply(200, server.schema(base_url), 'application/coreapi+json')
+                        return
+                    action_name, code, result = self._route(method, parts, query, body)
+                    server._count(action_name)
+                    self._reply(code, result)
+                except (KeyError, ValueError, TypeError, sqlite3.Error) as e:
+                    self._reply(400, {"detail": str(e)})
+
+            def _route(self, method, parts, query, body):
+                if len(parts) == 2 and parts[0] == 'query-state' and method == 'GET':
+                    if parts[1] not in QUERY_STATE_LISTS:
+                        return 'other', 404, {"detail": "Not found."}
+                    return 'query-state/{}/list'.format(parts[1]), 200, server.store.waiting_query(
+                        parts[1], query.get('exclude'))
+                if not parts or parts[0] not in RESOURCES:
+                    return 'other', 404, {"detail": "Not found."}
+                resource = parts[0]
+                if len(parts) == 1 and method == 'GET':
+                    page = int(query.pop('page', 1))
+                    return resource + '/list', 200, server.store.list(resource, query, page, server.page_size)
+                if len(parts) == 1 and method == 'POST':
+                    return resource + '/create', 201, server.store.create(resource, self._fields(body))
+                if parts[1:] == ['bulk'] and method == 'POST' and resource in BULK_RESOURCES:
+                    records = json.loads(body.decode('utf-8'))
+                    if not isinstance(records, list):
+                        raise ValueError('Expected a list of records.')
+                    return resource + '/bulk_create', 201, server.store.bulk_create(resource, records)
+                record_id = int(parts[1])
+                if len(parts) == 3 and parts[2] == 'features' and method == 'GET':
+                    if resource == 'video-clips':
+                        result = server.store.clip_features(record_id)
+                    else:
+                        result = server.store.search_set_features(record_id)
+                    return resource + '/features', 200 if result is not None else 404, result
+                if len(parts) == 2 and method == 'GET':
+                    result = server.store.read(resource, record_id)
+                elif len(parts) == 2 and method == 'PATCH':
+                    result = server.store.partial_update(resource, record_id, self._fields(body))
+                else:
+                    return 'other', 405, {"detail": "Method not allowed."}
+                action_name = resource + ('/read' if method == 'GET' else '/partial_update')
+                return action_name, 200 if result is not None else 404, result or {"detail": "Not found."}
+
+            def _authenticate(self, body):
+                credentials = dict(parse_qsl(body.decode('utf-8')))
+                if server.users is not None and \
+                        server.users.get(credentials.get('username')) != credentials.get('password'):
+                    self._reply(400, {"non_field_errors": ["Unable to log in with provided credentials."]})
+                    return
+                token = secrets.token_hex(20)
+                server.tokens.add(token)
+                self._reply(200, {"token": token})
+
+            def _authorized(self):
+                scheme, __, token = (self.headers.get('Authorization') or '').partition(' ')
+                return scheme == 'Token' and token in server.tokens
+
+            def _fields(self, body):
+                content_type = self.headers.get('Content-Type') or ''
+                if content_type.startswith('multipart/form-data'):
+                    # e.g. the final report file of a query; files are stored by name, with their size
+                    message = BytesParser(policy=policy.HTTP).parsebytes(
+                        b'Content-Type: ' + content_type.encode('utf-8') + b'\r\n\r\n' + body)
+                    fields = {}
+                    for part in message.iter_parts():
+                        name = part.get_param('name', header='content-disposition')
+                        content = part.get_payload(decode=True) or b''
+                        if part.get_filename():
+                            fields[name] = '{} ({} bytes)'.format(part.get_filename(), len(content))
+                        else:
+                            fields[name] = content.decode('utf-8')
+                    return fields
+                if content_type.startswith('application/x-www-form-urlencoded'):
+                    return dict(parse_qsl(body.decode('utf-8')))
+                return json.loads(body.decode('utf-8')) if body else {}
+
+            def _reply(self, code, result, content_type='application/json'):
+                body = result if isinstance(result, str) else json.dumps(result)
+                content = body.encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return StandinHandler
+
+
+def _table(resource):
+    return resource.replace('-', '_')
+
+
+def _record(columns, row):
+    record = dict(zip(columns, row))
+    for name in JSON_COLUMNS:
+        if record.get(name) is not None:
+            record[name] = json.loads(record[name])
+    for name in BOOLEAN_COLUMNS:
+        if record.get(name) is not None:
+            record[name] = bool(record[name])
+    return record
+
+
+def _values(fields):
+    return [int(value) if isinstance(value, bool) else value for value in fields.values()]
+
+
+def _boolean(value):
+    if isinstance(value, str):
+        return 1 if value.lower() in ('true', '1') else 0
+    return 1 if value else 0
+
+
+def _features_json(rows):
+    # feature records as returned by the features actions, built from the stored JSON of the feature vectors
+    return '[' + ','.join('{{"video_clip_id": {}, "dnn_stream_id": {}, "dnn_stream_split": {}, "name": {}, '
+                          '"feature_vector": {}}}'.format(video_clip, json.dumps(stream), split, json.dumps(name),
+                                                          feature_vector)
+                          for video_clip, stream, split, name, feature_vector in rows) + ']'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Video Query API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--db', default=':memory:', help='SQLite database file of the records')
+    parser.add_argument('--features-dir', default=None, help='feature files to seed the records from, as for load_db')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    store = StandinStore(args.db)
+    if args.features_dir:
+        logging.info('Search sets: {}'.format(store.seed_from_directory(args.features_dir)))
+    server = StandinServer(store, args.host, args.port, args.latency, args.page_size)
+    server.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
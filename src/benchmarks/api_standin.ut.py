@@ -0,0 +1,89 @@
+import unittest
+import coreapi
+import requests
+from api_standin import FINALIZE, PROCESSED, StandinServer, StandinStore
+from synthetic import FeatureStatistics, SyntheticSearchSet
+
+
+class StandinTest(unittest.TestCase):
+    """Tests for api_standin.py."""
+
+    def setUp(self):
+        self.store = StandinStore()
+        search_set = SyntheticSearchSet(FeatureStatistics.default(dimension=8), 30)
+        self.video, self.search_set, self.clip_ids = self.store.seed_synthetic(search_set)
+        self.server = StandinServer(self.store, page_size=10)
+        self.server.start()
+        token = requests.post(self.server.url + 'api-token-auth/', data={"username": "u", "password": "p"}).json()
+        auth = coreapi.auth.TokenAuthentication(scheme='Token', token=token["token"])
+        self.client = coreapi.Client(auth=auth)
+        self.schema = self.client.get(self.server.url + 'docs/')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_token_required(self):
+        self.assertEqual(requests.get(self.server.url + 'videos/').status_code, 401)
+        # an invalid token is rejected by the token endpoint too
+        response = requests.post(self.server.url + 'api-token-auth/', data={"username": "u", "password": "p"},
+                                 headers={"Authorization": "Token expired"})
+        self.assertEqual(response.status_code, 401)
+
+    def test_list_pages_and_filters(self):
+        clips = self.client.action(self.schema, ["video-clips", "list"], params={"page": 2})
+        self.assertEqual(len(clips["results"]), 10)
+        self.assertEqual(clips["pagination"]["nextPage"], 3)
+        self.assertEqual(clips["pagination"]["count"], 30)
+        ids = "{},{}".format(self.clip_ids[3], self.clip_ids[7])
+        clips = self.client.action(self.schema, ["video-clips", "list"], params={"id__in": ids})
+        self.assertEqual([clip["clip"] for clip in clips["results"]], [2, 6])
+
+    def test_features(self):
+        features = self.client.action(self.schema, ["search-sets", "features"], params={"id": self.search_set})
+        self.assertEqual(len(features), 30 * 2 * 3)
+        self.assertEqual(len(features[0]["feature_vector"]), 8)
+        features = self.client.action(self.schema, ["video-clips", "features"], params={"id": self.clip_ids[1]})
+        self.assertEqual({(f["dnn_stream_id"], f["dnn_stream_split"]) for f in features},
+                         {(stream, split) for stream in ('rgb', 'warped_optical_flow') for split in (1, 2, 3)})
+
+    def test_bulk_create(self):
+        clips = self.client.action(self.schema, ["video-clips", "bulk_create"], params={"data": [
+            {"clip": clip, "duration": 10, "debug_video_uri": "v", "video": self.video} for clip in (30, 31)]})
+        self.assertEqual([clip["clip"] for clip in clips], [30, 31])
+        self.client.action(self.schema, ["features", "bulk_create"], params={"data": [
+            {"video_clip": clip["id"], "dnn_stream": "rgb", "dnn_stream_split": 1, "name": "global_pool",
+             "dnn_weights_uri": "w", "feature_vector": [0.5] * 8} for clip in clips]})
+        ids = ",".join(str(clip["id"]) for clip in clips)
+        features = self.client.action(self.schema, ["features", "list"], params={"video_clip__in": ids})
+        self.assertEqual(sorted(feature["video_clip"] for feature in features["results"]),
+                         [clip["id"] for clip in clips])
+
+    def test_query_rounds(self):
+        query = self.store.create_query('q', self.video, '0:00:20', self.search_set)
+        update_object = self.client.action(self.schema, ["query-state", "compute-new", "list"])
+        self.assertEqual((update_object["query_id"], update_object["ref_clip"], update_object["ref_clip_id"]),
+                         (query["id"], 2, self.clip_ids[3]))
+        self.client.action(self.schema, ["queries", "partial_update"], params={"id": query["id"], "process_state": 3})
+        self.assertIsNone(self.client.action(self.schema, ["query-state", "compute-new", "list"]))
+
+        result = self.client.action(self.schema, ["query-results", "create"], params={
+            "round": 1, "match_criterion": 0.8, "weights": [1.0, 1.5], "query": query["id"],
+            "bootstrapped_target": "{}"})
+        for clip, score in ((1, 0.9), (2, 0.5)):
+            self.client.action(self.schema, ["matches", "create"], params={
+                "query_result": result["id"], "score": score, "user_match": None, "video_clip": self.clip_ids[clip]})
+        self.store.partial_update("queries", query["id"], {"process_state": PROCESSED})
+        match = self.store.matches(result["id"])[1]
+        self.store.partial_update("matches", match["id"], {"user_match": True})
+        self.store.partial_update("queries", query["id"], {"process_state": FINALIZE})
+
+        update_object = self.client.action(self.schema, ["query-state", "compute-finalize", "list"])
+        self.assertEqual(update_object["latest_query_result"]["id"], result["id"])
+        self.assertEqual([match["is_match"] for match in update_object["matches"]], [True, False])
+        self.assertEqual(update_object["user_matches"], {str(self.clip_ids[2]): True})
+        self.assertEqual([(r["update_type"], r["query"]) for r in self.store.round_latencies()], [('new', query["id"])])
+        self.assertEqual(self.server.request_counts["matches/create"], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,371 @@
+"""Fidelity of approximate scoring modes against the exact pipeline, next to their speedup.
+
+A fast mode replaces the similarity computation of Ticket.compute_similarities.  Each labeled session is run through
+the exact pipeline and through the fast mode, round by round as compute_matches runs it: the first round scores with
+the default weights, and each later round optimizes the weights and threshold on the user's labels of the clips
+selected in the round before.  For every round the harness reports
+
+    score error         fast minus exact scores of every clip, with the exact round's weights
+    recall              fraction of the exact above-threshold clips that are above threshold in the fast pipeline
+    selection overlap   Jaccard overlap of the clips select_clips_to_review picks, with the same random seed
+    weights, threshold  chosen by optimize_weights in each pipeline
+
+and a mode is signed off if every round of every session is within TOLERANCE.  The target is the scaled reference
+clip in every round, as for queries without dynamic target adjustment.
+
+Sessions are synthetic (benchmarks.synthetic, labeled by its matches), built from data/features (labeled by an oracle
+score threshold), or read from a benchmarks.recording file of real sessions (labeled by the users' matches).  Modes
+are added to FAST_MODES.  Run from src/, e.g.
+
+    python -m benchmarks.fidelity --modes numpy,float32,first_split --source synthetic --clips 5000
+    python -m benchmarks.fidelity --modes float32 --source session.jsonl
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import time
+import numpy as np
+
+os.environ.setdefault("COMPUTE_EPS", "0.000003")  # read by models.hyperparameter on import
+
+from benchmarks.api_standin import StandinStore  # noqa: E402
+from benchmarks.kernels import benchmark_hyperparameters, benchmark_ticket, environment, scaled  # noqa: E402
+from benchmarks.synthetic import DEFAULT_FEATURES_DIR, FeatureStatistics, SyntheticSearchSet  # noqa: E402
+
+# largest differences from the exact pipeline for a fast mode to be signed off
+TOLERANCE = {
+    "score_error_p95": 1e-4,
+    "score_error_max": 1e-3,
+    "recall": 0.99,
+    "selection_overlap": 0.9,
+    "threshold_error": 0.01,
+    "weight_error": 0.05,
+}
+DEFAULT_ROUNDS = 3
+MAX_MATCHES_FOR_REVIEW = 20
+MAX_FAILURES_PRINTED = 10
+
+
+class ExactMode:
+    """Similarities as computed by Ticket.compute_similarities."""
+
+    def prepare(self, candidates):
+        # data structure the mode computes similarities from; preparing it is timed separately
+        return candidates
+
+    def similarities(self, prepared, target_features):
+        """
+        :param prepared: result of prepare(candidates), candidates as returned by Ticket._get_candidate_features
+        :param target_features: { <stream type>: {<split #>: [<target feature>], ...} }
+        :return: { video_clip_id: {stream_type: [<avg similarity>, <number of items in ensemble>]} }
+        """
+        return benchmark_ticket(None, target_features)._average_similarities(prepared)
+
+
+class MatrixMode(ExactMode):
+    def __init__(self, dtype=np.float64, splits=None):
+        """
+        Similarities as matrix products of the candidate features.
+        :param dtype: numpy type the features and target are held in, e.g. np.float32 for reduced precision
+        :param splits: splits used, e.g. (1,) to average over one split only; None uses every split of the target
+        """
+        self.dtype = dtype
+        self.splits = splits
+
+    def prepare(self, candidates):
+        # { <stream>: {<split>: (array of clip ids, matrix of their features)} }
+        prepared = {}
+        for stream, split_candidates in candidates.items():
+            prepared[stream] = {}
+            for split, clip_features in split_candidates.items():
+                if self.splits is not None and split not in self.splits:
+                    continue
+                clip_ids = np.array(list(clip_features), dtype=np.int64)
+                prepared[stream][split] = (clip_ids, np.array(list(clip_features.values()), dtype=self.dtype))
+        return prepared
+
+    def similarities(self, prepared, target_features):
+        averaged = {}
+        for stream, split_targets in target_features.items():
+            sums, counts = {}, {}
+            for split, target_feature in split_targets.items():
+                if split not in prepared[stream]:
+                    continue
+                clip_ids, features = prepared[stream][split]
+                for clip_id, similarity in zip(clip_ids.tolist(),
+                                               (features @ np.asarray(target_feature, self.dtype)).tolist()):
+                    sums[clip_id] = sums.get(clip_id, 0.0) + similarity
+                    counts[clip_id] = counts.get(clip_id, 0) + 1
+            for clip_id, total in sums.items():
+                averaged.setdefault(clip_id, {})[stream] = [total / counts[clip_id], counts[clip_id]]
+        return averaged
+
+
+# candidate fast modes, by name
+FAST_MODES = {
+    "numpy": MatrixMode(np.float64),
+    "float32": MatrixMode(np.float32),
+    "first_split": MatrixMode(np.float64, splits=(1,)),
+}
+
+
+class LabeledSession:
+    def __init__(self, name, candidates, reference_features, ref_clip_id, labels):
+        """
+        :param candidates: features of the search set, as returned by Ticket._get_candidate_features
+        :param reference_features: { <stream type>: {<split #>: [<feature>], ...} } of the reference clip
+        :param labels: { video_clip_id: True or False }, the user's evaluation of the clips they would review.
+                       Clips without a label are left unevaluated, as clips a user skips.
+        """
+        self.name = name
+        self.candidates = candidates
+        self.reference_features = reference_features
+        self.ref_clip_id = ref_clip_id
+        self.labels = labels
+
+
+def evaluate(session, mode, rounds=DEFAULT_ROUNDS, seed=0):
+    """
+    Run session through the exact pipeline and through mode.
+    :return: list with a comparison for each round, see the module docstring
+    """
+    target = {stream: {split: scaled(feature) for split, feature in splits.items()}
+              for stream, splits in session.reference_features.items()}
+    exact, fast = ExactMode(), mode
+    exact_prepared, exact_prepare_time = timed(exact.prepare, session.candidates)
+    fast_prepared, fast_prepare_time = timed(fast.prepare, session.candidates)
+    exact_similarities, exact_time = timed(exact.similarities, exact_prepared, target)
+    fast_similarities, fast_time = timed(fast.similarities, fast_prepared, target)
+
+    exact_ticket = benchmark_ticket(session.ref_clip_id, target)
+    exact_ticket.similarities = exact_similarities
+    fast_ticket = benchmark_ticket(session.ref_clip_id, target)
+    fast_ticket.similarities = fast_similarities
+    exact_hyperparameters = benchmark_hyperparameters()
+    fast_hyperparameters = benchmark_hyperparameters()
+    comparisons = []
+    for nround in range(1, rounds + 1):
+        for ticket, hyperparameters in ((exact_ticket, exact_hyperparameters), (fast_ticket, fast_hyperparameters)):
+            run_round(ticket, hyperparameters, session.labels, nround, seed)
+
+        # score error of the fast similarities alone, with the same weights
+        fast_ticket.compute_scores(exact_hyperparameters.weights)
+        errors = np.array([fast_ticket.scores.get(clip_id, np.nan) - score
+                           for clip_id, score in exact_ticket.scores.items()])
+        errors = np.abs(np.nan_to_num(errors, nan=1.0))
+        fast_ticket.compute_scores(fast_hyperparameters.weights)
+
+        exact_above = {clip_id for clip_id, score in exact_ticket.scores.items()
+                       if score >= exact_hyperparameters.threshold}
+        fast_above = {clip_id for clip_id, score in fast_ticket.scores.items()
+                      if score >= fast_hyperparameters.threshold}
+        exact_selected, fast_selected = set(exact_ticket.selected), set(fast_ticket.selected)
+        comparisons.append({
+            "session": session.name,
+            "round": nround,
+            "clips": len(exact_ticket.scores),
+            "score_error_mean": float(errors.mean()) if len(errors) else 0.0,
+            "score_error_p95": float(np.percentile(errors, 95)) if len(errors) else 0.0,
+            "score_error_max": float(errors.max()) if len(errors) else 0.0,
+            "above_threshold": len(exact_above),
+            "recall": len(exact_above & fast_above) / len(exact_above) if exact_above else 1.0,
+            "selection_overlap": len(exact_selected & fast_selected) / len(exact_selected | fast_selected)
+            if exact_selected | fast_selected else 1.0,
+            "exact_threshold": float(exact_hyperparameters.threshold),
+            "fast_threshold": float(fast_hyperparameters.threshold),
+            "threshold_error": abs(float(fast_hyperparameters.threshold - exact_hyperparameters.threshold)),
+            "exact_weights": {stream: float(w) for stream, w in exact_hyperparameters.weights.items()},
+            "fast_weights": {stream: float(w) for stream, w in fast_hyperparameters.weights.items()},
+            "weight_error": max(abs(float(fast_hyperparameters.weights[stream] - w))
+                                for stream, w in exact_hyperparameters.weights.items()),
+            "exact_seconds": exact_time,
+            "fast_seconds": fast_time,
+            "exact_prepare_seconds": exact_prepare_time,
+            "fast_prepare_seconds": fast_prepare_time,
+        })
+    return comparisons
+
+
+def run_round(ticket, hyperparameters, labels, nround, seed):
+    # one round of compute_matches on precomputed similarities; the user labels the clips selected the round before
+    if nround == 1:
+        hyperparameters.weights = hyperparameters.default_weights
+        hyperparameters.threshold = hyperparameters.default_threshold
+    else:
+        ticket.matches = [{"video_clip": clip_id, "user_match": labels.get(clip_id),
+                           "is_match": ticket.scores[clip_id] >= hyperparameters.threshold}
+                          for clip_id in ticket.selected]
+        ticket.user_matches.update({str(clip_id): labels[clip_id] for clip_id in ticket.selected if clip_id in labels})
+        hyperparameters.optimize_weights(ticket)
+    ticket.compute_scores(hyperparameters.weights)
+    random.seed('{}:{}'.format(seed, nround))
+    ticket.select_clips_to_review(hyperparameters.threshold, MAX_MATCHES_FOR_REVIEW, hyperparameters.near_miss_default)
+    ticket.selected = list(ticket.matches)
+
+
+def sign_off(comparisons, tolerance=None):
+    """
+    :return: (True if every round is within tolerance, list of the rounds and measures that are not)
+    """
+    tolerance = dict(TOLERANCE, **(tolerance or {}))
+    failures = []
+    for comparison in comparisons:
+        for measure, limit in tolerance.items():
+            value = comparison[measure]
+            within = value >= limit if measure in ("recall", "selection_overlap") else value <= limit
+            if not within:
+                failures.append('{} round {}: {} = {:.3g}, limit {:.3g}'.format(
+                    comparison["session"], comparison["round"], measure, value, limit))
+    return not failures, failures
+
+
+def synthetic_sessions(nsessions, nclips, features_dir=DEFAULT_FEATURES_DIR, seed=0):
+    # sessions on synthetic search sets, whose true matches are the clips generated from the reference clip
+    statistics = FeatureStatistics.from_directory(features_dir)
+    sessions = []
+    for k in range(nsessions):
+        search_set = SyntheticSearchSet(statistics, nclips, seed=seed + k)
+        true_matches = set(search_set.match_clip_ids().tolist()) | {search_set.ref_clip_id}
+        labels = {clip_id: clip_id in true_matches for clip_id in range(1, nclips + 1)}
+        sessions.append(LabeledSession('synthetic_{}'.format(seed + k), search_set.candidates(),
+                                       search_set.clip_features(search_set.ref_clip_id), search_set.ref_clip_id,
+                                       labels))
+    return sessions
+
+
+def directory_sessions(nsessions, features_dir=DEFAULT_FEATURES_DIR, oracle_threshold=0.85, seed=0):
+    """
+    Sessions on all the clips of features_dir, with random reference clips.  A clip is labeled a match if its exact
+    score with the default weights is at least oracle_threshold, standing in for a user.
+    """
+    store = StandinStore()
+    search_set = store.seed_from_directory(features_dir)["all"]
+    candidates = candidates_from_features(json.loads(store.search_set_features(search_set)))
+    clip_ids = sorted(candidates[next(iter(candidates))][1])
+    sessions = []
+    for ref_clip_id in random.Random(seed).sample(clip_ids, nsessions):
+        reference = {stream: {split: features[ref_clip_id] for split, features in splits.items()}
+                     for stream, splits in candidates.items()}
+        ticket = benchmark_ticket(ref_clip_id, {stream: {split: scaled(feature) for split, feature in splits.items()}
+                                                for stream, splits in reference.items()})
+        ticket.similarities = ExactMode().similarities(candidates, ticket.target.target_features)
+        ticket.compute_scores(benchmark_hyperparameters().default_weights)
+        labels = {clip_id: score >= oracle_threshold for clip_id, score in ticket.scores.items()}
+        sessions.append(LabeledSession('clip_{}'.format(ref_clip_id), candidates, reference, ref_clip_id, labels))
+    return sessions
+
+
+def recorded_sessions(path):
+    """
+    Sessions of the queries in a benchmarks.recording file, with the search set features, reference clip features
+    and user matches the API returned.  Queries whose search set features were not recorded are skipped.
+    """
+    update_objects, search_set_features, clip_features = {}, {}, {}
+    with open(path, 'r') as f:
+        for line in f:
+            record = json.loads(line)
+            if record["method"] != 'GET' or record["status"] != 200:
+                continue
+            parts = [part for part in record["path"].split('?')[0].split('/') if part]
+            body = json.loads(base64.b64decode(record["body"]).decode('utf-8'))
+            if parts[0] == 'query-state' and body:
+                # the latest state of the query has the most user matches
+                update_objects[body["query_id"]] = body
+            elif len(parts) == 3 and parts[2] == 'features' and parts[0] == 'search-sets':
+                search_set_features[int(parts[1])] = body
+            elif len(parts) == 3 and parts[2] == 'features' and parts[0] == 'video-clips':
+                clip_features[int(parts[1])] = body
+    sessions = []
+    for query_id, update_object in sorted(update_objects.items()):
+        if update_object["search_set"] not in search_set_features:
+            continue
+        candidates = candidates_from_features(search_set_features[update_object["search_set"]])
+        ref_clip_id = update_object["ref_clip_id"]
+        if ref_clip_id in clip_features:
+            reference = candidates_from_features(clip_features[ref_clip_id])
+            reference = {stream: {split: features[ref_clip_id] for split, features in splits.items()}
+                         for stream, splits in reference.items()}
+        else:
+            reference = {stream: {split: features[ref_clip_id] for split, features in splits.items()
+                                  if ref_clip_id in features} for stream, splits in candidates.items()}
+        labels = {int(clip_id): user_match for clip_id, user_match in update_object.get("user_matches", {}).items()
+                  if user_match is not None}
+        sessions.append(LabeledSession('query_{}'.format(query_id), candidates, reference, ref_clip_id, labels))
+    return sessions
+
+
+def candidates_from_features(features, streams=('rgb', 'warped_optical_flow'), feature_name='global_pool'):
+    # candidate features in the format of Ticket._get_candidate_features, from a features action response
+    candidates = {stream: {} for stream in streams}
+    for feature in features:
+        if feature["dnn_stream_id"] in candidates and feature["name"] == feature_name:
+            split_candidates = candidates[feature["dnn_stream_id"]].setdefault(feature["dnn_stream_split"], {})
+            split_candidates[feature["video_clip_id"]] = feature["feature_vector"]
+    return candidates
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fidelity and speedup of approximate scoring modes')
+    parser.add_argument('--modes', default=','.join(FAST_MODES), help='comma separated fast modes to evaluate')
+    parser.add_argument('--source', default='synthetic',
+                        help='"synthetic", "data" for data/features, or a file recorded by benchmarks.recording')
+    parser.add_argument('--sessions', type=int, default=3, help='number of synthetic or data sessions')
+    parser.add_argument('--clips', type=int, default=5000, help='clips in each synthetic search set')
+    parser.add_argument('--rounds', type=int, default=DEFAULT_ROUNDS)
+    parser.add_argument('--features-dir', default=DEFAULT_FEATURES_DIR)
+    parser.add_argument('--oracle-threshold', type=float, default=0.85, help='score of a match, for data sessions')
+    parser.add_argument('--tolerance', default=None,
+                        help='JSON object overriding limits of TOLERANCE, e.g. \'{"selection_overlap": 0.8}\'')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='fidelity_results.jsonl', help='JSON lines file the results are added to')
+    args = parser.parse_args()
+
+    if args.source == 'synthetic':
+        sessions = synthetic_sessions(args.sessions, args.clips, args.features_dir, args.seed)
+    elif args.source == 'data':
+        sessions = directory_sessions(args.sessions, args.features_dir, args.oracle_threshold, args.seed)
+    else:
+        sessions = recorded_sessions(args.source)
+    tolerance = json.loads(args.tolerance) if args.tolerance else None
+
+    run_info = environment()
+    with open(args.output, 'a') as f:
+        for name in args.modes.split(','):
+            comparisons = []
+            for session in sessions:
+                comparisons += evaluate(session, FAST_MODES[name], args.rounds, args.seed)
+            passed, failures = sign_off(comparisons, tolerance)
+            result = dict(run_info, mode=name, source=args.source, passed=passed, failures=failures,
+                          tolerance=dict(TOLERANCE, **(tolerance or {})), rounds=comparisons)
+            f.write(json.dumps(result, sort_keys=True) + '\n')
+            print_result(name, comparisons, passed, failures)
+
+
+def print_result(name, comparisons, passed, failures):
+    exact_time = sum(c["exact_seconds"] for c in comparisons if c["round"] == 1)
+    fast_time = sum(c["fast_seconds"] for c in comparisons if c["round"] == 1)
+    print('{}: {}, similarities {:.1f}x faster ({:.3f} s vs {:.3f} s exact)'.format(
+        name, 'PASS' if passed else 'FAIL', exact_time / fast_time if fast_time else float('inf'), fast_time,
+        exact_time))
+    print('  {:<16} {:>5} {:>12} {:>12} {:>8} {:>9} {:>10} {:>10}'.format(
+        'session', 'round', 'error p95', 'error max', 'recall', 'overlap', 'threshold', 'weight'))
+    for c in comparisons:
+        print('  {:<16} {:>5} {:>12.2e} {:>12.2e} {:>8.3f} {:>9.3f} {:>10.4f} {:>10.4f}'.format(
+            c["session"], c["round"], c["score_error_p95"], c["score_error_max"], c["recall"],
+            c["selection_overlap"], c["fast_threshold"], c["fast_weights"].get('warped_optical_flow', 0)))
+    for failure in failures[:MAX_FAILURES_PRINTED]:
+        print('  ' + failure)
+    if len(failures) > MAX_FAILURES_PRINTED:
+        print('  ... {} more, see the output file'.format(len(failures) - MAX_FAILURES_PRINTED))
+
+
+if __name__ == '__main__':
+    main()
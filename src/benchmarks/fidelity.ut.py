@@ -0,0 +1,71 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+# fidelity imports the benchmarks and models packages, so src/ is put on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.fidelity import ExactMode, LabeledSession, MatrixMode, evaluate, sign_off  # noqa: E402
+from benchmarks.synthetic import FeatureStatistics, SyntheticSearchSet  # noqa: E402
+
+NCLIPS = 300
+
+
+class FidelityTest(unittest.TestCase):
+    """Tests for fidelity.py."""
+
+    def setUp(self):
+        search_set = SyntheticSearchSet(FeatureStatistics.default(dimension=16), NCLIPS, match_fraction=0.1)
+        true_matches = set(search_set.match_clip_ids().tolist()) | {search_set.ref_clip_id}
+        labels = {clip_id: clip_id in true_matches for clip_id in range(1, NCLIPS + 1)}
+        self.session = LabeledSession('synthetic', search_set.candidates(),
+                                      search_set.clip_features(search_set.ref_clip_id), search_set.ref_clip_id,
+                                      labels)
+
+    def test_matrix_mode_similarities(self):
+        target = self.session.reference_features
+        exact = ExactMode().similarities(self.session.candidates, target)
+        for mode, places in ((MatrixMode(np.float64), 9), (MatrixMode(np.float32), 3)):
+            similarities = mode.similarities(mode.prepare(self.session.candidates), target)
+            self.assertEqual(set(similarities), set(exact))
+            for stream, (similarity, count) in similarities[7].items():
+                self.assertAlmostEqual(similarity, exact[7][stream][0], places=places)
+                self.assertEqual(count, exact[7][stream][1])
+        # one split only
+        mode = MatrixMode(np.float64, splits=(1,))
+        similarities = mode.similarities(mode.prepare(self.session.candidates), target)
+        self.assertEqual(similarities[7]['rgb'][1], 1)
+
+    def test_exact_mode_signed_off(self):
+        comparisons = evaluate(self.session, MatrixMode(np.float64), rounds=3)
+        self.assertEqual([comparison["round"] for comparison in comparisons], [1, 2, 3])
+        for comparison in comparisons:
+            self.assertEqual(comparison["clips"], NCLIPS)
+            self.assertLess(comparison["score_error_max"], 1e-9)
+            self.assertEqual(comparison["recall"], 1.0)
+            self.assertEqual(comparison["selection_overlap"], 1.0)
+            self.assertLess(comparison["weight_error"], 1e-9)
+        self.assertEqual(sign_off(comparisons), (True, []))
+
+    def test_first_split_rejected(self):
+        comparisons = evaluate(self.session, MatrixMode(np.float64, splits=(1,)), rounds=2)
+        passed, failures = sign_off(comparisons)
+        self.assertFalse(passed)
+        self.assertTrue(any(failure.startswith('synthetic round 1: recall') for failure in failures))
+        # a limit raised over every measure signs the mode off
+        tolerance = {"score_error_p95": np.inf, "score_error_max": np.inf, "recall": 0.0, "selection_overlap": 0.0,
+                     "threshold_error": np.inf, "weight_error": np.inf}
+        self.assertEqual(sign_off(comparisons, tolerance), (True, []))
+
+    def test_sign_off_limits(self):
+        comparison = {"session": 's', "round": 2, "score_error_p95": 0.0, "score_error_max": 0.0, "recall": 1.0,
+                      "selection_overlap": 1.0, "threshold_error": 0.0, "weight_error": 0.0}
+        self.assertEqual(sign_off([comparison]), (True, []))
+        # recall and overlap are lower limits, the errors upper limits
+        passed, failures = sign_off([dict(comparison, recall=0.5, weight_error=0.1)])
+        self.assertFalse(passed)
+        self.assertEqual(failures, ['s round 2: recall = 0.5, limit 0.99', 's round 2: weight_error = 0.1, limit 0.05'])
+
+
+if __name__ == '__main__':
+    unittest.main()
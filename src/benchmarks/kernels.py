@@ -0,0 +1,291 @@
+"""Microbenchmarks of the algorithm kernels on synthetic search sets.
+
+Times Ticket.compute_similarities, compute_scores and select_clips_to_review, Hyperparameter.optimize_weights and
+each TargetClip bootstrap type, and reports the wall time, throughput and peak memory of each.  Every result is
+appended as one JSON line to the output file, with the commit and library versions, so runs can be compared over
+time.  Run from src/, e.g.
+
+    python -m benchmarks.kernels --sizes 1000,10000,100000,1000000 --output benchmark_results.jsonl
+    python -m benchmarks.kernels --sizes 10000 --baseline benchmark_results.jsonl
+
+compute_similarities holds the whole search set as lists of floats, as the broker does, so it is skipped for sizes
+whose features would exceed --max-memory-mb.  The other kernels only need the similarities, which are computed for
+every size a chunk of clips at a time.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+
+os.environ.setdefault("COMPUTE_EPS", "0.000003")  # read by models.hyperparameter on import
+
+from benchmarks.synthetic import SPLITS, STREAMS, FeatureStatistics, SyntheticSearchSet  # noqa: E402
+from models import Hyperparameter, TargetClip, Ticket  # noqa: E402
+
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000)
+DEFAULT_REPEATS = 3
+DEFAULT_LABELED = 20
+# bytes per feature value held by compute_similarities, see services.memory
+BYTES_PER_FEATURE_VALUE = 32
+BOOTSTRAP_TYPES = ('simple', 'partial_update', 'bagging')
+SCORE_KERNELS = ('compute_scores', 'select_clips_to_review', 'optimize_weights')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the algorithm kernels on synthetic search sets')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help='comma separated numbers of clips in the search sets')
+    parser.add_argument('--kernels', default=None, help='comma separated kernels to run, default all')
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS)
+    parser.add_argument('--labeled', type=int, default=DEFAULT_LABELED,
+                        help='number of labeled clips for optimize_weights and the bootstrap types')
+    parser.add_argument('--max-memory-mb', type=int, default=4096,
+                        help='largest estimated feature memory for compute_similarities')
+    parser.add_argument('--features-dir', default=None, help='real features to take the statistics from')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.jsonl', help='JSON lines file the results are added to')
+    parser.add_argument('--baseline', default=None, help='JSON lines file of earlier results to compare with')
+    args = parser.parse_args()
+
+    if args.features_dir:
+        feature_statistics = FeatureStatistics.from_directory(args.features_dir)
+    else:
+        feature_statistics = FeatureStatistics.from_directory()
+    kernels = args.kernels.split(',') if args.kernels else None
+    run_info = environment()
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        search_set = SyntheticSearchSet(feature_statistics, size, seed=args.seed)
+        results += benchmark_search_set(search_set, args, kernels)
+    if kernels is None or any(kernel.startswith('bootstrap') for kernel in kernels):
+        search_set = SyntheticSearchSet(feature_statistics, max(10 * args.labeled, 1000), seed=args.seed)
+        results += benchmark_bootstrap(search_set, args, kernels)
+
+    with open(args.output, 'a') as f:
+        for result in results:
+            f.write(json.dumps(dict(run_info, **result), sort_keys=True) + '\n')
+    print_results(results, load_results(args.baseline) if args.baseline else None)
+
+
+def benchmark_search_set(search_set, args, kernels=None):
+    results = []
+    hyperparameters = benchmark_hyperparameters()
+    target = search_set.clip_features(search_set.ref_clip_id)
+    target = {stream: {split: scaled(feature) for split, feature in splits.items()}
+              for stream, splits in target.items()}
+    ticket = benchmark_ticket(search_set.ref_clip_id, target)
+
+    if selected(kernels, 'compute_similarities'):
+        needed = search_set.nclips * len(STREAMS) * len(SPLITS) * search_set.statistics.dimension * \
+            BYTES_PER_FEATURE_VALUE
+        if needed > args.max_memory_mb * 2 ** 20:
+            results.append(skipped('compute_similarities', search_set.nclips,
+                                   'features need about {} MB'.format(needed // 2 ** 20)))
+        else:
+            candidates = search_set.candidates()
+            ticket._get_candidate_features = lambda splits, hyperparameters: candidates
+            results.append(measure('compute_similarities', search_set.nclips, search_set.nclips, args.repeats,
+                                   lambda: ticket.compute_similarities(hyperparameters)))
+            del candidates, ticket._get_candidate_features
+
+    if not any(selected(kernels, kernel) for kernel in SCORE_KERNELS):
+        return results
+    ticket.similarities = fast_similarities(search_set, target)
+    weights = hyperparameters.default_weights
+    if selected(kernels, 'compute_scores'):
+        results.append(measure('compute_scores', search_set.nclips, search_set.nclips, args.repeats,
+                               lambda: ticket.compute_scores(weights)))
+    ticket.compute_scores(weights)
+    if selected(kernels, 'select_clips_to_review'):
+        def select():
+            random.seed(args.seed)
+            ticket.select_clips_to_review(hyperparameters.default_threshold, 20, hyperparameters.near_miss_default)
+        results.append(measure('select_clips_to_review', search_set.nclips, search_set.nclips, args.repeats, select))
+    if selected(kernels, 'optimize_weights'):
+        ticket.matches = labeled_matches(search_set, args.labeled)
+        results.append(measure('optimize_weights', search_set.nclips, search_set.nclips, args.repeats,
+                               lambda: hyperparameters.copy().optimize_weights(ticket), labeled=len(ticket.matches)))
+    return results
+
+
+def benchmark_bootstrap(search_set, args, kernels=None):
+    # the bootstrap types depend on the number of labeled clips, not on the size of the search set
+    results = []
+    match_ids = search_set.match_clip_ids()[:args.labeled]
+    rng = np.random.RandomState(args.seed)
+    invalid_ids = rng.choice(np.setdiff1d(np.arange(2, search_set.nclips + 1), match_ids), args.labeled,
+                             replace=False)
+    valid = [search_set.clip_features(int(clip_id)) for clip_id in match_ids]
+    invalid = [search_set.clip_features(int(clip_id)) for clip_id in invalid_ids]
+    reference = search_set.clip_features(search_set.ref_clip_id)
+    for bootstrap_type in BOOTSTRAP_TYPES:
+        kernel = 'bootstrap_' + bootstrap_type
+        if not selected(kernels, kernel):
+            continue
+        hyperparameters = benchmark_hyperparameters(bootstrap_type)
+        target = benchmark_target(hyperparameters, reference)
+
+        def bootstrap():
+            random.seed(args.seed)
+            if bootstrap_type == 'bagging':
+                target.target_by_bagging(valid, invalid, set(SPLITS))
+            else:
+                target.target_features = target.dynamic_target_adjustment(valid, invalid, set(SPLITS),
+                                                                          hyperparameters.f_bootstrap)
+                if bootstrap_type == 'partial_update':
+                    target.avg_new_old_targets(set(SPLITS))
+        results.append(measure(kernel, search_set.nclips, len(valid) + len(invalid), args.repeats, bootstrap,
+                               labeled=len(valid) + len(invalid)))
+    return results
+
+
+def measure(kernel, size, items, repeats, run, labeled=None):
+    """
+    :param items: number of items processed by one run, for the throughput
+    :return: result record.  The runs are timed without tracing, then run once more under tracemalloc for the
+             peak memory, since tracing slows allocation.
+    """
+    seconds = []
+    for __ in range(repeats):
+        start = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    result = {
+        "kernel": kernel,
+        "size": size,
+        "repeats": repeats,
+        "seconds_min": min(seconds),
+        "seconds_median": statistics.median(seconds),
+        "throughput": items / min(seconds) if min(seconds) > 0 else None,
+        "peak_bytes": peak,
+    }
+    if labeled is not None:
+        result["labeled"] = labeled
+    return result
+
+
+def skipped(kernel, size, reason):
+    return {"kernel": kernel, "size": size, "skipped": reason}
+
+
+def selected(kernels, kernel):
+    return kernels is None or kernel in kernels
+
+
+def benchmark_hyperparameters(bootstrap_type='bagging'):
+    # the broker's defaults, see broker.py
+    return Hyperparameter({'rgb': 1.0, 'warped_optical_flow': 1.5}, default_threshold=0.8, ballast=0.0,
+                          near_miss_default=0.35, mu=0.0, streams=STREAMS, feature_name='global_pool',
+                          f_bootstrap=1, f_memory=0.7, bootstrap_type=bootstrap_type, nbags=3)
+
+
+def benchmark_ticket(ref_clip_id, target_features):
+    # a Ticket with the state compute_similarities and the later kernels use, without an API
+    ticket = Ticket.__new__(Ticket)
+    ticket.query_id = 0
+    ticket.search_set = 0
+    ticket.ref_clip_id = ref_clip_id
+    ticket.user_matches = {}
+    ticket.matches = {}
+    ticket.similarities = {}
+    ticket.candidate_stats = {}
+    ticket.scores = {}
+    ticket.target = type('BenchmarkTarget', (), {})()
+    ticket.target.splits = set(SPLITS)
+    ticket.target.target_features = target_features
+    return ticket
+
+
+def benchmark_target(hyperparameters, reference_features):
+    # a TargetClip with the state the bootstrap methods use, without an API
+    target = TargetClip.__new__(TargetClip)
+    target.hyperparameters = hyperparameters
+    target.ref_clip_features = reference_features
+    target.splits = set(SPLITS)
+    target.previous_target_features = target.scaled_ref_clip_features()
+    target.target_features = {}
+    return target
+
+
+def fast_similarities(search_set, target_features):
+    # same result as Ticket.compute_similarities, computed with numpy a chunk of clips at a time
+    similarities = {}
+    for clip_ids, features in search_set.features():
+        stream_similarities = {}
+        for stream in STREAMS:
+            splits = target_features[stream]
+            split_similarities = [features[stream][split] @ np.asarray(splits[split]) for split in splits]
+            stream_similarities[stream] = np.mean(split_similarities, axis=0).tolist()
+        nsplits = len(SPLITS)
+        for k, clip_id in enumerate(clip_ids.tolist()):
+            similarities[clip_id] = {stream: [stream_similarities[stream][k], nsplits] for stream in STREAMS}
+    return similarities
+
+
+def labeled_matches(search_set, nlabeled):
+    # matches of the previous round, as in a revise update: half user-confirmed matches, half rejected clips
+    match_ids = search_set.match_clip_ids()[:nlabeled // 2].tolist()
+    others = [clip_id for clip_id in range(2, search_set.nclips + 1) if clip_id not in set(match_ids)]
+    rejected = random.Random(search_set.seed).sample(others, min(nlabeled - len(match_ids), len(others)))
+    return [{"video_clip": clip_id, "user_match": True, "is_match": True} for clip_id in match_ids] + \
+        [{"video_clip": clip_id, "user_match": False, "is_match": True} for clip_id in rejected]
+
+
+def scaled(feature):
+    feature = np.asarray(feature)
+    return (feature / np.dot(feature, feature)).tolist()
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": time.time(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "host": platform.node(),
+    }
+
+
+def load_results(path):
+    # latest result for each (kernel, size) in a JSON lines file of earlier results
+    latest = {}
+    with open(path, 'r') as f:
+        for line in f:
+            result = json.loads(line)
+            if "seconds_min" in result:
+                latest[result["kernel"], result["size"]] = result
+    return latest
+
+
+def print_results(results, baseline=None):
+    print('{:<26} {:>9} {:>12} {:>14} {:>12} {:>10}'.format('kernel', 'size', 'seconds', 'items/s', 'peak MB',
+                                                            'vs base'))
+    for result in results:
+        if "skipped" in result:
+            print('{:<26} {:>9}   skipped: {}'.format(result["kernel"], result["size"], result["skipped"]))
+            continue
+        ratio = ''
+        if baseline and (result["kernel"], result["size"]) in baseline:
+            ratio = '{:.2f}x'.format(baseline[result["kernel"], result["size"]]["seconds_min"] / result["seconds_min"])
+        print('{:<26} {:>9} {:>12.4f} {:>14.0f} {:>12.1f} {:>10}'.format(
+            result["kernel"], result["size"], result["seconds_min"], result["throughput"] or 0,
+            result["peak_bytes"] / 2 ** 20, ratio))
+
+
+if __name__ == '__main__':
+    main()
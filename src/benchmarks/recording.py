@@ -0,0 +1,226 @@
+"""Record the requests of real Video Query API sessions, and replay them without the API.
+
+RecordingProxy forwards every request to the API and appends the exchange to a JSON lines file.  Point the broker at
+the proxy instead of the API, e.g. with API_BASE_URL.  ReplayServer answers the same requests from the file, with the
+recorded latencies, scaled, or a fixed latency per request, so a recorded session can be run again offline.
+
+A request is matched to a recording by its method, path, query string and JSON body; the n-th identical request gets
+the n-th recorded response, so polls of the query-state lists replay the states the API went through.  Urls of the API
+in responses, e.g. in the schema, are recorded as {base_url} and replaced by the url of the proxy or replay server.
+
+    python -m benchmarks.recording record http://127.0.0.1:8000/ session.jsonl --port 8001
+    python -m benchmarks.recording replay session.jsonl --port 8001 --latency-scale 0.5
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import base64
+import json
+import logging
+import threading
+import time
+import requests
+
+BASE_URL_PLACEHOLDER = '{base_url}'
+# request headers passed on to the API; hop-by-hop headers are left to each connection
+FORWARDED_HEADERS = ('Accept', 'Authorization', 'Content-Type')
+
+
+class RecordingProxy:
+    def __init__(self, upstream_url, path, host='127.0.0.1', port=0):
+        """
+        :param upstream_url: url of the Video Query API, e.g. http://127.0.0.1:8000/
+        :param path: JSON lines file the exchanges are appended to
+        :param port: port to listen on, 0 for any free port
+        """
+        self.upstream_url = upstream_url.rstrip('/') + '/'
+        self.path = path
+        self.nrecorded = 0
+        self._http = requests.Session()
+        self._file_lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _handler_class(self._exchange))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(self._server.server_address[0], self.port)
+
+    def start(self):
+        self._thread.start()
+        logging.info('Recording requests to {} at {} in {}'.format(self.upstream_url, self.url, self.path))
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _exchange(self, method, path, headers, body, base_url):
+        start = time.time()
+        response = self._http.request(method, self.upstream_url + path.lstrip('/'), data=body,
+                                      headers={name: headers[name] for name in FORWARDED_HEADERS if name in headers})
+        latency = time.time() - start
+        content = response.content.replace(self.upstream_url.encode('utf-8'), BASE_URL_PLACEHOLDER.encode('utf-8'))
+        record = {
+            "method": method,
+            "path": path,
+            "key": request_key(method, path, headers.get('Content-Type'), body),
+            "status": response.status_code,
+            "content_type": response.headers.get('Content-Type'),
+            "body": base64.b64encode(content).decode('ascii'),
+            "latency": latency,
+            "time": start,
+        }
+        with self._file_lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            self.nrecorded += 1
+        return response.status_code, response.headers.get('Content-Type'), _with_base_url(content, base_url)
+
+
+class ReplayServer:
+    def __init__(self, path, host='127.0.0.1', port=0, latency=None, latency_scale=1.0):
+        """
+        :param path: JSON lines file written by RecordingProxy
+        :param latency: seconds to wait before every response.  None waits the recorded latency times latency_scale.
+        :param latency_scale: factor applied to the recorded latencies, e.g. 0 to replay as fast as possible
+        """
+        self.latency = latency
+        self.latency_scale = latency_scale
+        self.recordings = {}  # request key: list of recorded responses, in the order they were recorded
+        with open(path, 'r') as f:
+            for line in f:
+                record = json.loads(line)
+                self.recordings.setdefault(record["key"], []).append(record)
+        self.replayed = {}  # request key: number of requests answered
+        self.unmatched = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _handler_class(self._exchange))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(self._server.server_address[0], self.port)
+
+    def start(self):
+        self._thread.start()
+        logging.info('Replaying {} recorded requests at {}'.format(sum(map(len, self.recordings.values())), self.url))
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _exchange(self, method, path, headers, body, base_url):
+        key = request_key(method, path, headers.get('Content-Type'), body)
+        with self._lock:
+            recorded = self.recordings.get(key)
+            if not recorded:
+                self.unmatched += 1
+                logging.warning('No recorded response for {} {}'.format(method, path))
+                return 404, 'application/json', b'{"detail": "Not recorded."}'
+            n = self.replayed.get(key, 0)
+            self.replayed[key] = n + 1
+        # requests made more often than recorded get the last recorded response
+        record = recorded[min(n, len(recorded) - 1)]
+        time.sleep(self.latency if self.latency is not None else record["latency"] * self.latency_scale)
+        return record["status"], record["content_type"], _with_base_url(base64.b64decode(record["body"]), base_url)
+
+
+def request_key(method, path, content_type, body):
+    """
+    Key matching a replayed request to recorded ones.  JSON bodies are compared by content.  Multipart bodies,
+    e.g. final reports, and form bodies, e.g. credentials, differ between runs and are left out.
+    """
+    key = '{} {}'.format(method, path)
+    if body and (content_type or '').startswith('application/json'):
+        key += ' ' + json.dumps(json.loads(body.decode('utf-8')), sort_keys=True)
+    return key
+
+
+def _with_base_url(content, base_url):
+    return content.replace(BASE_URL_PLACEHOLDER.encode('utf-8'), base_url.encode('utf-8'))
+
+
+def _handler_class(exchange):
+    """
+    :param exchange: function (method, path, headers, body, base url of the server as the client sees it)
+                     returning (status, content type, body)
+    """
+
+    class ExchangeHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self._handle('GET')
+
+        def do_POST(self):
+            self._handle('POST')
+
+        def do_PATCH(self):
+            self._handle('PATCH')
+
+        def do_PUT(self):
+            self._handle('PUT')
+
+        def do_DELETE(self):
+            self._handle('DELETE')
+
+        def _handle(self, method):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            base_url = 'http://{}/'.format(self.headers.get('Host'))
+            try:
+                status, content_type, content = exchange(method, self.path, self.headers, body, base_url)
+            except requests.RequestException as e:
+                status, content_type, content = 502, 'application/json', json.dumps({"detail": str(e)}).encode()
+            self.send_response(status)
+            if content_type:
+                self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ExchangeHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record Video Query API sessions, or replay recorded sessions')
+    subparsers = parser.add_subparsers(dest='command')
+    record = subparsers.add_parser('record', help='forward requests to the API and record them')
+    record.add_argument('upstream_url', help='url of the Video Query API')
+    record.add_argument('path', help='JSON lines file the requests are added to')
+    replay = subparsers.add_parser('replay', help='answer requests from a recording')
+    replay.add_argument('path', help='JSON lines file written by record')
+    replay.add_argument('--latency', type=float, default=None, help='seconds per response, instead of the recorded')
+    replay.add_argument('--latency-scale', type=float, default=1.0, help='factor applied to the recorded latencies')
+    for subparser in (record, replay):
+        subparser.add_argument('--host', default='127.0.0.1')
+        subparser.add_argument('--port', type=int, default=8001)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'record':
+        server = RecordingProxy(args.upstream_url, args.path, args.host, args.port)
+    elif args.command == 'replay':
+        server = ReplayServer(args.path, args.host, args.port, args.latency, args.latency_scale)
+    else:
+        parser.error('choose record or replay')
+    server.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
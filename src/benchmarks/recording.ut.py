@@ -0,0 +1,57 @@
+import os
+import tempfile
+import unittest
+import requests
+from api_standin import StandinServer, StandinStore
+from recording import RecordingProxy, ReplayServer
+
+
+class RecordingTest(unittest.TestCase):
+    """Tests for recording.py."""
+
+    def setUp(self):
+        self.store = StandinStore()
+        self.store.create("videos", {"name": "a", "path": "a"})
+        self.api = StandinServer(self.store)
+        self.api.start()
+        self.path = os.path.join(tempfile.mkdtemp(), 'session.jsonl')
+        self.proxy = RecordingProxy(self.api.url, self.path)
+        self.proxy.start()
+
+    def tearDown(self):
+        self.proxy.stop()
+        self.api.stop()
+
+    def _session(self, url):
+        http = requests.Session()
+        token = http.post(url + 'api-token-auth/', data={"username": "u", "password": "p"}).json()["token"]
+        http.headers["Authorization"] = 'Token ' + token
+        return http
+
+    def test_replay(self):
+        http = self._session(self.proxy.url)
+        first = http.get(self.proxy.url + 'videos/').json()
+        http.post(self.proxy.url + 'videos/', json={"name": "b", "path": "b"})
+        second = http.get(self.proxy.url + 'videos/').json()
+        schema = http.get(self.proxy.url + 'docs/').text
+        self.assertIn(self.proxy.url, schema)
+        self.assertNotIn(self.api.url, schema)
+        self.assertEqual(self.proxy.nrecorded, 5)
+
+        replay = ReplayServer(self.path, latency_scale=0)
+        replay.start()
+        try:
+            http = self._session(replay.url)
+            # identical requests replay the recorded responses in order
+            self.assertEqual(http.get(replay.url + 'videos/').json(), first)
+            self.assertEqual(http.post(replay.url + 'videos/', json={"path": "b", "name": "b"}).status_code, 201)
+            self.assertEqual(http.get(replay.url + 'videos/').json(), second)
+            self.assertIn(replay.url, http.get(replay.url + 'docs/').text)
+            self.assertEqual(http.get(replay.url + 'queries/').status_code, 404)
+            self.assertEqual(replay.unmatched, 1)
+        finally:
+            replay.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
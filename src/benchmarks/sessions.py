@@ -0,0 +1,257 @@
+"""End-to-end benchmark of whole query sessions: new round, review rounds and finalize, as the broker runs them.
+
+By default the API is a benchmarks.api_standin server seeded from data/features, or from a synthetic search set with
+--synthetic-clips, and a simulated user reviews each processed round: matches scoring at least --oracle-threshold, or
+the synthetic matches, are marked as user matches, and the query is sent back for revision until --rounds rounds are
+done, then finalized.  With --api-url the broker loop runs against another API instead, e.g. a
+benchmarks.recording.ReplayServer, until it has been idle for --idle seconds.
+
+Reports the latency of each round (from entering a query-state list until processed), the processing time of each
+ticket, API requests per action and per round, and rounds per second.  Results are appended as a JSON line to
+--output.  Run from src/, e.g.
+
+    python -m benchmarks.sessions --queries 8 --workers 4 --rounds 3 --latency 0.005
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from datetime import timedelta
+
+# settings read when the API and models modules are imported
+os.environ.setdefault("COMPUTE_EPS", "0.000003")
+os.environ.setdefault("API_CLIENT_USERNAME", "benchmark")
+os.environ.setdefault("API_CLIENT_PASSWORD", "benchmark")
+# the stand-in listens on a new port each run; keep its schemas out of the shared schema cache
+os.environ.setdefault("API_SCHEMA_CACHE_DIR", tempfile.mkdtemp(prefix='api_schema_'))
+
+from api.api_repository import APIRepository  # noqa: E402
+from api.session import get_session  # noqa: E402
+from benchmarks.api_standin import ERROR, FINALIZE, FINALIZED, PROCESSED, REVISE, StandinServer, \
+    StandinStore  # noqa: E402
+from benchmarks.kernels import benchmark_hyperparameters, environment  # noqa: E402
+from benchmarks.synthetic import DEFAULT_FEATURES_DIR, FeatureStatistics, SyntheticSearchSet  # noqa: E402
+from models.compute_matches import process_update  # noqa: E402
+from services import TicketWorkerPool  # noqa: E402
+
+POLL_INTERVAL = 0.05  # In seconds, wait between polls of the broker loop and of the simulated user
+
+
+class SimulatedUser:
+    def __init__(self, store, rounds, oracle_threshold=0.8, true_matches=None, think_time=0.0):
+        """
+        Reviews the processed rounds of every query in store, on its own thread.
+        :param rounds: number of rounds, new and revised, before the query is finalized
+        :param oracle_threshold: score from which a match is marked as a user match, if true_matches is None
+        :param true_matches: optional set of video clip ids that are the true matches
+        :param think_time: seconds the user takes to review a round
+        """
+        self.store = store
+        self.rounds = rounds
+        self.oracle_threshold = oracle_threshold
+        self.true_matches = true_matches
+        self.think_time = think_time
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._review_loop, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def review(self, query_id):
+        results = self.store.list("query-results", {"query": query_id}, page_size=2 ** 31)["results"]
+        latest = max(results, key=lambda result: result["round"])
+        for match in self.store.matches(latest["id"]):
+            if self.true_matches is not None:
+                user_match = match["video_clip"] in self.true_matches
+            else:
+                user_match = match["score"] >= self.oracle_threshold
+            self.store.partial_update("matches", match["id"], {"user_match": user_match})
+        next_state = FINALIZE if latest["round"] >= self.rounds else REVISE
+        self.store.partial_update("queries", query_id, {"process_state": next_state})
+
+    def _review_loop(self):
+        while not self._stopping.is_set():
+            for query_id in self.store.queries_in_state(PROCESSED):
+                if self.think_time:
+                    time.sleep(self.think_time)
+                self.review(query_id)
+            self._stopping.wait(POLL_INTERVAL)
+
+
+def run_broker(api_url, nworkers, finished, idle=None, timeout=600.0, random_seed=None):
+    """
+    Claim and process query rounds as broker.poll does, until finished() is true, or until nothing was claimed or
+    running for idle seconds.  random_seed seeds each ticket's random numbers, as the broker's RANDOM_SEED does.
+    :return: list of (update_type, seconds from claim to end of processing, summary or None if the ticket failed)
+    """
+    repository = APIRepository(api_url)
+    hyperparameters = benchmark_hyperparameters()
+    pool = TicketWorkerPool(nworkers, 'thread')
+    tickets = []
+    tickets_lock = threading.Lock()
+    deadline = time.time() + timeout
+    last_busy = time.time()
+
+    def done(update_type, claimed, summary):
+        with tickets_lock:
+            tickets.append((update_type, time.time() - claimed, summary))
+
+    while not finished() and time.time() < deadline:
+        available = pool.available()
+        if available:
+            for update_type, update_object in repository.claim_pending(available):
+                pool.submit(process_update, update_type, update_object, api_url, hyperparameters.copy(), None,
+                            random_seed,
+                            callback=lambda summary, update_type=update_type, claimed=time.time():
+                            done(update_type, claimed, summary))
+                last_busy = time.time()
+        if pool.available() < nworkers:
+            last_busy = time.time()
+        if idle is not None and time.time() - last_busy > idle:
+            break
+        time.sleep(POLL_INTERVAL)
+    pool.shutdown(wait=True)
+    return tickets
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of query sessions')
+    parser.add_argument('--queries', type=int, default=4, help='number of query sessions run at the same time')
+    parser.add_argument('--rounds', type=int, default=3, help='rounds of each query before it is finalized')
+    parser.add_argument('--workers', type=int, default=4, help='tickets processed at the same time')
+    parser.add_argument('--features-dir', default=DEFAULT_FEATURES_DIR, help='feature files seeding the stand-in')
+    parser.add_argument('--synthetic-clips', type=int, default=None,
+                        help='seed the stand-in with a synthetic search set of this many clips instead')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the stand-in adds to every response')
+    parser.add_argument('--think-time', type=float, default=0.0, help='seconds the simulated user takes per review')
+    parser.add_argument('--oracle-threshold', type=float, default=0.8)
+    parser.add_argument('--api-url', default=None, help='run against this API instead of a stand-in')
+    parser.add_argument('--idle', type=float, default=10.0, help='with --api-url, stop after this many idle seconds')
+    parser.add_argument('--timeout', type=float, default=600.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='session_results.jsonl', help='JSON lines file the results are added to')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    start = time.time()
+    if args.api_url:
+        tickets = run_broker(args.api_url, args.workers, lambda: False, idle=args.idle, timeout=args.timeout,
+                             random_seed=args.seed)
+        wall_time = time.time() - start
+        rounds = []
+        request_counts = {name: stats["count"] for name, stats in get_session(args.api_url).telemetry.snapshot()
+                          .items()}
+    else:
+        store, server, user, query_ids = standin_sessions(args)
+        server.start()
+        user.start()
+
+        def finished():
+            return len(store.queries_in_state(FINALIZED)) + len(store.queries_in_state(ERROR)) == len(query_ids)
+
+        start = time.time()
+        tickets = run_broker(server.url, args.workers, finished, timeout=args.timeout, random_seed=args.seed)
+        wall_time = time.time() - start
+        user.stop()
+        server.stop()
+        rounds = store.round_latencies()
+        request_counts = dict(server.request_counts)
+
+    result = session_report(args, tickets, rounds, request_counts, wall_time)
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(dict(environment(), **result), sort_keys=True) + '\n')
+    print_report(result)
+
+
+def standin_sessions(args):
+    # stand-in store and server with args.queries new queries, and the simulated user reviewing them
+    store = StandinStore()
+    true_matches = None
+    if args.synthetic_clips:
+        search_set = SyntheticSearchSet(FeatureStatistics.from_directory(args.features_dir), args.synthetic_clips,
+                                        seed=args.seed)
+        video, search_set_id, clip_ids = store.seed_synthetic(search_set)
+        true_matches = {clip_ids[int(clip_id)] for clip_id in search_set.match_clip_ids()}
+        true_matches.add(clip_ids[search_set.ref_clip_id])
+        # the synthetic reference clip is clip 0 of the video
+        references = [(video, 0)] * args.queries
+    else:
+        search_set_id = store.seed_from_directory(args.features_dir)["all"]
+        clips = store.list("video-clips", page_size=2 ** 31)["results"]
+        references = [(clip["video"], clip["clip"] * clip["duration"]) for clip in random.sample(clips, args.queries)]
+    query_ids = []
+    for k, (video, seconds) in enumerate(references):
+        query = store.create_query('benchmark_{}'.format(k), video, str(timedelta(seconds=seconds)), search_set_id)
+        query_ids.append(query["id"])
+    server = StandinServer(store, latency=args.latency)
+    user = SimulatedUser(store, args.rounds, args.oracle_threshold, true_matches, args.think_time)
+    return store, server, user, query_ids
+
+
+def session_report(args, tickets, rounds, request_counts, wall_time):
+    by_type = {}
+    for update_type, seconds, summary in tickets:
+        by_type.setdefault(update_type, []).append(seconds)
+    latency_by_type = {}
+    for round_ in rounds:
+        latency_by_type.setdefault(round_["update_type"], []).append(round_["latency"])
+    nrequests = sum(request_counts.values())
+    return {
+        "benchmark": "sessions",
+        "queries": args.queries,
+        "rounds_per_query": args.rounds,
+        "workers": args.workers,
+        "latency": args.latency,
+        "api_url": args.api_url,
+        "synthetic_clips": args.synthetic_clips,
+        "wall_time": wall_time,
+        "tickets": len(tickets),
+        "failed_tickets": sum(1 for __, __, summary in tickets if summary is None),
+        "rounds_per_second": len(tickets) / wall_time if wall_time else None,
+        "ticket_seconds": {update_type: describe(seconds) for update_type, seconds in by_type.items()},
+        "round_latency": {update_type: describe(latencies) for update_type, latencies in latency_by_type.items()},
+        "requests": nrequests,
+        "requests_per_round": nrequests / len(tickets) if tickets else None,
+        "request_counts": request_counts,
+    }
+
+
+def describe(values):
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "mean": statistics.mean(values),
+        "median": statistics.median(values),
+        "p95": values[min(int(0.95 * len(values)), len(values) - 1)],
+        "max": values[-1],
+    }
+
+
+def print_report(result):
+    print('{} tickets ({} failed) in {:.2f} s, {:.2f} rounds/s, {} API requests ({:.1f} per round)'.format(
+        result["tickets"], result["failed_tickets"], result["wall_time"], result["rounds_per_second"] or 0,
+        result["requests"], result["requests_per_round"] or 0))
+    print('{:<10} {:>8} {:>14} {:>14} {:>14}'.format('round', 'count', 'latency p50', 'latency p95', 'ticket p50'))
+    for update_type in ('new', 'revise', 'finalize'):
+        latency = result["round_latency"].get(update_type)
+        ticket = result["ticket_seconds"].get(update_type)
+        if latency is None and ticket is None:
+            continue
+        print('{:<10} {:>8} {:>14} {:>14} {:>14}'.format(
+            update_type, (ticket or latency)["count"],
+            '{:.3f}'.format(latency["median"]) if latency else '-', '{:.3f}'.format(latency["p95"]) if latency else '-',
+            '{:.3f}'.format(ticket["median"]) if ticket else '-'))
+    for name, count in sorted(result["request_counts"].items(), key=lambda item: -item[1]):
+        print('  {:<40} {:>8}'.format(name, count))
+
+
+if __name__ == '__main__':
+    main()
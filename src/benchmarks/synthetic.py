@@ -0,0 +1,205 @@
+"""Synthetic search sets whose features follow the statistics of the real global_pool features in data/features.
+
+The real features are non-negative and heavy tailed, with a small fraction of exact zeros.  The features of one clip
+are correlated across splits, since every split's network sees the same video, and each clip has an overall
+activation scale.  The generator reproduces these with a Gaussian copula, per stream and dimension d:
+
+    z[clip, split, d] = rho * l[clip, d] + sqrt(1 - rho^2) * e[clip, split, d]
+    x[clip, split, d] = exp(s[clip]) * Q_d(Phi(z[clip, split, d]))
+
+where l, e and s are normal, Phi is the normal distribution function and Q_d is the empirical quantile function of
+dimension d of the real features.  A fraction of the clips are noisy copies of the reference clip, so a search set
+has matches and near misses to select from, as a real one does.
+"""
+import csv
+import glob
+import os
+import numpy as np
+from scipy.special import ndtr, ndtri
+
+STREAMS = ('rgb', 'warped_optical_flow')
+SPLITS = (1, 2, 3)
+FEATURE_NAME = 'global_pool'
+FEATURE_DIMENSION = 1024
+DEFAULT_FEATURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'features')
+# number of points of the quantile functions
+NQUANTILES = 101
+# used when no feature files are found: log-normal features close to the statistics of data/features
+DEFAULT_LOG_MEAN = {'rgb': 0.1, 'warped_optical_flow': -0.9}
+DEFAULT_LOG_STD = 0.8
+DEFAULT_SPLIT_CORRELATION = 0.7
+DEFAULT_SCALE_STD = 0.15
+# clips generated together; a clip's features only depend on the seed and its id
+CHUNK_SIZE = 4096
+# correlation of the latent features of a match with those of the reference clip
+MATCH_CORRELATION = 0.97
+
+
+class FeatureStatistics:
+    def __init__(self, quantiles, split_correlation=DEFAULT_SPLIT_CORRELATION, scale_std=DEFAULT_SCALE_STD):
+        """
+        :param quantiles: { <stream>: array of shape (NQUANTILES, dimension), the feature values at probabilities
+                          0, 1/(NQUANTILES-1), ..., 1 in each dimension }
+        :param split_correlation: correlation of the features of one clip between splits, on the normal scale
+        :param scale_std: standard deviation of the log of a clip's overall activation scale
+        """
+        self.quantiles = quantiles
+        self.split_correlation = split_correlation
+        self.scale_std = scale_std
+
+    @classmethod
+    def default(cls, dimension=FEATURE_DIMENSION):
+        probabilities = np.clip(np.linspace(0, 1, NQUANTILES), 0.001, 0.999).reshape(-1, 1)
+        # the typical activation differs between dimensions
+        offsets = np.random.RandomState(0).standard_normal((1, dimension))
+        quantiles = {}
+        for stream in STREAMS:
+            quantiles[stream] = np.exp(DEFAULT_LOG_MEAN[stream] + offsets + DEFAULT_LOG_STD * ndtri(probabilities))
+        return cls(quantiles)
+
+    @classmethod
+    def from_directory(cls, features_dir=DEFAULT_FEATURES_DIR):
+        """
+        Estimate the statistics from feature files laid out as for load_db.py:
+        <features_dir>/<source>/<video>/<split>/<stream>_<feature name>_features.csv
+        Falls back to FeatureStatistics.default() if there are no files.
+        """
+        quantiles = {}
+        correlations, scales = [], []
+        for stream in STREAMS:
+            by_video = {}
+            pattern = os.path.join(features_dir, '*', '*', '*', '{}_{}_features.csv'.format(stream, FEATURE_NAME))
+            for path in sorted(glob.glob(pattern)):
+                video = os.path.dirname(os.path.dirname(path))
+                by_video.setdefault(video, []).append(_read_features(path))
+            if not by_video:
+                return cls.default()
+            features = np.concatenate([f for split_features in by_video.values() for f in split_features])
+            quantiles[stream] = np.quantile(features, np.linspace(0, 1, NQUANTILES), axis=0)
+            scales.append(np.std(np.log(np.mean(features, axis=1))))
+            for split_features in by_video.values():
+                correlations += _split_correlations(split_features)
+        split_correlation = float(np.mean(correlations)) if correlations else DEFAULT_SPLIT_CORRELATION
+        return cls(quantiles, split_correlation, float(np.mean(scales)))
+
+    @property
+    def dimension(self):
+        return self.quantiles[STREAMS[0]].shape[1]
+
+    def inverse_cdf(self, stream, probabilities):
+        # feature values at probabilities, an array of shape (nclips, dimension), by linear interpolation
+        position = probabilities * (NQUANTILES - 1)
+        lower = np.minimum(position.astype(int), NQUANTILES - 2)
+        fraction = position - lower
+        columns = np.arange(self.dimension)
+        quantiles = self.quantiles[stream]
+        return quantiles[lower, columns] * (1 - fraction) + quantiles[lower + 1, columns] * fraction
+
+
+class SyntheticSearchSet:
+    def __init__(self, statistics, nclips, match_fraction=0.02, seed=0):
+        """
+        :param statistics: FeatureStatistics of the features
+        :param nclips: number of clips in the search set.  Clip ids are 1 to nclips, and clip 1 is the reference.
+        :param match_fraction: fraction of the clips that are noisy copies of the reference clip
+        :param seed: seed of the generator, so a search set can be generated again identically
+        """
+        self.statistics = statistics
+        self.nclips = nclips
+        self.match_fraction = match_fraction
+        self.seed = seed
+        self.ref_clip_id = 1
+        self._matches = None
+        self._reference = {}  # stream: (z of each split, log scale) of the reference clip
+
+    def features(self):
+        """
+        Generate the features a chunk of clips at a time, so search sets larger than memory can be streamed.
+        :return: iterator of (array of clip ids, { <stream>: {<split>: array of shape (len(clip ids), dimension)} })
+        """
+        for chunk in range((self.nclips + CHUNK_SIZE - 1) // CHUNK_SIZE):
+            clip_ids = np.arange(chunk * CHUNK_SIZE + 1, min((chunk + 1) * CHUNK_SIZE, self.nclips) + 1)
+            features = {stream: self._chunk_features(stream, chunk) for stream in STREAMS}
+            yield clip_ids, {stream: {split: features[stream][split][:len(clip_ids)] for split in SPLITS}
+                             for stream in STREAMS}
+
+    def candidates(self, splits=SPLITS):
+        """
+        :return: candidate features as returned by Ticket._get_candidate_features,
+                 { <stream type>: {<split #>: { clip#: [<candidate feature>], ...} } }
+        """
+        candidates = {stream: {split: {} for split in splits} for stream in STREAMS}
+        for clip_ids, features in self.features():
+            for stream in STREAMS:
+                for split in splits:
+                    candidates[stream][split].update(zip(clip_ids.tolist(), features[stream][split].tolist()))
+        return candidates
+
+    def clip_features(self, clip_id):
+        # features of one clip in the format of TargetClip, { <stream type>: {<split #>:[<feature>], ...} }
+        chunk, row = divmod(clip_id - 1, CHUNK_SIZE)
+        features = {stream: self._chunk_features(stream, chunk) for stream in STREAMS}
+        return {stream: {split: features[stream][split][row].tolist() for split in SPLITS} for stream in STREAMS}
+
+    def match_clip_ids(self):
+        # clips generated as noisy copies of the reference clip
+        if self.nclips < 2:
+            return np.array([], dtype=int)
+        nmatches = min(max(int(self.match_fraction * self.nclips), 1), self.nclips - 1)
+        return np.sort(np.random.RandomState(self.seed).choice(np.arange(2, self.nclips + 1), nmatches, replace=False))
+
+    def _chunk_features(self, stream, chunk):
+        # features of the CHUNK_SIZE clips of chunk, which are always generated together and so are reproducible
+        statistics = self.statistics
+        clip_ids = np.arange(chunk * CHUNK_SIZE + 1, (chunk + 1) * CHUNK_SIZE + 1)
+        z, scale = self._chunk_normal(stream, chunk)
+        # matches are noisy copies of the reference clip
+        if stream not in self._reference:
+            reference_z, reference_scale = self._chunk_normal(stream, 0)
+            self._reference[stream] = ({split: reference_z[split][self.ref_clip_id - 1] for split in SPLITS},
+                                       reference_scale[self.ref_clip_id - 1])
+        reference_z, reference_scale = self._reference[stream]
+        is_match = np.isin(clip_ids, self._match_set())
+        scale[is_match] = reference_scale
+        split_features = {}
+        for split in SPLITS:
+            z[split][is_match] = MATCH_CORRELATION * reference_z[split] + \
+                np.sqrt(1 - MATCH_CORRELATION ** 2) * z[split][is_match]
+            split_features[split] = np.exp(scale) * statistics.inverse_cdf(stream, ndtr(z[split]))
+        return split_features
+
+    def _chunk_normal(self, stream, chunk):
+        # normal variables z of each split and log scale s of the clips of chunk, see the module docstring
+        rho = self.statistics.split_correlation
+        shape = (CHUNK_SIZE, self.statistics.dimension)
+        rng = np.random.RandomState([self.seed, STREAMS.index(stream), 0, chunk])
+        latent = rng.standard_normal(shape)
+        scale = rng.normal(0, self.statistics.scale_std, (CHUNK_SIZE, 1))
+        z = {}
+        for split in SPLITS:
+            noise = np.random.RandomState([self.seed, STREAMS.index(stream), split, chunk]).standard_normal(shape)
+            z[split] = rho * latent + np.sqrt(1 - rho ** 2) * noise
+        return z, scale
+
+    def _match_set(self):
+        if self._matches is None:
+            self._matches = self.match_clip_ids()
+        return self._matches
+
+
+def _read_features(path):
+    with open(path, 'r') as f:
+        rows = list(csv.reader(f))[1:]  # the first row is a header describing the video and model
+    return np.array([[float(value) for value in row[1:]] for row in rows])
+
+
+def _split_correlations(split_features):
+    # mean correlation of the rank-standardized features of the same clips in pairs of splits
+    correlations = []
+    ranks = [np.argsort(np.argsort(f, axis=0), axis=0) for f in split_features]
+    standardized = [(r - r.mean(axis=0)) / (r.std(axis=0) + 1e-9) for r in ranks]
+    for a in range(len(standardized)):
+        for b in range(a + 1, len(standardized)):
+            if standardized[a].shape == standardized[b].shape:
+                correlations.append(float(np.mean(standardized[a] * standardized[b])))
+    return correlations
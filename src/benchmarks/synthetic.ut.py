@@ -0,0 +1,48 @@
+import unittest
+import numpy as np
+from synthetic import CHUNK_SIZE, SPLITS, STREAMS, FeatureStatistics, SyntheticSearchSet
+
+
+class SyntheticSearchSetTest(unittest.TestCase):
+    """Tests for synthetic.py."""
+
+    def setUp(self):
+        self.statistics = FeatureStatistics.default(dimension=16)
+
+    def test_candidates_format(self):
+        candidates = SyntheticSearchSet(self.statistics, 50).candidates()
+        self.assertEqual(set(candidates), set(STREAMS))
+        self.assertEqual(set(candidates['rgb']), set(SPLITS))
+        self.assertEqual(sorted(candidates['rgb'][1]), list(range(1, 51)))
+        self.assertEqual(len(candidates['rgb'][1][7]), 16)
+        self.assertTrue(all(value >= 0 for value in candidates['warped_optical_flow'][2][7]))
+
+    def test_clip_features_match_candidates(self):
+        search_set = SyntheticSearchSet(self.statistics, CHUNK_SIZE + 10, seed=3)
+        candidates = search_set.candidates()
+        for clip_id in (1, 5, CHUNK_SIZE + 7):
+            features = search_set.clip_features(clip_id)
+            self.assertEqual(features['rgb'][3], candidates['rgb'][3][clip_id])
+
+    def test_reproducible(self):
+        first = SyntheticSearchSet(self.statistics, 20, seed=1).clip_features(4)
+        second = SyntheticSearchSet(self.statistics, 20, seed=1).clip_features(4)
+        other = SyntheticSearchSet(self.statistics, 20, seed=2).clip_features(4)
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+
+    def test_matches_resemble_reference(self):
+        search_set = SyntheticSearchSet(self.statistics, 500, match_fraction=0.1)
+        match_ids = search_set.match_clip_ids()
+        self.assertEqual(len(match_ids), 50)
+        candidates = search_set.candidates()
+        reference = np.array(candidates['rgb'][1][search_set.ref_clip_id])
+
+        def correlation(clip_id):
+            return np.corrcoef(reference, candidates['rgb'][1][clip_id])[0, 1]
+        others = [clip_id for clip_id in range(2, 501) if clip_id not in set(match_ids)]
+        self.assertGreater(np.mean([correlation(c) for c in match_ids]), np.mean([correlation(c) for c in others]))
+
+
+if __name__ == '__main__':
+    unittest.main()
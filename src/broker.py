@@ -1,23 +1,66 @@
 """Brokers Queries to downstream logic based on Query.ProcessState.
 
-This script is designed to be executed as a long running service.
-
-TODO: Consider shifting to a daemonize approach to manage this process.
+This script is designed to be executed as a long running service.  With BROKER_THREADING=True a single scheduler
+loop polls the API, more often right after work is found and less often while idle.  With BROKER_NOTIFY_PORT or
+BROKER_NOTIFY_SOCKET set, a notification of a query state change wakes the loop at once, and idle polling slows to
+a safety net.
+Send SIGTERM to stop the broker cleanly, or SIGUSR1 to make it poll immediately.
 """
 import os
-import random
-import threading
+import signal
+import socket
+from collections import deque
+from functools import partial
 import logging
+import time
 from datetime import datetime
 from api.api_repository import APIRepository
-from models.compute_matches import compute_matches
+from api.session import get_session
+from models.compute_matches import process_update
 from models import Hyperparameter
+from services import BrokerScheduler, CheckpointStore, LeaseManager, MemoryEstimator, SQLiteLeaseBackend, \
+    StageMetrics, StatusServer, TicketQueue, TicketWorkerPool, UnixSocketListener, WebhookListener, active_traces, \
+    cache_stats, register_cache
 
 ###########################################
 # Broker Config
 ###########################################
-LOOP_EXECUTION_TIME = 5.0  # In seconds
-BASE_URL = "http://127.0.0.1:8000/"
+LOOP_EXECUTION_TIME = 5.0  # In seconds, longest wait between polls while the broker is idle
+MIN_POLL_INTERVAL = 0.5  # In seconds, wait between polls right after work was found
+BROKER_WORKERS = int(os.environ.get('BROKER_WORKERS', 4))  # number of tickets processed concurrently
+BROKER_WORKER_TYPE = os.environ.get('BROKER_WORKER_TYPE', 'thread')  # 'thread' or 'process'
+# finalize jobs running at the same time; the other workers are kept for interactive rounds
+BROKER_BATCH_WORKERS = int(os.environ.get('BROKER_BATCH_WORKERS', max(BROKER_WORKERS - 1, 1)))
+# claimed queries waiting for a worker, from which the broker picks by priority, fair share and cost
+BROKER_BACKLOG = int(os.environ.get('BROKER_BACKLOG', BROKER_WORKERS))
+# Megabytes that the estimated peak memory of the tickets running at the same time may not exceed.  Not set: no limit.
+BROKER_MEMORY_BUDGET = int(os.environ['BROKER_MEMORY_BUDGET_MB']) * 2 ** 20 \
+    if os.environ.get('BROKER_MEMORY_BUDGET_MB') else None
+# Lease database shared by the brokers that serve the same API, so no query is processed twice.  Not set: no leases.
+BROKER_LEASE_DB = os.environ.get('BROKER_LEASE_DB')
+BROKER_ID = os.environ.get('BROKER_ID', '{}:{}'.format(socket.gethostname(), os.getpid()))
+# Checkpoint database for the stages of each query round, so rounds resume after a restart.  Not set: no checkpoints.
+BROKER_CHECKPOINT_DB = os.environ.get('BROKER_CHECKPOINT_DB')
+TELEMETRY_LOG_INTERVAL = 300.0  # In seconds, interval between summaries of API request telemetry in the log
+# Prometheus text file for the ticket stage and API request metrics, e.g. in node_exporter's textfile directory.
+# Not set: metrics are only logged.
+BROKER_METRICS_FILE = os.environ.get('BROKER_METRICS_FILE')
+METRICS_WRITE_INTERVAL = 15.0  # In seconds, interval between writes of BROKER_METRICS_FILE
+# Port of the local HTTP status endpoint, http://BROKER_STATUS_HOST:BROKER_STATUS_PORT/status.  Not set: no endpoint.
+BROKER_STATUS_PORT = int(os.environ['BROKER_STATUS_PORT']) if os.environ.get('BROKER_STATUS_PORT') else None
+BROKER_STATUS_HOST = os.environ.get('BROKER_STATUS_HOST', '127.0.0.1')
+RECENT_TICKETS = 50  # number of finished tickets listed in the status
+# Push notifications of query state changes, which wake the broker immediately: a local webhook port and/or a Unix
+# datagram socket.  Not set: the broker relies on polling alone.
+BROKER_NOTIFY_PORT = int(os.environ['BROKER_NOTIFY_PORT']) if os.environ.get('BROKER_NOTIFY_PORT') else None
+BROKER_NOTIFY_SOCKET = os.environ.get('BROKER_NOTIFY_SOCKET')
+# In seconds, longest wait between polls while idle when push notifications are on; polling is then only a safety net
+SAFETY_POLL_INTERVAL = float(os.environ.get('BROKER_SAFETY_POLL_INTERVAL', 60.0))
+# url of the Video Query API, e.g. a benchmarks.api_standin server or a benchmarks.recording proxy
+BASE_URL = os.environ.get('API_BASE_URL', "http://127.0.0.1:8000/")
+# If set, each ticket draws its random numbers from a generator seeded with RANDOM_SEED and its query id, to ease
+# debugging.  "None": seeded from the system.
+RANDOM_SEED = os.environ['RANDOM_SEED'] if os.environ.get('RANDOM_SEED', 'None') != 'None' else None
 # BASE_URL = "http://localhost:1337"
 
 ###########################################
@@ -59,37 +102,249 @@ f_memory = 0.7
 ballast = 0.0
 
 
+last_telemetry_log = time.time()
+last_metrics_write = 0.0
+stage_metrics = StageMetrics()
+recent_tickets = deque(maxlen=RECENT_TICKETS)
+
+
 def main():
+    # Persistent API repository and hyperparameter template, shared by every poll of this broker process
+    query_updates = APIRepository(BASE_URL)
+    hyperparameters = Hyperparameter(
+        default_weights,
+        default_threshold,
+        ballast,
+        near_miss_default,
+        mu,
+        streams,
+        feature_name,
+        f_bootstrap,
+        f_memory,
+        bootstrap_type,
+        nbags
+    )
+
+    pool = TicketWorkerPool(BROKER_WORKERS, BROKER_WORKER_TYPE)
+    queue = TicketQueue(BROKER_BATCH_WORKERS, memory_estimator=MemoryEstimator(len(streams)),
+                        memory_budget=BROKER_MEMORY_BUDGET)
+    leases = None
+    if BROKER_LEASE_DB:
+        leases = LeaseManager(SQLiteLeaseBackend(BROKER_LEASE_DB), BROKER_ID)
+        leases.start()
+    checkpoints = None
+    if BROKER_CHECKPOINT_DB:
+        checkpoints = CheckpointStore(BROKER_CHECKPOINT_DB)
+        resume_incomplete(checkpoints, queue, leases)
+    status_server = None
+    if BROKER_STATUS_PORT is not None:
+        session = get_session(BASE_URL)
+        register_cache('api_schema', lambda: {
+            "hits": session.schema_cache_stats["memory_hits"] + session.schema_cache_stats["disk_hits"],
+            "misses": session.schema_cache_stats["downloads"]})
+        status_server = StatusServer(partial(broker_status, pool, queue, leases),
+                                     metrics=lambda: stage_metrics.prometheus_text(session.telemetry),
+                                     host=BROKER_STATUS_HOST, port=BROKER_STATUS_PORT)
+        status_server.start()
+
+    if os.environ.get('BROKER_THREADING') != 'True':
+        # single poll: process the queries claimed now, then stop
+        poll(query_updates, hyperparameters, pool, queue, leases, checkpoints)
+        while len(queue):
+            time.sleep(MIN_POLL_INTERVAL)
+            dispatch(hyperparameters, pool, queue, leases, checkpoints)
+        pool.shutdown(wait=True)
+        if status_server is not None:
+            status_server.stop()
+        return
+
+    listeners = notification_listeners()
+    scheduler = BrokerScheduler(lambda: poll(query_updates, hyperparameters, pool, queue, leases, checkpoints),
+                                min_interval=MIN_POLL_INTERVAL,
+                                max_interval=SAFETY_POLL_INTERVAL if listeners else LOOP_EXECUTION_TIME)
+    # poll as soon as a query changes state
+    for listener in listeners:
+        listener.start(lambda notification: query_changed(scheduler, notification))
+    # poll again as soon as a worker is free
+    pool.on_done = scheduler.trigger
+    # SIGTERM or SIGINT stop the broker after the poll in progress; SIGUSR1 polls immediately
+    signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: scheduler.stop())
+    signal.signal(signal.SIGUSR1, lambda signum, frame: scheduler.trigger())
+    scheduler.run()
+    for listener in listeners:
+        listener.stop()
+    # queries claimed for the backlog but not started are handed back rather than left in progress
+    requeue_pending(query_updates, queue, leases, checkpoints)
+    # let tickets in progress finish before exiting
+    pool.shutdown(wait=True)
+    if leases is not None:
+        leases.stop()
+    if status_server is not None:
+        status_server.stop()
+
+
+def poll(query_updates, hyperparameter_template, pool, queue, leases=None, checkpoints=None):
+    """
+    One broker cycle: claim queries waiting for an update, enough to fill the free workers and the backlog,
+    and start the ones the ticket queue picks on the worker pool.
+    Returns True if any queries were claimed or started.
+    """
     try:
-        # Ask data-source for queries to impart logic on.
-        query_updates = APIRepository(BASE_URL)
-
-        # Calculate hyperparameters
-        hyperparameters = Hyperparameter(
-            default_weights,
-            default_threshold,
-            ballast,
-            near_miss_default,
-            mu,
-            streams,
-            feature_name,
-            f_bootstrap,
-            f_memory,
-            bootstrap_type,
-            nbags
-        )
-
-        # If available, set random seed on environment to ease debugging
-        if os.environ["RANDOM_SEED"] != "None":
-            random.seed(a=os.environ["RANDOM_SEED"])
-
-        # Compute new matches and scores for a query
-        compute_matches(query_updates, hyperparameters)
+        # Pause while the API is down, rather than polling it
+        if query_updates.session.breaker.is_open:
+            logging.warning('API circuit breaker is open, skipping this broker cycle')
+            return False
+
+        # first take over queries of brokers whose leases expired, then claim waiting queries
+        claimed = query_updates.reclaim_expired(leases) if leases is not None else []
+        nclaim = pool.available() + BROKER_BACKLOG - len(queue) - len(claimed)
+        if nclaim > 0:
+            claimed += query_updates.claim_pending(nclaim, leases)
+        for update_type, update_object in claimed:
+            queue.push(update_type, update_object)
+        nstarted = dispatch(hyperparameter_template, pool, queue, leases, checkpoints)
+        return len(claimed) > 0 or nstarted > 0
     except Exception as e:
         logging.error(e, exc_info=True)
+        return False
     finally:
-        if os.environ.get('BROKER_THREADING') == 'True':
-            threading.Timer(LOOP_EXECUTION_TIME, main).start()
+        log_request_telemetry()
+        write_metrics()
+
+
+def dispatch(hyperparameter_template, pool, queue, leases=None, checkpoints=None):
+    # start queued tickets while workers are free.  Returns the number of tickets started.
+    nstarted = 0
+    while pool.available() > 0:
+        ticket = queue.pop_next()
+        if ticket is None:
+            break
+        # Each ticket gets its own copy of the hyperparameters, since it updates weights and threshold
+        pool.submit(process_update, ticket.update_type, ticket.update_object, BASE_URL,
+                    hyperparameter_template.copy(), checkpoints, RANDOM_SEED,
+                    callback=partial(ticket_finished, queue, leases, ticket))
+        nstarted += 1
+    return nstarted
+
+
+def requeue_pending(query_updates, queue, leases=None, checkpoints=None):
+    # release the queries waiting in the ticket queue, so this or another broker claims them again
+    tickets = queue.drain()
+    if not tickets:
+        return
+    query_updates.release([(ticket.update_type, ticket.update_object) for ticket in tickets], leases)
+    if checkpoints is not None:
+        # rounds queued by resume_incomplete are claimed from the API again instead of being resumed
+        for ticket in tickets:
+            checkpoints.release(ticket.update_object["query_id"])
+    logging.info('Released {} queued queries'.format(len(tickets)))
+
+
+def resume_incomplete(checkpoints, queue, leases=None):
+    # queue the query rounds this broker had claimed but not finished before it stopped.  The checkpointed update
+    # objects hold decoded targets, which are encoded again for the lease payload.
+    for update_type, update_object in checkpoints.incomplete():
+        if leases is not None and not leases.claim(update_type, APIRepository.as_listed(update_object)):
+            # another broker holds the round; if its lease expires the round is requeued by reclaim_expired
+            continue
+        queue.push(update_type, update_object)
+
+
+def ticket_finished(queue, leases, ticket, summary):
+    # summary is None if the ticket failed.  A failed ticket's lease is released rather than completed, so the query
+    # can be claimed again as soon as it is resubmitted.
+    queue.finished(ticket, summary)
+    stage_metrics.record_ticket(ticket.update_type, summary)
+    recent_tickets.append({
+        "query_id": ticket.update_object["query_id"],
+        "update_type": ticket.update_type,
+        "outcome": summary.get("outcome") if summary else "failed",
+        "duration": time.time() - ticket.started,
+        "finished": time.time(),
+        "memory_estimate": ticket.memory,
+        "peak_traced_bytes": summary["memory"].get("peak_traced_bytes") if summary else None,
+        "process_max_rss": summary["memory"]["process_max_rss_bytes"] if summary else None,
+    })
+    if leases is not None and summary is None:
+        leases.release(ticket.update_type, ticket.update_object)
+    elif leases is not None:
+        leases.complete(ticket.update_type, ticket.update_object)
+
+
+def notification_listeners():
+    listeners = []
+    if BROKER_NOTIFY_PORT is not None:
+        listeners.append(WebhookListener(port=BROKER_NOTIFY_PORT))
+    if BROKER_NOTIFY_SOCKET:
+        listeners.append(UnixSocketListener(BROKER_NOTIFY_SOCKET))
+    return listeners
+
+
+def query_changed(scheduler, notification):
+    # a notification only says that there may be work; poll claims it from the API
+    logging.debug('Query notification: {}'.format(notification))
+    scheduler.trigger()
+
+
+def broker_status(pool, queue, leases=None):
+    # status document served at /status: tickets in flight, queue depth, workers, API errors, caches, recent tickets
+    now = time.time()
+    pending, running = queue.snapshot()
+    # the stage of a ticket is only known for thread workers, which share this process
+    traces = {trace["query_id"]: trace for trace in active_traces()}
+    in_flight = []
+    for ticket in running:
+        trace = traces.get(ticket["query_id"], {})
+        in_flight.append(dict(ticket, elapsed=now - ticket["started"], stage=trace.get("stage"),
+                              stage_elapsed=trace.get("stage_elapsed")))
+
+    session = get_session(BASE_URL)
+    api_actions = {}
+    for action_name, stats in session.telemetry.snapshot().items():
+        api_actions[action_name] = {
+            "requests": stats["count"],
+            "failures": stats["failures"],
+            "retries": stats["retries"],
+            "error_rate": stats["failures"] / stats["count"] if stats["count"] else None,
+        }
+    return {
+        "broker_id": BROKER_ID,
+        "time": now,
+        "workers": {"type": pool.worker_type, "total": pool.nworkers, "available": pool.available(),
+                    "utilization": pool.utilization()},
+        "queue": {"pending": pending, "backlog": BROKER_BACKLOG},
+        "memory": {"budget": BROKER_MEMORY_BUDGET,
+                   "reserved": sum(ticket["memory_estimate"] or 0 for ticket in running)},
+        "in_flight": in_flight,
+        "leases_held": len(leases.held) if leases is not None else None,
+        "api": {"circuit_breaker_open": session.breaker.is_open, "actions": api_actions},
+        "caches": cache_stats(),
+        "recent_tickets": list(recent_tickets),
+    }
+
+
+def log_request_telemetry():
+    # periodically write per-action API request counters, latencies and payload sizes to the log
+    global last_telemetry_log
+    if time.time() - last_telemetry_log < TELEMETRY_LOG_INTERVAL:
+        return
+    last_telemetry_log = time.time()
+    summary = get_session(BASE_URL).telemetry.summary()
+    if summary:
+        logging.info('API request telemetry:\n' + summary)
+
+
+def write_metrics():
+    # periodically export the stage and API request metrics for Prometheus
+    global last_metrics_write
+    if not BROKER_METRICS_FILE or time.time() - last_metrics_write < METRICS_WRITE_INTERVAL:
+        return
+    last_metrics_write = time.time()
+    try:
+        stage_metrics.write_prometheus(BROKER_METRICS_FILE, get_session(BASE_URL).telemetry)
+    except OSError as e:
+        logging.warning('Could not write metrics file: {}'.format(e))
 
 
 if __name__ == '__main__':
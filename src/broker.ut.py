@@ -0,0 +1,71 @@
+import os
+import tempfile
+import time
+import unittest
+import numpy as np
+
+# settings read when the models are imported
+os.environ.setdefault("COMPUTE_EPS", "0.000003")
+# broker logs to logs/ in the working directory, so the test runs in a temporary one
+os.chdir(tempfile.mkdtemp())
+os.makedirs('logs')
+from api.api_repository import APIRepository  # noqa: E402
+from api.target_encoding import encode_target  # noqa: E402
+from broker import resume_incomplete, ticket_finished  # noqa: E402
+from services import CheckpointStore, LeaseManager, SQLiteLeaseBackend, TicketQueue  # noqa: E402
+
+
+class BrokerTest(unittest.TestCase):
+    """Tests for broker.py."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.checkpoints = CheckpointStore(os.path.join(self.directory.name, 'checkpoints.sqlite'))
+        backend = SQLiteLeaseBackend(os.path.join(self.directory.name, 'leases.sqlite'))
+        self.broker_1 = LeaseManager(backend, 'broker-1', ttl=0.2)
+        self.broker_2 = LeaseManager(backend, 'broker-2', ttl=0.2)
+
+    def tearDown(self):
+        self.broker_1.stop()
+        self.broker_2.stop()
+        self.directory.cleanup()
+
+    def test_resume_incomplete(self):
+        # a revise round claimed before a restart, whose bootstrapped target was decoded into arrays
+        target = {'rgb': {1: [0.25, 0.5]}, 'warped_optical_flow': {1: [0.75, 1.0]}}
+        update_object = APIRepository._convert_split_key({
+            "query_id": 7, "search_set": 1, "number_of_matches_to_review": 5, "user_matches": {},
+            "latest_query_result": {"round": 2, "bootstrapped_target": encode_target(target)}})
+        self.checkpoints.round(7, 3).save('claimed', ('revise', update_object))
+        queue = TicketQueue(1)
+        resume_incomplete(self.checkpoints, queue, self.broker_1)
+        self.assertEqual(len(queue), 1)
+        self.assertIsInstance(queue.pop_next().update_object["latest_query_result"]["bootstrapped_target"]['rgb'][1],
+                              np.ndarray)
+        self.assertFalse(self.broker_2.claim('revise', update_object))
+        # the round is taken over by another broker once the lease expires, with its target intact
+        time.sleep(0.3)
+        (update_type, reclaimed), = self.broker_2.reclaim_expired()
+        self.assertEqual(update_type, 'revise')
+        reclaimed = APIRepository._convert_split_key(reclaimed)
+        np.testing.assert_allclose(reclaimed["latest_query_result"]["bootstrapped_target"]['rgb'][1], [0.25, 0.5])
+
+    def test_failed_ticket_lease_released(self):
+        queue = TicketQueue(2)
+        for query_id in (7, 8):
+            update_object = {"query_id": query_id, "search_set": 1, "number_of_matches_to_review": 5}
+            self.broker_1.claim('new', update_object)
+            queue.push('new', update_object)
+        failed, processed = queue.pop_next(), queue.pop_next()
+        ticket_finished(queue, self.broker_1, failed, None)
+        ticket_finished(queue, self.broker_1, processed, {"query_id": 8, "search_set": 1, "search_set_size": 10,
+                                                          "outcome": "processed", "spans": [],
+                                                          "memory": {"process_max_rss_bytes": 0}})
+        self.assertEqual(self.broker_1.held, set())
+        # the failed query can be claimed again once it is resubmitted, the processed one cannot
+        self.assertTrue(self.broker_2.claim('new', failed.update_object))
+        self.assertFalse(self.broker_2.claim('new', processed.update_object))
+
+
+if __name__ == '__main__':
+    unittest.main()
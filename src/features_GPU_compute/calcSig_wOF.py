@@ -125,12 +125,16 @@ def writeFeatures(clip_list, video_path):
         header_txt = 'video =' + video + ', video url =' + video_path + ', CNN stream =' + mode[0] \
                      + ', feature blob =' + args.featureBlob + ', caffe model =' + net_weights_file
         outfile = os.path.join(f_output_dir, mode[0] + "_" + args.featureBlob + "_features.csv")
-        with open(outfile, mode='w') as fout:
+        # write to a temporary name, then rename, so load_db.py --watch never reads a partial file
+        with open(outfile + ".tmp", mode='w') as fout:
             fout.write(header_txt + "\n")
             for i, vid in enumerate(clip_list):
                 clip_no = int(vid[-4:])
                 row = str(clip_no) + "," + ",".join(map(str, mode[1][i]))
                 fout.write(row + "\n")
+        os.rename(outfile + ".tmp", outfile)
+    # marker telling load_db.py --watch that the features of this video and model are complete
+    open(os.path.join(f_output_dir, ".done"), mode='w').close()
     return
 
 
@@ -3,29 +3,171 @@ Loads features created by calcSig_wof into the video-queries-api database.
 The features are in csv files in a directory tree specified by calcSig_wOF.py.
 """
 from api.api_load_records import APILoadRecords
+from api.async_client import MAX_CONCURRENT_REQUESTS
+from api.ingestion_manifest import IngestionManifest
+from api.session import CONNECTION_POOL_SIZE
+from concurrent.futures import ThreadPoolExecutor
 import os
 import argparse
+import logging
+import signal
+import threading
+import time
+
+# file written in a split directory by calcSig_wOF.writeFeatures once its feature files are complete
+DONE_MARKER = '.done'
+
+
+class IngestionProgress:
+    def __init__(self, nvideos, session):
+        """
+        Counts the videos, feature rows loaded and unchanged files skipped, and logs the progress and throughput
+        after each video.
+        :param nvideos: number of videos to load, None if unknown
+        :param session: APISession whose requests are counted
+        """
+        self.nvideos = nvideos
+        self.session = session
+        self.videos = 0
+        self.failed = 0
+        self.rows = 0
+        self.skipped_files = 0
+        self.start = time.time()
+        self._requests_at_start = self._requests()
+        self._lock = threading.Lock()
+
+    def video_done(self, video_name, nrows, nskipped, seconds):
+        with self._lock:
+            self.videos += 1
+            self.rows += nrows
+            self.skipped_files += nskipped
+            logging.info('video {} {}: {} rows, {} unchanged files in {:.1f} s; {}'.format(
+                self._position(), video_name, nrows, nskipped, seconds, self.throughput()))
+
+    def video_failed(self, video_name, error):
+        with self._lock:
+            self.failed += 1
+            logging.error('video {} {} failed: {}'.format(self._position(), video_name, error))
+
+    def throughput(self):
+        elapsed = time.time() - self.start
+        requests = self._requests() - self._requests_at_start
+        return '{} rows, {} unchanged files, {} requests in {:.1f} s: {:.1f} rows/s, {:.1f} requests/s'.format(
+            self.rows, self.skipped_files, requests, elapsed, self.rows / elapsed if elapsed else 0,
+            requests / elapsed if elapsed else 0)
+
+    def _position(self):
+        done = self.videos + self.failed
+        return '{}/{}'.format(done, self.nvideos) if self.nvideos is not None else str(done)
+
+    def _requests(self):
+        return sum(stats["count"] for stats in self.session.telemetry.snapshot().values())
 
 
 def main(args):
-    loader = APILoadRecords(args.base_url)
+    # more workers are allowed more requests in flight, up to the size of the connection pool
+    max_requests = args.max_requests
+    if max_requests is None and args.workers > 1:
+        max_requests = min(MAX_CONCURRENT_REQUESTS * args.workers, CONNECTION_POOL_SIZE)
+    loader = APILoadRecords(args.base_url, max_requests, args.write_sidecars)
+    # bulk requests if the API offers them, otherwise clips and features are created row by row
+    bulk = not args.no_bulk and loader.bulk_supported()
+    # files loaded before and unchanged since are skipped
+    manifest = None
+    if not args.no_manifest:
+        manifest = IngestionManifest(args.manifest or os.path.join(args.src_dir, '.load_db_manifest.sqlite'))
+    if args.watch:
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        try:
+            watch(args, loader, bulk, manifest, stop)
+        except KeyboardInterrupt:
+            pass
+        return
 
+    videos = scan_videos(args.src_dir, args.video_path_type)
+    # videos are loaded by args.workers threads, sharing the loader's session and its limit on requests in flight
+    progress = IngestionProgress(len(videos), loader.session)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(load_video, loader, progress, args, bulk, manifest, *video) for video in videos]
+    logging.info('loaded {} of {} videos; {}'.format(progress.videos, len(videos), progress.throughput()))
+    # raise the error of the first video that failed, if any
+    for future in futures:
+        future.result()
+
+
+def watch(args, loader, bulk, manifest, stop):
+    """
+    Load feature files as soon as they are complete, polling args.src_dir every args.poll_interval seconds until stop
+    is set.  A split directory is complete once it holds the DONE_MARKER file that calcSig_wOF.writeFeatures writes
+    after its csv files.  With args.no_done_marker, every csv file is loaded as soon as it appears, so files must be
+    renamed into place once written.  A file is loaded again if it changes; a video that fails is tried again at the
+    next poll.
+    """
+    marker = None if args.no_done_marker else DONE_MARKER
+    loaded = {}  # csv path: (size, modification time) when it was loaded
+    progress = IngestionProgress(None, loader.session)
+    logging.info('watching {} for feature files'.format(args.src_dir))
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        while not stop.is_set():
+            pending = []
+            for video_name, video_path, split_paths in scan_videos(args.src_dir, args.video_path_type, marker):
+                changed = {path: stat for path, stat in _csv_stats(split_paths) if loaded.get(path) != stat}
+                if changed:
+                    new_splits = sorted(set(os.path.dirname(path) for path in changed))
+                    pending.append((executor.submit(load_video, loader, progress, args, bulk, manifest, video_name,
+                                                    video_path, new_splits), changed))
+            for future, changed in pending:
+                if future.exception() is None:
+                    loaded.update(changed)
+            stop.wait(args.poll_interval)
+
+
+def scan_videos(src_dir, video_path_type, marker=None):
+    """
+    :param marker: optional name of a file that a split directory must hold to be loaded
+    :return: [(video name, video path, split directories)] of the videos in src_dir with at least one split
+    """
     # load features, clips and videos by iterating through feature csv files stored in specified directory tree:
     # <source directory>/<video names>/<split names>/<csv files titled <<stream>>_<<feature name>>_features.csv >
-    src_path = args.src_dir
-    with os.scandir(src_path) as vid:
+    videos = []
+    with os.scandir(src_dir) as vid:
         for video in vid:
             if video.is_dir() and not video.name.startswith('.'):
-                if args.video_path_type == 'absolute':
+                if video_path_type == 'absolute':
                     video_path = video.path
                 else:
                     video_path = video.name
-                # TODO: add mp4 or avi to video name
-                video_object = loader.create_or_get_video(video.name, video_path)
                 with os.scandir(video.path) as split_dir:
-                    for split in split_dir:
-                        if split.is_dir() and not split.name.startswith('.'):
-                            loader.create_video_clips_and_features(video_object, split.path, args.duration)
+                    split_paths = [split.path for split in split_dir
+                                   if split.is_dir() and not split.name.startswith('.') and
+                                   (marker is None or os.path.exists(os.path.join(split.path, marker)))]
+                if split_paths:
+                    videos.append((video.name, video_path, sorted(split_paths)))
+    return videos
+
+
+def load_video(loader, progress, args, bulk, manifest, video_name, video_path, split_paths):
+    start = time.time()
+    try:
+        # TODO: add mp4 or avi to video name
+        nrows, nskipped = loader.load_video(video_name, video_path, split_paths, args.duration, bulk, manifest)
+    except Exception as e:
+        progress.video_failed(video_name, e)
+        raise
+    progress.video_done(video_name, nrows, nskipped, time.time() - start)
+
+
+def _csv_stats(split_paths):
+    # [(path, (size, modification time))] of the csv files in split_paths
+    stats = []
+    for split_path in split_paths:
+        with os.scandir(split_path) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith('.csv') and not entry.name.startswith('.'):
+                    stat = entry.stat()
+                    stats.append((entry.path, (stat.st_size, stat.st_mtime_ns)))
+    return stats
 
 
 if __name__ == '__main__':
@@ -36,6 +178,26 @@ if __name__ == '__main__':
                         help='relative paths will have a parent specified in the video query api')
     parser.add_argument("--base_url", type=str, default="http://127.0.0.1:8000/",
                         help='url for video query api')
+    parser.add_argument("--no_bulk", action='store_true',
+                        help='create clips and features one request per row, even if the api offers bulk requests')
+    parser.add_argument("--workers", type=int, default=1, help='number of videos loaded at the same time')
+    parser.add_argument("--max_requests", type=int, default=None,
+                        help='maximum number of api requests in flight across all workers, at most 16.  '
+                             'Default 8 per worker, up to 16')
+    parser.add_argument("--write_sidecars", action='store_true',
+                        help='write a binary sidecar next to each feature csv file parsed, read instead of the csv '
+                             'file while the csv file is unchanged')
+    parser.add_argument("--manifest", type=str, default=None,
+                        help='manifest of the files loaded, default <src_dir>/.load_db_manifest.sqlite')
+    parser.add_argument("--no_manifest", action='store_true',
+                        help='check every file against the api, and record nothing in the manifest')
+    parser.add_argument("--watch", action='store_true',
+                        help='keep loading feature files as soon as feature extraction completes them')
+    parser.add_argument("--poll_interval", type=float, default=2.0, help='with --watch, seconds between scans')
+    parser.add_argument("--no_done_marker", action='store_true',
+                        help='with --watch, load csv files without waiting for the ' + DONE_MARKER + ' file of '
+                             'their split; they must be renamed into place once written')
     arguments = parser.parse_args()
 
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
     main(arguments)
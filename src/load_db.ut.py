@@ -0,0 +1,122 @@
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+# load_db imports the api package, and the test loads into the API stand-in of the benchmarks package
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("API_CLIENT_USERNAME", "u")
+os.environ.setdefault("API_CLIENT_PASSWORD", "p")
+os.environ["API_SCHEMA_CACHE_DIR"] = tempfile.mkdtemp()
+import load_db  # noqa: E402
+from api.api_load_records import APILoadRecords  # noqa: E402
+from api.feature_file import FEATURE_DIMENSION  # noqa: E402
+from benchmarks.api_standin import StandinServer, StandinStore  # noqa: E402
+
+STREAMS = ('rgb', 'warped_optical_flow')
+
+
+class LoadDbTest(unittest.TestCase):
+    """Tests for load_db.py."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = StandinStore()
+        self.server = StandinServer(self.store)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.directory.cleanup()
+
+    def test_bulk_load(self):
+        for video in ('Video0', 'Video1'):
+            self._write_split(video, 1, (1, 2, 3))
+        args = self._args()
+        loader = APILoadRecords(self.server.url)
+        self.assertTrue(loader.bulk_supported())
+        progress = load_db.IngestionProgress(2, loader.session)
+        for video in load_db.scan_videos(self.directory.name, args.video_path_type):
+            load_db.load_video(loader, progress, args, True, None, *video)
+        self.assertEqual(self._counts(), (2, 6, 12))
+        self.assertIn('features/bulk_create', self.server.request_counts)
+        self.assertNotIn('features/create', self.server.request_counts)
+        # loading again finds every clip and feature, and creates none
+        for video in load_db.scan_videos(self.directory.name, args.video_path_type):
+            load_db.load_video(loader, progress, args, True, None, *video)
+        self.assertEqual(self._counts(), (2, 6, 12))
+        self.assertEqual((progress.videos, progress.failed, progress.rows), (4, 0, 24))
+
+    def test_parallel_load(self):
+        for nvideo in range(4):
+            for nsplit in (1, 2):
+                self._write_split('Video{}'.format(nvideo), nsplit, (1, 2, 3))
+        # videos are loaded by several threads, row by row and then with bulk requests, creating no duplicates
+        load_db.main(self._args(workers=3, no_bulk=True))
+        self.assertEqual(self._counts(), (4, 12, 48))
+        load_db.main(self._args(workers=3))
+        self.assertEqual(self._counts(), (4, 12, 48))
+
+    def test_watch(self):
+        self._write_split('Video0', 1, (1, 2, 3), done=False)
+        args = self._args(poll_interval=0.05)
+        loader = APILoadRecords(self.server.url)
+        stop = threading.Event()
+        with mock.patch.object(load_db, 'scan_videos', wraps=load_db.scan_videos) as scan_videos:
+            thread = threading.Thread(target=load_db.watch, args=(args, loader, False, None, stop))
+            thread.start()
+            try:
+                # a split is not loaded before its feature files are complete
+                self._wait_for(lambda: scan_videos.call_count >= 2)
+                self.assertEqual(self._counts(), (0, 0, 0))
+                self._write_split('Video0', 1, (1, 2, 3))
+                self._wait_for(lambda: self._counts() == (1, 3, 6))
+                # a feature file that changes is loaded again
+                self._write_split('Video0', 1, (1, 2, 3, 4))
+                self._wait_for(lambda: self._counts() == (1, 4, 8))
+            finally:
+                stop.set()
+                thread.join()
+
+    def _args(self, **kwargs):
+        args = dict(src_dir=self.directory.name, duration=10, video_path_type='relative', base_url=self.server.url,
+                    no_bulk=False, workers=1, max_requests=None, write_sidecars=False, manifest=None,
+                    no_manifest=True, watch=False, poll_interval=2.0, no_done_marker=False)
+        args.update(kwargs)
+        return argparse.Namespace(**args)
+
+    def _write_split(self, video, nsplit, clips, done=True):
+        # feature files of a split as written by calcSig_wOF.writeFeatures, with its done marker if done
+        split_path = os.path.join(self.directory.name, video, 'UCF101_split{}'.format(nsplit))
+        os.makedirs(split_path, exist_ok=True)
+        for stream in STREAMS:
+            path = os.path.join(split_path, '{}_global_pool_features.csv'.format(stream))
+            with open(path + '.tmp', 'w') as f:
+                f.write('video ={}, video url ={}/, CNN stream ={}, feature blob =global_pool, '
+                        'caffe model =weights\n'.format(video, video, stream))
+                for clip in clips:
+                    f.write('{},'.format(clip) + ','.join([str(clip / 4)] * FEATURE_DIMENSION) + '\n')
+            os.replace(path + '.tmp', path)
+        if done:
+            open(os.path.join(split_path, load_db.DONE_MARKER), 'w').close()
+
+    def _counts(self):
+        # number of videos, video clips and features in the stand-in
+        return tuple(self.store.list(resource)["pagination"]["count"]
+                     for resource in ("videos", "video-clips", "features"))
+
+    @staticmethod
+    def _wait_for(condition, timeout=10.0):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                raise AssertionError('condition not met within {} s'.format(timeout))
+            time.sleep(0.02)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
 from .hyperparameter import *
 from .target_clip import *
 from .ticket import *
+from .batch_scoring import *
@@ -0,0 +1,164 @@
+"""Score many reference clips against a search set at once, with the math of the first round of a query:
+the target of each reference is its scaled features (TargetClip.scaled_ref_clip_features), similarities are averaged
+over splits (Ticket.compute_similarities) and combined over streams with weights (Ticket.compute_scores).
+
+Features of a stream and split are stacked into one matrix for all clips, and the references into another, so the
+similarities of a block of references and a block of candidates are one matrix product per split.
+"""
+import numpy as np
+
+# candidate clips and references scored together; a block of scores is CANDIDATE_BLOCK x REFERENCE_BLOCK floats
+CANDIDATE_BLOCK = 16384
+REFERENCE_BLOCK = 256
+
+
+class FeatureSet:
+    def __init__(self, keys, features):
+        """
+        :param keys: list identifying each clip, e.g. (video name, clip number)
+        :param features: { <stream type>: {<split #>: float32 array with one row per key} }.  Rows of missing features
+                         are NaN.
+        """
+        self.keys = list(keys)
+        self.features = features
+        self._index = None
+
+    @classmethod
+    def from_blocks(cls, blocks):
+        """
+        :param blocks: iterable of (keys, stream type, split #, features), features having one row per key, e.g. the
+                       clips and features of one feature file.  Features of a key, stream and split repeated in a
+                       later block replace the earlier ones.
+        """
+        keys, positions, indexed = [], {}, {}
+        for block_keys, stream, split, matrix in blocks:
+            for key in block_keys:
+                if key not in positions:
+                    positions[key] = len(keys)
+                    keys.append(key)
+            rows = np.array([positions[key] for key in block_keys], dtype=np.int64)
+            indexed.setdefault(stream, {}).setdefault(split, []).append((rows, matrix))
+        features = {}
+        for stream, split_blocks in indexed.items():
+            features[stream] = {}
+            for split, row_blocks in split_blocks.items():
+                matrix = np.full((len(keys), row_blocks[0][1].shape[1]), np.nan, dtype=np.float32)
+                for rows, block in row_blocks:
+                    matrix[rows] = block
+                features[stream][split] = matrix
+        return cls(keys, features)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def index(self, key):
+        # position of key in self.keys, or None
+        if self._index is None:
+            self._index = {k: position for position, k in enumerate(self.keys)}
+        return self._index.get(key)
+
+    def subset(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        return FeatureSet([self.keys[position] for position in positions],
+                          {stream: {split: matrix[positions] for split, matrix in split_features.items()}
+                           for stream, split_features in self.features.items()})
+
+
+class BatchScorer:
+    def __init__(self, candidates, weights, streams=None):
+        """
+        :param candidates: FeatureSet of the search set
+        :param weights: {<stream_type>: <weight>}, e.g. Hyperparameter.default_weights
+        :param streams: streams scored, default the streams of weights
+        """
+        self.candidates = candidates
+        self.weights = weights
+        self.streams = tuple(streams or weights)
+        # missing features count for nothing in the sums of similarities, and are left out of the averages
+        self._candidate_features = {stream: {split: _zero_missing(matrix) for split, matrix in
+                                             candidates.features.get(stream, {}).items()} for stream in self.streams}
+        self._candidate_present = {stream: {split: ~np.isnan(matrix[:, 0]) for split, matrix in
+                                            candidates.features.get(stream, {}).items()} for stream in self.streams}
+
+    def scores(self, references, candidate_slice=slice(None)):
+        """
+        :param references: FeatureSet of the reference clips, whose features are scaled into targets
+        :param candidate_slice: block of the candidates to score
+        :return: float32 array of scores, one row per candidate of the block and one column per reference.  A candidate
+                 without a split in common with a reference, in any stream, scores NaN.
+        """
+        return self._scores(self._targets(references), len(references), candidate_slice)
+
+    def _targets(self, references):
+        # { <stream type>: {<split #>: (targets of the references, True for the references with features)} }
+        targets = {}
+        for stream in self.streams:
+            targets[stream] = {}
+            for split, matrix in references.features.get(stream, {}).items():
+                if split in self._candidate_features[stream]:
+                    targets[stream][split] = (np.nan_to_num(scale_features(matrix)), ~np.isnan(matrix[:, 0]))
+        return targets
+
+    def _scores(self, targets, nreferences, candidate_slice):
+        ncandidates = len(range(len(self.candidates))[candidate_slice])
+        squared_error = np.zeros((ncandidates, nreferences), dtype=np.float32)
+        for stream in self.streams:
+            # similarities summed over the splits, then averaged over the splits both clips have
+            similarity_sum = np.zeros((ncandidates, nreferences), dtype=np.float32)
+            nsplits = np.zeros((ncandidates, nreferences), dtype=np.float32)
+            for split, (split_targets, present) in targets[stream].items():
+                similarity_sum += self._candidate_features[stream][split][candidate_slice] @ split_targets.T
+                nsplits += np.outer(self._candidate_present[stream][split][candidate_slice], present)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                similarity = similarity_sum / np.where(nsplits > 0, nsplits, np.nan)
+            squared_error += (self.weights[stream] * (1 - similarity)) ** 2
+        denominator = sum(self.weights[stream] ** 2 for stream in self.streams)
+        return 1 - np.sqrt(squared_error / denominator)
+
+    def rank(self, references, top_k=20, threshold=None, candidate_block=CANDIDATE_BLOCK):
+        """
+        :return: one (top, above) per reference: top is [(candidate position, score)] of the top_k highest scores,
+                 highest first, and above is [(candidate position, score)] of every score >= threshold, highest
+                 first, or None if threshold is None
+        """
+        nreferences = len(references)
+        top_positions = np.zeros((0, nreferences), dtype=np.int64)
+        top_scores = np.zeros((0, nreferences), dtype=np.float32)
+        above = [[] for __ in range(nreferences)]
+        targets = self._targets(references)
+        for start in range(0, len(self.candidates), candidate_block):
+            block = self._scores(targets, nreferences, slice(start, start + candidate_block))
+            block = np.where(np.isnan(block), -np.inf, block)
+            if threshold is not None:
+                for candidate, reference in zip(*np.nonzero(block >= threshold)):
+                    above[reference].append((start + int(candidate), float(block[candidate, reference])))
+            # best top_k of the block, merged with the best so far
+            k = min(top_k, block.shape[0])
+            best = np.argpartition(-block, k - 1, axis=0)[:k] if k < block.shape[0] else \
+                np.tile(np.arange(block.shape[0])[:, None], (1, nreferences))
+            top_positions = np.vstack([top_positions, best + start])
+            top_scores = np.vstack([top_scores, np.take_along_axis(block, best, axis=0)])
+            if top_positions.shape[0] > top_k:
+                keep = np.argpartition(-top_scores, top_k - 1, axis=0)[:top_k]
+                top_positions = np.take_along_axis(top_positions, keep, axis=0)
+                top_scores = np.take_along_axis(top_scores, keep, axis=0)
+
+        results = []
+        for reference in range(nreferences):
+            order = np.argsort(-top_scores[:, reference], kind='stable')
+            top = [(int(top_positions[k, reference]), float(top_scores[k, reference])) for k in order
+                   if np.isfinite(top_scores[k, reference])]
+            results.append((top, sorted(above[reference], key=lambda item: -item[1]) if threshold is not None
+                            else None))
+        return results
+
+
+def scale_features(matrix):
+    # each row scaled by its squared L2 norm, as TargetClip._scale_feature does for one feature
+    matrix = np.asarray(matrix, dtype=np.float32)
+    return matrix / np.einsum('ij,ij->i', matrix, matrix)[:, None]
+
+
+def _zero_missing(matrix):
+    # matrix with the NaN rows of missing features set to 0, copied only if it has any
+    return np.nan_to_num(matrix) if np.isnan(matrix[:, 0]).any() else matrix
@@ -0,0 +1,75 @@
+import unittest
+import numpy as np
+from batch_scoring import BatchScorer, FeatureSet, scale_features
+
+WEIGHTS = {'rgb': 1.0, 'warped_optical_flow': 1.5}
+
+
+class BatchScoringTest(unittest.TestCase):
+    """Tests for batch_scoring.py."""
+
+    def setUp(self):
+        self.random = np.random.RandomState(0)
+        self.keys = [('v{}'.format(clip // 10), clip % 10 + 1) for clip in range(50)]
+        blocks = [(self.keys, stream, split, self.random.rand(len(self.keys), 8).astype(np.float32))
+                  for stream in WEIGHTS for split in (1, 2, 3)]
+        # the last clips have no features for split 3
+        blocks[-1] = (self.keys[:45], 'warped_optical_flow', 3, blocks[-1][3][:45])
+        self.candidates = FeatureSet.from_blocks(blocks)
+        self.scorer = BatchScorer(self.candidates, WEIGHTS)
+
+    def _ticket_scores(self, reference):
+        # scores of Ticket.compute_similarities and compute_scores with the features of one reference as the target
+        target = {stream: {split: matrix[reference] / np.dot(matrix[reference], matrix[reference])
+                           for split, matrix in self.candidates.features[stream].items()
+                           if not np.isnan(matrix[reference][0])} for stream in WEIGHTS}
+        scores = []
+        for candidate in range(len(self.candidates)):
+            ssum = 0
+            for stream, w in WEIGHTS.items():
+                similarities = [np.dot(target_feature, self.candidates.features[stream][split][candidate])
+                                for split, target_feature in target[stream].items()
+                                if not np.isnan(self.candidates.features[stream][split][candidate][0])]
+                ssum += (w * (1 - sum(similarities) / len(similarities))) ** 2
+            scores.append(1 - np.sqrt(ssum / sum(w ** 2 for w in WEIGHTS.values())))
+        return np.array(scores)
+
+    def test_scale_features(self):
+        matrix = self.candidates.features['rgb'][1][:3]
+        for row, scaled in zip(matrix, scale_features(matrix)):
+            np.testing.assert_allclose(scaled, row / np.dot(row, row), rtol=1e-6)
+
+    def test_scores_match_ticket(self):
+        references = self.candidates.subset([0, 47])
+        scores = self.scorer.scores(references)
+        self.assertEqual(scores.shape, (50, 2))
+        np.testing.assert_allclose(scores[:, 0], self._ticket_scores(0), atol=1e-5)
+        np.testing.assert_allclose(scores[:, 1], self._ticket_scores(47), atol=1e-5)
+
+    def test_rank_in_blocks(self):
+        references = self.candidates.subset([3, 12, 47])
+        scores = self.scorer.scores(references)
+        threshold = float(np.median(scores))
+        results = self.scorer.rank(references, top_k=5, threshold=threshold, candidate_block=7)
+        for reference, (top, above) in enumerate(results):
+            expected = np.argsort(-scores[:, reference], kind='stable')[:5]
+            self.assertEqual([position for position, __ in top], expected.tolist())
+            self.assertEqual(sorted(position for position, __ in above),
+                             np.nonzero(scores[:, reference] >= threshold)[0].tolist())
+            self.assertEqual([score for __, score in above], sorted([score for __, score in above], reverse=True))
+
+    def test_missing_stream(self):
+        # a candidate without features of a stream is left out of the rankings
+        candidates = FeatureSet.from_blocks([(self.keys, 'rgb', 1, self.candidates.features['rgb'][1]),
+                                             (self.keys, 'warped_optical_flow', 1,
+                                              self.candidates.features['warped_optical_flow'][1]),
+                                             (self.keys[:1], 'rgb', 2, self.candidates.features['rgb'][2][:1])])
+        candidates.features['warped_optical_flow'][1][4] = np.nan
+        candidates.features['rgb'][1][4] = np.nan
+        top, __ = BatchScorer(candidates, WEIGHTS).rank(candidates.subset([0]), top_k=100)[0]
+        self.assertEqual(len(top), 49)
+        self.assertNotIn(4, [position for position, __ in top])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,13 @@
 Public API to algorithms logic chain
 """
 from models import Ticket, TargetClip
+from api.session import get_session
+from services.checkpoints import TicketCheckpoint
+from services.metrics import TicketTrace, span
+from services.profiling import max_rss, measure_ticket_memory, profile_ticket
+import logging
 import os
+import random
 
 
 def compute_matches(query_updates, hyperparameters):
@@ -29,52 +35,140 @@ def compute_matches(query_updates, hyperparameters):
             add new matches to API database
             for "finalize" query updates:
                 create final report
+
+    Returns the number of queries that were picked up for processing.
     """
     # Get info on any queries in the API repository that are waiting for an update
     updates_needed = query_updates.get_status()
 
-    # update queries marked as "new", "revised" or "finalize" in the API database
+    # update queries marked as "new", "revised" or "finalize" in the API database.
+    # Each update gets its own copy of the hyperparameters, since optimization changes weights and threshold.
+    nprocessed = 0
     for update_type, update_object in updates_needed.items():
         if update_object is None:
             continue
-        # Create a Ticket instance for the algorithm task to be done, and
-        # change process state to 3: in progress
-        ticket = Ticket(update_object, query_updates.url)
-        ticket.change_process_state(3)
+        nprocessed += 1
+        process_update(update_type, update_object, query_updates.url, hyperparameters.copy())
+    return nprocessed
+
+
+def process_update(update_type, update_object, api_url, hyperparameters, checkpoints=None, random_seed=None):
+    """
+    Compute new matches and scores for one query update, see compute_matches for the general logic.
+    :param update_type: "new", "revise" or "finalize"
+    :param update_object: query update from APIRepository, see Ticket for its contents
+    :param api_url: url of the Video Query API
+    :param hyperparameters: instance of Hyperparameter class, owned by this update.  Its weights and threshold
+                            are changed by optimization.
+    :param checkpoints: optional services.CheckpointStore.  Each completed stage is checkpointed, and a round that
+                        was interrupted resumes after its last completed stage.
+    :param random_seed: optional seed of the ticket's random numbers, combined with the query id, so a run can be
+                        reproduced whatever other tickets run at the same time.  None seeds from the system.
+    :return: summary of the ticket, see ticket_summary.  Its "spans" are the timing spans of the ticket's stages.
+
+    Tickets selected by the TICKET_PROFILE* environment variables are profiled, see services.profiling.
+    """
+    trace = TicketTrace(update_object["query_id"], update_type, get_session(api_url).bytes_received)
+    with trace, profile_ticket(trace), measure_ticket_memory() as measured:
+        summary = _process_stages(update_type, update_object, api_url, hyperparameters, checkpoints, random_seed)
+    summary["spans"] = trace.spans
+    # peak memory of the ticket, if it had the process to itself
+    summary["memory"].update(measured)
+    return summary
+
+
+def _process_stages(update_type, update_object, api_url, hyperparameters, checkpoints, random_seed):
+    if random_seed is None:
+        rng = random.Random()
+    else:
+        rng = random.Random('{}:{}'.format(random_seed, update_object["query_id"]))
+    # round number of the new query_result for this update
+    if update_type == 'new':
+        new_round = 1
+    else:
+        new_round = update_object["latest_query_result"]["round"] + 1
+    if checkpoints is not None:
+        checkpoint = checkpoints.round(update_object["query_id"], new_round)
+    else:
+        checkpoint = TicketCheckpoint(None, update_object["query_id"], new_round)
+    # a round handed back unstarted keeps the stages it completed, but not its 'claimed' stage
+    resuming = checkpoint.started()
+    if resuming:
+        logging.info('Resuming round {} of query {}'.format(new_round, update_object["query_id"]))
+    if 'claimed' not in checkpoint:
+        checkpoint.save('claimed', (update_type, update_object))
 
-        # Check for query errors.  Change process_state to 5 if there is an error in the query, and exit loop
-        # Add a message in notes if there is recovery from an error
+    # Create a Ticket instance for the algorithm task to be done, and
+    # change process state to 3: in progress, unless APIRepository.claim_pending already did
+    with span('ticket'):
+        ticket = Ticket(update_object, api_url)
+        if update_object.get("process_state") != 3:
+            ticket.change_process_state(3)
+            ticket.flush_writes()
+
+    # Check for query errors.  Change process_state to 5 if there is an error in the query, and stop
+    # Add a message in notes if there is recovery from an error
+    with span('catch_errors'):
         fatal_error_message, error_message = ticket.catch_errors(update_type)
-        if fatal_error_message:
-            ticket.change_process_state(5, message=fatal_error_message)
-            continue
-        if error_message:
-            ticket.add_note(error_message)
+    if fatal_error_message:
+        ticket.change_process_state(5, message=fatal_error_message)
+        ticket.flush_writes()
+        checkpoint.clear()
+        return ticket_summary(ticket, 'query_error')
+    if error_message and not resuming:
+        ticket.add_note(error_message)
 
-        # Get the feature dictionary for the target: { <stream type>: {<split #>: [<target feature>], ...} }
-        ticket.target = TargetClip(ticket, hyperparameters)
-        ticket.target.get_target_features()
-        # compute similarities with all clips in the search set
+    # Get the feature dictionary for the target: { <stream type>: {<split #>: [<target feature>], ...} }
+    with span('target_features', resumed='target' in checkpoint):
+        ref_clip_features = checkpoint.get('ref_features')
+        ticket.target = TargetClip(ticket, hyperparameters, ref_clip_features=ref_clip_features, rng=rng)
+        if ref_clip_features is None:
+            checkpoint.save('ref_features', ticket.target.ref_clip_features)
+        if 'target' in checkpoint:
+            ticket.target.target_features = checkpoint.get('target')
+        else:
+            ticket.target.get_target_features()
+            checkpoint.save('target', ticket.target.target_features)
+
+    # compute similarities with all clips in the search set.  Ticket times the feature fetch and the similarities.
+    if 'similarities' in checkpoint:
+        ticket.similarities = checkpoint.get('similarities')
+    else:
         ticket.compute_similarities(hyperparameters)
+        checkpoint.save('similarities', ticket.similarities)
 
-        # for revise and finalize jobs, update weights and threshold based on current matches
+    # for revise and finalize jobs, update weights and threshold based on current matches
+    if 'hyperparameters' in checkpoint:
+        hyperparameters.weights, hyperparameters.threshold = checkpoint.get('hyperparameters')
+    else:
         if (update_type == "new") or not update_object["matches"]:
             hyperparameters.weights = hyperparameters.default_weights
             hyperparameters.threshold = hyperparameters.default_threshold
         elif update_type == "revise" or update_type == "finalize":
-            hyperparameters.optimize_weights(ticket)
+            with span('optimize_weights', labeled_count=len(ticket.user_matches)):
+                hyperparameters.optimize_weights(ticket)
         else:
             raise Exception('update type is invalid')
+        checkpoint.save('hyperparameters', (hyperparameters.weights, hyperparameters.threshold))
 
-        # pack new information into a new query_result database entity
-        if update_type == 'new':
-            new_round = 1
-        else:
-            new_round = ticket.latest_query_result["round"] + 1
-        new_result_id = ticket.create_query_result(new_round, hyperparameters)
+    # pack new information into a new query_result database entity.  When resuming, reuse the query_result
+    # created before the interruption, so it is not duplicated.
+    with span('query_result', round=new_round):
+        new_result_id = checkpoint.get('query_result')
+        if new_result_id is None and resuming:
+            new_result_id = ticket.find_query_result(new_round)
+        if new_result_id is None:
+            new_result_id = ticket.create_query_result(new_round, hyperparameters)
+        checkpoint.save('query_result', new_result_id)
+        ticket.flush_writes()
 
-        # compute scores and determine new set of matches (for the next round or final report)
-        ticket.compute_scores(hyperparameters.weights)
+    # compute scores and determine new set of matches (for the next round or final report).
+    # The selection is random, so a resumed round uses the selection made before the interruption.
+    if 'selected' in checkpoint:
+        ticket.matches = checkpoint.get('selected')
+    else:
+        with span('scoring', search_set_size=len(ticket.similarities)):
+            ticket.compute_scores(hyperparameters.weights)
         if update_type == "finalize":
             max_number_matches = float("inf")  # add all matches to final report
             # near_miss = 0  # do not add any near misses to final report
@@ -86,29 +180,55 @@ def compute_matches(query_updates, hyperparameters):
         else:
             max_number_matches = ticket.number_of_matches_to_review
             near_miss = hyperparameters.near_miss_default
-        ticket.select_clips_to_review(hyperparameters.threshold, max_number_matches, near_miss)
+        with span('selection') as attributes:
+            ticket.select_clips_to_review(hyperparameters.threshold, max_number_matches, near_miss, rng)
+            attributes["selected"] = len(ticket.matches)
+        checkpoint.save('selected', ticket.matches)
 
-        # catch errors that results in no matches being returned
-        if not ticket.matches:
-            catch_no_matches_error(ticket)
-            continue
+    # catch errors that results in no matches being returned
+    if not ticket.matches:
+        catch_no_matches_error(ticket)
+        checkpoint.clear()
+        return ticket_summary(ticket, 'no_matches')
 
-        # add new match entities to database
-        ticket.add_matches_to_database(new_result_id)
+    # add new match entities to database, skipping any written before an interruption
+    if 'matches_written' not in checkpoint:
+        with span('match_writes', matches=len(ticket.matches)):
+            skip_clips = ticket.existing_match_clips(new_result_id) if resuming else set()
+            ticket.add_matches_to_database(new_result_id, skip_clips)
+            ticket.flush_writes()
+        checkpoint.save('matches_written', True)
 
-        # Create a final report if update_type = "finalize" and change process_state to 7: Finalized
-        # Otherwise, Change process_state to 4: Processed (for all jobs that are not finalize jobs)
-        # TODO: Add email notification to user
-        if update_type == "finalize":
+    # Create a final report if update_type = "finalize" and change process_state to 7: Finalized
+    # Otherwise, Change process_state to 4: Processed (for all jobs that are not finalize jobs)
+    # TODO: Add email notification to user
+    if update_type == "finalize":
+        with span('final_report', matches=len(ticket.matches)):
             ticket.create_final_report(hyperparameters, new_result_id)
-            ticket.change_process_state(7)
-            continue
-        else:
-            ticket.change_process_state(4)
+        ticket.change_process_state(7)
+    else:
+        ticket.change_process_state(4)
+    ticket.flush_writes()
+    checkpoint.clear()
+    return ticket_summary(ticket, 'finalized' if update_type == "finalize" else 'processed')
 
 
 def catch_no_matches_error(ticket):
     mround = ticket.latest_query_result["round"] if ticket.latest_query_result else 1
     error_message = "*** Error: No matches were found for round {} of query {}! ***".format(mround, ticket.query_id)
     ticket.change_process_state(5, message=error_message)
+    ticket.flush_writes()
     return
+
+
+def ticket_summary(ticket, outcome):
+    # small, picklable description of a processed ticket for the broker's scheduling and monitoring
+    return {
+        "query_id": ticket.query_id,
+        "search_set": ticket.search_set,
+        "search_set_size": len(ticket.similarities),
+        "outcome": outcome,
+        # data held by the ticket, to learn the search set's feature sizes, and the peak RSS of the whole process so
+        # far, which is shared by every ticket the process ran and is only reported
+        "memory": dict(ticket.candidate_stats, process_max_rss_bytes=max_rss()),
+    }
@@ -1,18 +1,96 @@
+import os
+import random
+import sqlite3
+import sys
+import tempfile
 import unittest
+from unittest import mock
+
+# compute_matches imports the api and services packages, and the test runs against the API stand-in
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("COMPUTE_EPS", "0.000003")
+os.environ.setdefault("API_CLIENT_USERNAME", "u")
+os.environ.setdefault("API_CLIENT_PASSWORD", "p")
+os.environ["API_SCHEMA_CACHE_DIR"] = tempfile.mkdtemp()
+from api.api_repository import APIRepository  # noqa: E402
+from benchmarks.api_standin import StandinServer, StandinStore  # noqa: E402
+from benchmarks.kernels import benchmark_hyperparameters  # noqa: E402
+from benchmarks.synthetic import FeatureStatistics, SyntheticSearchSet  # noqa: E402
+from models.compute_matches import process_update  # noqa: E402
+from services import CheckpointStore, TicketCheckpoint  # noqa: E402
 
 
 class ComputeMatchesTest(unittest.TestCase):
     """Tests for compute_matches.py."""
 
     def setUp(self):
-        pass
+        self.directory = tempfile.TemporaryDirectory()
+        self.store, self.server, self.query_id = self._standin()
+        self.repository = APIRepository(self.server.url)
 
     def tearDown(self):
-        pass
+        self.server.stop()
+        self.directory.cleanup()
 
     def test_true(self):
         self.assertTrue(True)
 
+    def test_released_round_writes_no_duplicates(self):
+        path = os.path.join(self.directory.name, 'checkpoints.sqlite')
+        checkpoints = CheckpointStore(path)
+        (update_type, update_object), = self.repository.claim_pending(1)
+        # the round stops after its query result and some of its matches were written
+        with mock.patch.object(TicketCheckpoint, 'clear'):
+            process_update(update_type, update_object, self.server.url, benchmark_hyperparameters(), checkpoints)
+        matches = self._count("matches")
+        self.assertGreater(matches, 0)
+        connection = sqlite3.connect(path)
+        with connection:
+            connection.execute("DELETE FROM checkpoints WHERE stage = 'matches_written'")
+        connection.close()
+        # the round is handed back, then claimed and processed again
+        self.repository.release([(update_type, update_object)])
+        checkpoints.release(self.query_id)
+        (update_type, update_object), = self.repository.claim_pending(1)
+        process_update(update_type, update_object, self.server.url, benchmark_hyperparameters(), checkpoints)
+        self.assertEqual(self._count("query-results"), 1)
+        self.assertEqual(self._count("matches"), matches)
+        self.assertEqual(checkpoints.incomplete(), [])
+
+    def test_claimed_query_set_in_progress_once(self):
+        (update_type, update_object), = self.repository.claim_pending(1)
+        process_update(update_type, update_object, self.server.url, benchmark_hyperparameters())
+        # set in progress by the claim, then processed
+        self.assertEqual(self.server.request_counts["queries/partial_update"], 2)
+
+    def test_seeded_run_reproducible(self):
+        selections = []
+        for other_seed in (1, 2):
+            # the query has the same id in each stand-in
+            store, server, __ = self._standin()
+            try:
+                (update_type, update_object), = APIRepository(server.url).claim_pending(1)
+                # random numbers drawn elsewhere in the process do not change the ticket's selection
+                random.seed(other_seed)
+                process_update(update_type, update_object, server.url, benchmark_hyperparameters(), random_seed=5)
+                selections.append(sorted(match["video_clip"] for match in store.list("matches")["results"]))
+            finally:
+                server.stop()
+        self.assertEqual(selections[0], selections[1])
+
+    @staticmethod
+    def _standin():
+        # stand-in server with a synthetic search set and one new query
+        store = StandinStore()
+        video, search_set, __ = store.seed_synthetic(SyntheticSearchSet(FeatureStatistics.default(dimension=16), 40))
+        query_id = store.create_query('q', video, '0:00:00', search_set, max_matches_for_review=5)["id"]
+        server = StandinServer(store)
+        server.start()
+        return store, server, query_id
+
+    def _count(self, resource):
+        return self.store.list(resource)["pagination"]["count"]
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,4 +1,5 @@
 import numpy as np
+import copy
 import os
 import logging
 
@@ -26,6 +27,11 @@ class Hyperparameter:
         self.nbags = nbags
         # TODO: add code to check if hyperparameters are in an allowable range, e.g. 0<f_bootstrap<=1
 
+    def copy(self):
+        # independent copy, e.g. for one ticket, whose weights and threshold can be optimized without
+        # affecting other tickets
+        return copy.deepcopy(self)
+
     def optimize_weights(self, ticket):
         """
         Conditions:
@@ -1,22 +1,31 @@
-from requests import ConnectionError
+from api.async_client import get_async_client
 import numpy as np
-from time import sleep
 import random
-import logging
 
 
 class TargetClip:
-    def __init__(self, ticket, hyperparameters):
+    def __init__(self, ticket, hyperparameters, ref_clip_features=None, rng=None):
         """
         :param ticket: ticket instance of Ticket class
         :param hyperparameters: instance of class Hyperparameter, hyperparameters for deep learning ensemble
+        :param ref_clip_features: features of the reference clip, if already known, in the format
+                                  { <stream type>: {<split #>:[<feature>], ...} }.  Otherwise they are requested.
+        :param rng: random.Random instance of the ticket, for the bootstrap samples.  None uses the random module.
         """
+        self.rng = rng or random
+        self.session = ticket.session
+        self.deadline = ticket.deadline
         self.client = ticket.client
         self.schema = ticket.schema
+        self.async_client = get_async_client(ticket.session.url)
         self.bootstrap_target = ticket.dynamic_target_adjustment
         self.latest_query_result = ticket.latest_query_result
         self.hyperparameters = hyperparameters
-        self.ref_clip_features, self.splits = self._get_clip_features(ticket.ref_clip_id)
+        if ref_clip_features is None:
+            self.ref_clip_features, self.splits = self._get_clip_features(ticket.ref_clip_id)
+        else:
+            self.ref_clip_features = ref_clip_features
+            self.splits = set(split for split_features in ref_clip_features.values() for split in split_features)
         self.previous_target_features = None
         self.target_features = {}
         if ticket.latest_query_result:
@@ -114,24 +123,22 @@ class TargetClip:
         :return: list of features for all matches where user_match=user_match_value, and all splits encountered
         """
         # Interact with the API endpoint to get matches for the query
-        page = 1
-        matches = []
-        while page is not None:
-            action = ["matches", "list"]
-            params = {"query_result": self.latest_query_result["id"], "page": page}
-            results = self._request(action, params)
-            matches.extend(results["results"])
-            page = results["pagination"]["nextPage"]
+        action = ["matches", "list"]
+        params = {"query_result": self.latest_query_result["id"]}
+        matches = self.async_client.run_list_pages(action, params, deadline=self.deadline)
         # Load features for matches where user_match equals user_match_value into a list of feature dictionaries:
-        # [<features dictionary 1>, ...]
+        # [<features dictionary 1>, ...].  Features of all these clips are requested concurrently.
+        clip_ids = [match["video_clip"] for match in matches if match["user_match"] is user_match_value]
+        action = ["video-clips", "features"]
+        feature_lists = self.async_client.run_gather([(action, {"id": clip_id}) for clip_id in clip_ids],
+                                                     deadline=self.deadline)
         matches_features = []
         splits_matches = set()
-        for match in matches:
-            if match["user_match"] is user_match_value:
-                match_features, match_splits = self._get_clip_features(match["video_clip"])
-                matches_features.append(match_features)
-                # splits_matches is a set, so elements are added only if not already in splits
-                splits_matches.update(match_splits)
+        for feature_dictionaries_as_a_list in feature_lists:
+            match_features, match_splits = self._parse_clip_features(feature_dictionaries_as_a_list)
+            matches_features.append(match_features)
+            # splits_matches is a set, so elements are added only if not already in splits
+            splits_matches.update(match_splits)
         return matches_features, splits_matches
 
     def scaled_ref_clip_features(self):
@@ -265,15 +272,21 @@ class TargetClip:
         :param clip_id: primary key of the video clup
         :return: Clip features dictionaries with entries { <stream type>: {<split #>:[<feature>], ...} }
         """
-        results = {}
-        splits = set()
-        for stream_type in self.hyperparameters.streams:
-            results[stream_type] = {}
-
         # Interact with the API endpoint to get features for the video clip
         action = ["video-clips", "features"]
         params = {"id": clip_id}
         feature_dictionaries_as_a_list = self._request(action, params)
+        return self._parse_clip_features(feature_dictionaries_as_a_list)
+
+    def _parse_clip_features(self, feature_dictionaries_as_a_list):
+        """
+        :param feature_dictionaries_as_a_list: response of the video-clips/features API action for one clip
+        :return: Clip features dictionaries with entries { <stream type>: {<split #>:[<feature>], ...} }
+        """
+        results = {}
+        splits = set()
+        for stream_type in self.hyperparameters.streams:
+            results[stream_type] = {}
 
         # fill in the feature dictionary for the clip with feature vectors from API feature_dictionaries_as_a_list
         for feature_object in feature_dictionaries_as_a_list:
@@ -286,25 +299,18 @@ class TargetClip:
         return results, splits
 
     def _request(self, action, params):
-        while True:
-            try:
-                return self.client.action(self.schema, action, params=params)
-            except ConnectionError:
-                sleep(0.05)
-                msg = 'Try API request by Target again: action = {}, params = {}'.format(action, params)
-                logging.warning(msg)
+        return self.session.request(action, params, deadline=self.deadline)
 
-    @staticmethod
-    def _random_fraction(flist, fraction, replacement):
+    def _random_fraction(self, flist, fraction, replacement):
         # select a random list of items from flist, with fraction set by self.hyperparameters.f_bootstrap
         # select either with or without replacement
         nmatches = len(flist)
         tmatches = round(nmatches * fraction)
         tmatches = max(tmatches, 1)  # make sure at least one item is selected
         if replacement is False:
-            tsamples = random.sample(range(nmatches), tmatches)
+            tsamples = self.rng.sample(range(nmatches), tmatches)
         else:
-            tsamples = random.choices(range(nmatches), k=tmatches)
+            tsamples = self.rng.choices(range(nmatches), k=tmatches)
         tsamples = list(set(tsamples))  # list of unique values
         return [flist[m] for m in tsamples]
 
@@ -1,16 +1,21 @@
 """Make requests for Queries based on processing state
 """
-from api.authenticate import authenticate
-from requests import ConnectionError
-import coreapi
-import os
+from api.session import get_session
+from api.target_encoding import encode_target
+from api.write_behind_queue import WriteBehindQueue
+from coreapi.utils import File
+from services.metrics import span
+import io
 import csv
 from datetime import datetime, timedelta
 import numpy as np
 import random
-from time import sleep
-import logging
-import json
+import time
+
+# number of matched clips whose metadata is requested together when writing a final report
+REPORT_PAGE_SIZE = 200
+# seconds within which all API requests for a ticket must succeed, including retries
+TICKET_DEADLINE = 3600.0
 
 
 class Ticket:   # base_url is the api url.  The default is the dev default.
@@ -33,8 +38,11 @@ class Ticket:   # base_url is the api url.  The default is the dev default.
         }
         :param api_url is the url for the Video Query API
         """
-        self.client = coreapi.Client(auth=authenticate(api_url))
-        self.schema = self.client.get(os.path.join(api_url, "docs"))
+        # the authenticated session and parsed API schema are shared by all tickets for api_url
+        self.session = get_session(api_url)
+        self.deadline = time.time() + TICKET_DEADLINE
+        self.client = self.session.client
+        self.schema = self.session.schema
         self.query_id = update_object["query_id"]
         self.video_id = update_object["video_id"]
         self.ref_clip = update_object["ref_clip"]
@@ -54,28 +62,22 @@ class Ticket:   # base_url is the api url.  The default is the dev default.
             self.user_matches = {}
         self.target = None
         self.similarities = {}
+        self.candidate_stats = {}
         self.scores = {}
+        # process state changes, notes and match creates are held here until the next call of flush_writes()
+        self.writes = WriteBehindQueue(self._request, self.query_id)
 
-    def add_matches_to_database(self, new_result_id):
+    def add_matches_to_database(self, new_result_id, skip_clips=()):
+        # skip_clips: video clips that already have a match for new_result_id, e.g. when resuming a round
         for video_clip, score in self.matches.items():
+            if video_clip in skip_clips:
+                continue
             user_match = self.user_matches.get(str(video_clip))
             self.create_match(new_result_id, score, user_match, video_clip)
 
     def add_note(self, note):
-        # Get current notes by interacting with API
-        action = ["queries", "read"]
-        params = {"id": self.query_id}
-        result = self._request(action, params)
-        # add note to current notes
-        if result["notes"]:
-            new_notes = result["notes"] + '\n\n' + note
-        else:
-            # TODO: test that this works, or whether above should be changed to if "notes" in result
-            new_notes = note
-        # update query object with new notes
-        action = ["queries", "partial_update"]
-        params = {"id": self.query_id, "notes": new_notes}
-        self._request(action, params)
+        # the note is appended to the current notes of the query at the next flush_writes()
+        self.writes.add_note(note)
 
     def catch_errors(self, job_type):
         # catch errors, create error messages, and create corrections if possible
@@ -110,12 +112,11 @@ class Ticket:   # base_url is the api url.  The default is the dev default.
         return fatal_error_message, error_message
 
     def change_process_state(self, process_state, message=None):
-        action = ["queries", "partial_update"]
-        params = {"id": self.query_id, "process_state": process_state}
-        result = self._request(action, params)
+        # the new state is sent, merged with any notes, at the next flush_writes()
+        self.writes.update_query(process_state=process_state)
         if message:
             self.add_note(message)
-        return result["process_state"]
+        return process_state
 
     def compute_similarities(self, hyperparameters):
         """
@@ -139,28 +140,15 @@ class Ticket:   # base_url is the api url.  The default is the dev default.
         """
         # Get the feature dictionary for all video clips (in the search set of interest).
         # Dictionary structure is { <stream type>: {<split #>: { clip#: [<candidate feature>], ...} } }
-        candidates = self._get_candidate_features(self.target.splits, hyperparameters)
+        with span('candidate_features', search_set=self.search_set) as attributes:
+            candidates = self._get_candidate_features(self.target.splits, hyperparameters)
+            self.candidate_stats = self._candidate_stats(candidates)
+            attributes.update(self.candidate_stats)
 
         # compute similarities and ensemble average them over the splits
-        avgd_similarities = {}  # type: dict
-        for stream_type, all_splits in self.target.target_features.items():
-            similarities = {}  # type: dict
-            # compute dot product similarities{} for each split, saved as key:value = clip:array of similarities
-            for split, target_feature in all_splits.items():
-                for clip, candidate_feature in candidates[stream_type][split].items():
-                    similarity = np.dot(target_feature, candidate_feature)
-                    similarities[clip] = similarities.get(clip, []) + [similarity]
-
-            # ensemble average over the splits for each id
-            for clip_id, sim_array in similarities.items():
-                id_len = len(sim_array)
-                avg_sim_this_stream = sum(sim_array) / id_len
-                # create dictionary item in avgd_similarities for clip_id if it does not exist, and add result:
-                avgd_similarities[clip_id] = avgd_similarities.get(clip_id, {})
-                avgd_similarities[clip_id].update({stream_type: [avg_sim_this_stream, id_len]})
-
-        # update Ticket similarities
-        self.similarities = avgd_similarities
+        with span('similarities') as attributes:
+            self.similarities = self._average_similarities(candidates)
+            attributes["search_set_size"] = len(self.similarities)
 
     def compute_scores(self, weights):
         """
@@ -198,51 +186,53 @@ class Ticket:   # base_url is the api url.  The default is the dev default.
         params = {"id": query["search_set_to_query"]}
         search_set = self._request(action, params)
 
-    # create final report that contains scores of all matches
+        # create final report that contains scores of all matches.  The report is built in memory and
+        # uploaded directly, rather than written to disk and read back.
         file_name = 'final_report_query_{}_{}.csv'.format(query["name"], datetime.now().strftime('%m-%d-%Y_%Hh%Mm%Ss'))
-        file = os.path.join('../final_reports/', file_name)
-        if not os.path.exists('../final_reports/'):
-            os.makedirs('../final_reports/')
-
-        # write the csv file
-        with open(file, 'x', newline='') as csvfile:
-            reportwriter = csv.writer(csvfile)
-            # header information
-            reportwriter.writerow(['Query:', query["name"], 'Query pk:', self.query_id])
-            reportwriter.writerow(['Search Set queried:', search_set["name"], 'Search set pk:', search_set["id"]])
-            reportwriter.writerow(['Reference Video:', video["name"], 'Video pk:', self.video_id])
-            reportwriter.writerow(['Reference time:', query["reference_time"]])
-            reportwriter.writerow(['number of reviews:', number_of_reviews])
-            reportwriter.writerow(['min score for a match:', query_result["match_criterion"]])
-            reportwriter.writerow(["max matches to review:", query["max_matches_for_review"]])
-            reportwriter.writerow(['streams:', str(hyperparameters.streams)])
-            reportwriter.writerow(['stream weights:', str(query_result["weights"])])
-            reportwriter.writerow(['Target bootstrapping:', query["use_dynamic_target_adjustment"]])
-            reportwriter.writerow(['query notes:', query["notes"]])
-            reportwriter.writerow(['Hyperparameters:'])
-            reportwriter.writerow(['', 'default weights:', str(hyperparameters.default_weights)])
-            reportwriter.writerow(['', 'default threshold:', str(hyperparameters.default_threshold)])
-            reportwriter.writerow(['', 'near miss default:', str(hyperparameters.near_miss_default)])
-            reportwriter.writerow(['', 'feature name:', str(hyperparameters.feature_name)])
-            reportwriter.writerow(['', 'ballast:', str(hyperparameters.ballast)])
-            reportwriter.writerow(['', 'mu:', str(hyperparameters.mu)])
-            reportwriter.writerow(['', 'f_bootstrap:', str(hyperparameters.f_bootstrap)])
-            reportwriter.writerow(['', 'f_memory:', str(hyperparameters.f_memory)])
-            reportwriter.writerow(['', 'bootstrap type:', str(hyperparameters.bootstrap_type)])
-            if hyperparameters.bootstrap_type == "bagging":
-                reportwriter.writerow(['', 'number of bags:', str(hyperparameters.nbags)])
-            reportwriter.writerow([''])
-            # write out a row for each video clip that is a selected match
-            reportwriter.writerow(['List of all clips with scores greater than min(threshold, score of lowest scoring'
-                                   ' user validated match)'])
-            reportwriter.writerow(['clip #', 'start time', 'match type', 'video pk', 'video clip id', 'score',
-                                   'duration', 'notes'])
-            clip_rows = []
-            for video_clip_id, score in self.matches.items():
-                # add a row for each match that is in the set of self.matches.
-                # This set includes matches either above the threshold score or explicitly scored
-                # by the user in this round, when compute_matches set
-                # max_number_matches = float("inf")  and near_miss = 0 before selecting matches for finalization.
+        report = io.StringIO(newline='')
+        reportwriter = csv.writer(report)
+        # header information
+        reportwriter.writerow(['Query:', query["name"], 'Query pk:', self.query_id])
+        reportwriter.writerow(['Search Set queried:', search_set["name"], 'Search set pk:', search_set["id"]])
+        reportwriter.writerow(['Reference Video:', video["name"], 'Video pk:', self.video_id])
+        reportwriter.writerow(['Reference time:', query["reference_time"]])
+        reportwriter.writerow(['number of reviews:', number_of_reviews])
+        reportwriter.writerow(['min score for a match:', query_result["match_criterion"]])
+        reportwriter.writerow(["max matches to review:", query["max_matches_for_review"]])
+        reportwriter.writerow(['streams:', str(hyperparameters.streams)])
+        reportwriter.writerow(['stream weights:', str(query_result["weights"])])
+        reportwriter.writerow(['Target bootstrapping:', query["use_dynamic_target_adjustment"]])
+        reportwriter.writerow(['query notes:', query["notes"]])
+        reportwriter.writerow(['Hyperparameters:'])
+        reportwriter.writerow(['', 'default weights:', str(hyperparameters.default_weights)])
+        reportwriter.writerow(['', 'default threshold:', str(hyperparameters.default_threshold)])
+        reportwriter.writerow(['', 'near miss default:', str(hyperparameters.near_miss_default)])
+        reportwriter.writerow(['', 'feature name:', str(hyperparameters.feature_name)])
+        reportwriter.writerow(['', 'ballast:', str(hyperparameters.ballast)])
+        reportwriter.writerow(['', 'mu:', str(hyperparameters.mu)])
+        reportwriter.writerow(['', 'f_bootstrap:', str(hyperparameters.f_bootstrap)])
+        reportwriter.writerow(['', 'f_memory:', str(hyperparameters.f_memory)])
+        reportwriter.writerow(['', 'bootstrap type:', str(hyperparameters.bootstrap_type)])
+        if hyperparameters.bootstrap_type == "bagging":
+            reportwriter.writerow(['', 'number of bags:', str(hyperparameters.nbags)])
+        reportwriter.writerow([''])
+        # write out a row for each video clip that is a selected match
+        reportwriter.writerow(['List of all clips with scores greater than min(threshold, score of lowest scoring'
+                               ' user validated match)'])
+        reportwriter.writerow(['clip #', 'start time', 'match type', 'video pk', 'video clip id', 'score',
+                               'duration', 'notes'])
+
+        # Add a row for each match that is in the set of self.matches.
+        # This set includes matches either above the threshold score or explicitly scored
+        # by the user in this round, when compute_matches set
+        # max_number_matches = float("inf")  and near_miss = 0 before selecting matches for finalization.
+        # Matches are ranked by score before any clip metadata is requested, so rows can be written out
+        # page by page, in final order, as soon as the metadata for each page arrives.
+        ranked_matches = sorted(self.matches.items(), key=lambda item: item[1], reverse=True)
+        for page_start in range(0, len(ranked_matches), REPORT_PAGE_SIZE):
+            page = ranked_matches[page_start:page_start + REPORT_PAGE_SIZE]
+            video_clips = self._get_video_clips([video_clip_id for video_clip_id, __ in page])
+            for video_clip_id, score in page:
                 if str(video_clip_id) in self.user_matches:
                     if self.user_matches[str(video_clip_id)] is True:
                         match_type = "user-identified match"
@@ -253,25 +243,17 @@ class Ticket:   # base_url is the api url.  The default is the dev default.
                 else:
                     match_type = "inferred non-match"
 
-                action = ["video-clips", "read"]
-                params = {"id": video_clip_id}
-                video_clip = self._request(action, params)
-                action = ["matches", "list"]
-                params = {"query_result": query_result_id, "video_clip": video_clip_id}
-                match = self._request(action, params)
-                start_time = int(match["results"][0]["match_video_time_span"].split(",")[0])
-                stime = str(timedelta(seconds=start_time))
-                clip_rows.append([video_clip['clip'], stime, match_type, video_clip['video'], video_clip_id, score,
-                                  video_clip['duration'], video_clip['notes']])
-            clip_rows.sort(key=lambda x: x[5], reverse=True)
-            for row in clip_rows:
-                reportwriter.writerow(row)
-
-        with open(file, 'r') as csvfile:
-            # write final report to API
-            action = ["queries", "partial_update"]
-            params = {"id": self.query_id, "final_report_file": csvfile}
-            self._post_file(action, params)
+                # clip n of a video starts at n * clip duration
+                video_clip = video_clips[video_clip_id]
+                stime = str(timedelta(seconds=int(video_clip['clip'] * video_clip['duration'])))
+                reportwriter.writerow([video_clip['clip'], stime, match_type, video_clip['video'], video_clip_id,
+                                       score, video_clip['duration'], video_clip['notes']])
+
+        # write final report to API
+        action = ["queries", "partial_update"]
+        params = {"id": self.query_id,
+                  "final_report_file": File(file_name, report.getvalue().encode('utf-8'), 'text/csv')}
+        self._post_file(action, params)
 
     def create_match(self, qresult, score, user_match, video_clip):
         action = ["matches", "create"]
@@ -281,7 +263,7 @@ class Ticket:   # base_url is the api url.  The default is the dev default.
             "user_match": user_match,
             "video_clip": video_clip,
         }
-        self._request(action, params)
+        self.writes.submit(action, params)
 
     def create_query_result(self, nround, hyperparameters):
         # Make list out of dictionary of weights, in the order specified by streams
@@ -293,11 +275,42 @@ class Ticket:   # base_url is the api url.  The default is the dev default.
             "match_criterion": hyperparameters.threshold,
             "weights": weights_values,
             "query": self.query_id,
-            "bootstrapped_target": json.dumps(self.target.target_features)
+            "bootstrapped_target": encode_target(self.target.target_features)
         }
         result = self._request(action, params)
         return result["id"]
 
+    def existing_match_clips(self, query_result_id):
+        # video clips that already have a match for query_result_id
+        page = 1
+        video_clips = set()
+        while page is not None:
+            action = ["matches", "list"]
+            params = {"query_result": query_result_id, "page": page}
+            results = self._request(action, params)
+            video_clips.update(match["video_clip"] for match in results["results"])
+            page = results["pagination"]["nextPage"]
+        return video_clips
+
+    def find_query_result(self, nround):
+        """
+        :return: id of the query result already created for round nround of this query, or None.
+                 None is also returned if the API cannot filter query results by round.
+        """
+        if not self._has_filter(["query-results", "list"], "round"):
+            return None
+        action = ["query-results", "list"]
+        params = {"query": self.query_id, "round": nround}
+        results = self._request(action, params)
+        return results["results"][0]["id"] if results["results"] else None
+
+    def flush_writes(self):
+        """
+        Commit point for the writes held by the ticket: waits for match creates, then sends pending
+        process state changes and notes to the API as one partial update of the query.
+        """
+        return self.writes.flush()
+
     def lowest_scoring_user_match(self):
         min_score = 1
         min_clip = None
@@ -308,7 +321,7 @@ class Ticket:   # base_url is the api url.  The default is the dev default.
                     min_clip = clip
         return min_score, min_clip
 
-    def select_clips_to_review(self, threshold=0.8, max_number_matches=20, near_miss=0.5):
+    def select_clips_to_review(self, threshold=0.8, max_number_matches=20, near_miss=0.5, rng=None):
         """
         Find matches and near matches for review,
         half being above threshold and half for 1-(1+near_miss)*(1-threshold) < score < threshold.
@@ -321,7 +334,9 @@ class Ticket:   # base_url is the api url.  The default is the dev default.
         :param threshold: real threshold, either the initial default or a new threshold_optimum from optimize_weights
         :param max_number_matches:  max number of matches the user wants to review.
         :param near_miss:  range of scores for near misses relative to the range (1-threshold) for hits
+        :param rng: random.Random instance of the ticket, for the selection.  None uses the random module.
         """
+        rng = rng or random
         lower_limit = threshold - near_miss * (1 - threshold)
         match_candidates = {k: v for k, v in self.scores.items() if v >= threshold}
         near_match_candidates = {k: v for k, v in self.scores.items() if lower_limit <= v < threshold}
@@ -330,7 +345,8 @@ class Ticket:   # base_url is the api url.  The default is the dev default.
         # Note: if the number of candidates is fewer than the user defined max, use all candidates
         mscores = min(max_number_matches / 2, len(match_candidates)).__int__()
         m_near_scores = min(max_number_matches - mscores, len(near_match_candidates)).__int__()
-        match_scores = random.sample(match_candidates.items(), mscores)
+        # random.sample needs a sequence; the list has the same order as the items, so seeded runs are unchanged
+        match_scores = rng.sample(list(match_candidates.items()), mscores)
         # hold back one slot for the near miss with highest score
         near_match_max = {}
         if m_near_scores > 0:
@@ -338,7 +354,7 @@ class Ticket:   # base_url is the api url.  The default is the dev default.
             near_match_max_key = max(near_match_candidates, key=lambda key: near_match_candidates[key])
             near_match_max = {near_match_max_key: self.scores[near_match_max_key]}
             near_match_candidates.pop(near_match_max_key)
-        near_match_scores = random.sample(near_match_candidates.items(), m_near_scores)
+        near_match_scores = rng.sample(list(near_match_candidates.items()), m_near_scores)
         # create dictionary with the random sampling of matches and near matches
         self.matches = dict(match_scores + near_match_scores)
         self.matches.update(near_match_max)
@@ -355,6 +371,43 @@ class Ticket:   # base_url is the api url.  The default is the dev default.
                     previous_user_evals.update({int(clip): self.scores[int(clip)]})
         self.matches.update(previous_user_evals)
 
+    def _average_similarities(self, candidates):
+        # { video_clip_id: {stream_type: [<avg similarity>, <number of items in ensemble>]} }, see compute_similarities
+        avgd_similarities = {}  # type: dict
+        for stream_type, all_splits in self.target.target_features.items():
+            similarities = {}  # type: dict
+            # compute dot product similarities{} for each split, saved as key:value = clip:array of similarities
+            for split, target_feature in all_splits.items():
+                for clip, candidate_feature in candidates[stream_type][split].items():
+                    similarity = np.dot(target_feature, candidate_feature)
+                    similarities[clip] = similarities.get(clip, []) + [similarity]
+
+            # ensemble average over the splits for each id
+            for clip_id, sim_array in similarities.items():
+                id_len = len(sim_array)
+                avg_sim_this_stream = sum(sim_array) / id_len
+                # create dictionary item in avgd_similarities for clip_id if it does not exist, and add result:
+                avgd_similarities[clip_id] = avgd_similarities.get(clip_id, {})
+                avgd_similarities[clip_id].update({stream_type: [avg_sim_this_stream, id_len]})
+        return avgd_similarities
+
+    @staticmethod
+    def _candidate_stats(candidates):
+        # size of the candidate features held by the ticket, for calibrating the broker's memory estimates
+        clips = set()
+        feature_values = 0
+        feature_dimension = 0
+        splits = set()
+        for stream_candidates in candidates.values():
+            for split, split_candidates in stream_candidates.items():
+                splits.add(split)
+                clips.update(split_candidates)
+                for feature_vector in split_candidates.values():
+                    feature_values += len(feature_vector)
+                    feature_dimension = max(feature_dimension, len(feature_vector))
+        return {"clips": len(clips), "feature_values": feature_values, "feature_dimension": feature_dimension,
+                "splits": len(splits)}
+
     def _get_candidate_features(self, splits, hyperparameters):
         # Create video clip feature dictionary with entries like
         # { <stream type>: {<split #>: { clip#: [<target feature>], ...} } }
@@ -381,20 +434,39 @@ class Ticket:   # base_url is the api url.  The default is the dev default.
                 candidate_dict[tf_stream][fsplit][nclip] = feature_vector
         return candidate_dict
 
+    def _get_video_clips(self, video_clip_ids):
+        """
+        :param video_clip_ids: list of primary keys of video clips
+        :return: dictionary of video clip records, { video_clip_id: <video clip record> }
+
+        The clips are requested in bulk with an id__in filter on video-clips/list when the API schema offers one,
+        otherwise each clip is read individually.
+        """
+        video_clips = {}
+        if not self._has_filter(["video-clips", "list"], "id__in"):
+            for video_clip_id in video_clip_ids:
+                action = ["video-clips", "read"]
+                params = {"id": video_clip_id}
+                video_clips[video_clip_id] = self._request(action, params)
+            return video_clips
+
+        page = 1
+        while page is not None:
+            action = ["video-clips", "list"]
+            params = {"id__in": ",".join(str(video_clip_id) for video_clip_id in video_clip_ids), "page": page}
+            results = self._request(action, params)
+            for video_clip in results["results"]:
+                video_clips[video_clip["id"]] = video_clip
+            page = results["pagination"]["nextPage"]
+        return video_clips
+
+    def _has_filter(self, action, name):
+        # True if the API schema offers parameter name for action
+        link = self.schema[action[0]][action[1]]
+        return name in [field.name for field in link.fields]
+
     def _request(self, action, params):
-        while True:
-            try:
-                return self.client.action(self.schema, action, params=params)
-            except ConnectionError:
-                sleep(0.05)
-                msg = 'Try API request again: action = {}, params = {}'.format(action, params)
-                logging.warning(msg)
+        return self.session.request(action, params, deadline=self.deadline)
 
     def _post_file(self, action, params):
-        while True:
-            try:
-                return self.client.action(self.schema, action, params=params, encoding="multipart/form-data")
-            except ConnectionError:
-                sleep(0.05)
-                msg = 'Try API file post by Ticket again: action = {}, params = {}'.format(action, params)
-                logging.warning(msg)
+        return self.session.request(action, params, deadline=self.deadline, encoding="multipart/form-data")
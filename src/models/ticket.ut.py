@@ -1,11 +1,68 @@
+import csv
+import io
+import os
+import sys
 import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+# ticket imports the api and services packages, so src/ is put on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("COMPUTE_EPS", "0.000003")
+from models.hyperparameter import Hyperparameter  # noqa: E402
+from models.ticket import REPORT_PAGE_SIZE, Ticket  # noqa: E402
+
+# video clips per page of a video-clips list response
+LIST_PAGE_SIZE = 50
+NMATCHES = 2 * REPORT_PAGE_SIZE + 50
+
+
+class StubSession:
+    # the query, its video, search set and round, and the video clips of the matches, answering the actions of a
+    # final report
+    def __init__(self, list_by_id=True):
+        self.client = None
+        fields = [SimpleNamespace(name=name) for name in ("video", "clip", "page")]
+        if list_by_id:
+            fields.append(SimpleNamespace(name="id__in"))
+        self.schema = {"video-clips": {"list": SimpleNamespace(fields=fields)}}
+        self.video_clips = {video_clip_id: {"id": video_clip_id, "clip": video_clip_id - 1000, "duration": 10,
+                                            "video": 1, "notes": ''} for video_clip_id in range(1000, 1000 + NMATCHES)}
+        self.request = mock.Mock(side_effect=self._request)
+
+    def _request(self, action, params, deadline=None, **kwargs):
+        if action == ["queries", "read"]:
+            return {"id": 7, "name": 'q', "search_set_to_query": 2, "reference_time": '0:00:00',
+                    "max_matches_for_review": 5, "use_dynamic_target_adjustment": False, "notes": ''}
+        if action == ["videos", "read"]:
+            return {"id": 1, "name": 'Video0'}
+        if action == ["query-results", "read"]:
+            return {"id": 3, "round": 4, "match_criterion": 0.5, "weights": {'rgb': 1.0}}
+        if action == ["search-sets", "read"]:
+            return {"id": 2, "name": 'search set'}
+        if action == ["video-clips", "read"]:
+            return self.video_clips[params["id"]]
+        if action == ["video-clips", "list"]:
+            video_clips = [self.video_clips[int(video_clip_id)] for video_clip_id in params["id__in"].split(',')]
+            start = (params["page"] - 1) * LIST_PAGE_SIZE
+            next_page = params["page"] + 1 if start + LIST_PAGE_SIZE < len(video_clips) else None
+            return {"results": video_clips[start:start + LIST_PAGE_SIZE], "pagination": {"nextPage": next_page}}
+        if action == ["queries", "partial_update"]:
+            return {"id": params["id"]}
+        raise Exception("Error: unexpected action {}".format(action))
+
+    def requests(self, action):
+        return [call.args[1] for call in self.request.call_args_list if call.args[0] == action]
 
 
 class TicketTest(unittest.TestCase):
     """Tests for ticket.py."""
 
     def setUp(self):
-        pass
+        self.hyperparameters = Hyperparameter({'rgb': 1.0, 'warped_optical_flow': 1.5}, default_threshold=0.8,
+                                              ballast=0.0, near_miss_default=0.35, mu=0.0,
+                                              streams=['rgb', 'warped_optical_flow'], feature_name='global_pool',
+                                              f_bootstrap=1, f_memory=0.7, bootstrap_type='bagging', nbags=3)
 
     def tearDown(self):
         pass
@@ -13,6 +70,51 @@ class TicketTest(unittest.TestCase):
     def test_is_true(self):
         self.assertTrue(True)
 
+    def test_final_report_pages_clips_by_id(self):
+        session = self._create_final_report(StubSession())
+        pages = session.requests(["video-clips", "list"])
+        # one id__in filter per page of the report, followed through the pages of the list response
+        self.assertEqual([len(params["id__in"].split(',')) for params in pages if params["page"] == 1],
+                         [REPORT_PAGE_SIZE, REPORT_PAGE_SIZE, NMATCHES - 2 * REPORT_PAGE_SIZE])
+        self.assertEqual(len(pages), -(-NMATCHES // LIST_PAGE_SIZE))
+        self.assertEqual(session.requests(["video-clips", "read"]), [])
+        self._assert_report(session)
+
+    def test_final_report_reads_clips_without_id_filter(self):
+        session = self._create_final_report(StubSession(list_by_id=False))
+        self.assertEqual(session.requests(["video-clips", "list"]), [])
+        self.assertEqual(sorted(params["id"] for params in session.requests(["video-clips", "read"])),
+                         sorted(session.video_clips))
+        self._assert_report(session)
+
+    def _create_final_report(self, session):
+        update_object = {"query_id": 7, "video_id": 1, "ref_clip": 0, "ref_clip_id": 1000, "search_set": 2,
+                         "number_of_matches_to_review": 5, "dynamic_target_adjustment": False}
+        with mock.patch('models.ticket.get_session', return_value=session):
+            ticket = Ticket(update_object, 'http://stub/')
+        # the later clips score higher, and two clips were reviewed
+        ticket.matches = {video_clip_id: (video_clip_id - 1000) / NMATCHES for video_clip_id in session.video_clips}
+        ticket.user_matches = {'1001': True, str(999 + NMATCHES): False}
+        ticket.create_final_report(self.hyperparameters, 3)
+        return session
+
+    def _assert_report(self, session):
+        upload, = session.requests(["queries", "partial_update"])
+        self.assertEqual(upload["final_report_file"].content_type, 'text/csv')
+        rows = list(csv.reader(io.StringIO(upload["final_report_file"].content.decode('utf-8'))))
+        header = rows.index(['clip #', 'start time', 'match type', 'video pk', 'video clip id', 'score',
+                             'duration', 'notes'])
+        clip_rows = rows[header + 1:]
+        # every match once, ranked by score
+        self.assertEqual([int(row[4]) for row in clip_rows], list(range(999 + NMATCHES, 999, -1)))
+        match_types = {int(row[4]): row[2] for row in clip_rows}
+        self.assertEqual(match_types[999 + NMATCHES], "user-identified non-match")
+        self.assertEqual(match_types[1001], "user-identified match")
+        self.assertEqual(match_types[1000 + NMATCHES // 2], "inferred match")
+        self.assertEqual(match_types[1000], "inferred non-match")
+        self.assertEqual(clip_rows[-1][:2], ['0', '0:00:00'])
+        self.assertEqual(clip_rows[0][:2], ['449', '1:14:50'])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,10 @@
+from .scheduler import *
+from .worker_pool import *
+from .ticket_queue import *
+from .leases import *
+from .checkpoints import *
+from .metrics import *
+from .profiling import *
+from .status import *
+from .notifications import *
+from .memory import *
@@ -0,0 +1,105 @@
+"""Durable checkpoints of the stages of a ticket, so a restarted broker can resume a query round
+where it stopped instead of redoing all of its work.
+"""
+import pickle
+import sqlite3
+import time
+
+# stages of a ticket, in the order they complete
+STAGES = ('claimed', 'ref_features', 'target', 'similarities', 'hyperparameters', 'query_result', 'selected',
+          'matches_written')
+
+
+class CheckpointStore:
+    def __init__(self, path):
+        """
+        :param path: SQLite database file for the checkpoints.  Only the path is kept, so the store can be
+                     passed to worker processes.
+        """
+        self.path = path
+        connection = self._connect()
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS checkpoints (query_id INTEGER, round INTEGER, "
+                               "stage TEXT, payload BLOB, created REAL, PRIMARY KEY (query_id, round, stage))")
+        connection.close()
+
+    def round(self, query_id, nround):
+        return TicketCheckpoint(self, query_id, nround)
+
+    def incomplete(self):
+        """
+        :return: list of (update_type, update_object) of query rounds that were claimed but not finished
+        """
+        connection = self._connect()
+        rows = connection.execute("SELECT payload FROM checkpoints WHERE stage = 'claimed' "
+                                  "ORDER BY created").fetchall()
+        connection.close()
+        return [pickle.loads(row[0]) for row in rows]
+
+    def release(self, query_id):
+        # the claimed round of query_id was handed back unstarted: it is no longer resumed by this broker, but its
+        # completed stages are kept for the broker that claims it again
+        connection = self._connect()
+        with connection:
+            connection.execute("DELETE FROM checkpoints WHERE query_id = ? AND stage = 'claimed'", (query_id,))
+        connection.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+
+class TicketCheckpoint:
+    def __init__(self, store, query_id, nround):
+        """
+        Checkpoints of one round of one query.  With store=None nothing is saved, and nothing is found.
+        """
+        self.store = store
+        self.query_id = query_id
+        self.nround = nround
+
+    def __contains__(self, stage):
+        if self.store is None:
+            return False
+        connection = self.store._connect()
+        row = connection.execute("SELECT 1 FROM checkpoints WHERE query_id = ? AND round = ? AND stage = ?",
+                                 (self.query_id, self.nround, stage)).fetchone()
+        connection.close()
+        return row is not None
+
+    def started(self):
+        # True if any stage of the round was saved, e.g. before the broker stopped or handed the round back
+        if self.store is None:
+            return False
+        connection = self.store._connect()
+        row = connection.execute("SELECT 1 FROM checkpoints WHERE query_id = ? AND round = ? LIMIT 1",
+                                 (self.query_id, self.nround)).fetchone()
+        connection.close()
+        return row is not None
+
+    def get(self, stage, default=None):
+        if self.store is None:
+            return default
+        connection = self.store._connect()
+        row = connection.execute("SELECT payload FROM checkpoints WHERE query_id = ? AND round = ? AND stage = ?",
+                                 (self.query_id, self.nround, stage)).fetchone()
+        connection.close()
+        return pickle.loads(row[0]) if row is not None else default
+
+    def save(self, stage, value):
+        if self.store is None:
+            return
+        connection = self.store._connect()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?)",
+                               (self.query_id, self.nround, stage, pickle.dumps(value), time.time()))
+        connection.close()
+
+    def clear(self):
+        # the round is finished; its checkpoints are no longer needed
+        if self.store is None:
+            return
+        connection = self.store._connect()
+        with connection:
+            connection.execute("DELETE FROM checkpoints WHERE query_id = ? AND round = ?",
+                               (self.query_id, self.nround))
+        connection.close()
@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+from checkpoints import CheckpointStore, TicketCheckpoint
+
+
+class CheckpointsTest(unittest.TestCase):
+    """Tests for checkpoints.py."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = CheckpointStore(os.path.join(self.directory.name, 'checkpoints.sqlite'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_saved_stage_is_found(self):
+        checkpoint = self.store.round(7, 2)
+        checkpoint.save('hyperparameters', ([0.5, 0.5], 0.1))
+        self.assertIn('hyperparameters', self.store.round(7, 2))
+        self.assertNotIn('hyperparameters', self.store.round(7, 3))
+        self.assertEqual(self.store.round(7, 2).get('hyperparameters'), ([0.5, 0.5], 0.1))
+
+    def test_incomplete_rounds(self):
+        update_object = {"query_id": 7, "latest_query_result": {"round": 2}}
+        self.store.round(7, 2).save('claimed', ('revise', update_object))
+        self.assertEqual(self.store.incomplete(), [('revise', update_object)])
+        self.store.round(7, 2).clear()
+        self.assertEqual(self.store.incomplete(), [])
+
+    def test_released_round(self):
+        update_object = {"query_id": 7, "latest_query_result": {"round": 2}}
+        self.store.round(7, 2).save('claimed', ('revise', update_object))
+        self.store.round(7, 2).save('target', {'rgb': {1: [0.5]}})
+        self.store.release(7)
+        self.assertEqual(self.store.incomplete(), [])
+        self.assertIn('target', self.store.round(7, 2))
+        self.assertTrue(self.store.round(7, 2).started())
+        self.assertFalse(self.store.round(7, 3).started())
+
+    def test_no_store(self):
+        checkpoint = TicketCheckpoint(None, 7, 2)
+        checkpoint.save('selected', [1, 2, 3])
+        self.assertNotIn('selected', checkpoint)
+        self.assertFalse(checkpoint.started())
+        self.assertEqual(checkpoint.get('selected', []), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
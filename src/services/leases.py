@@ -0,0 +1,196 @@
+"""Lease-based claiming of queries, so several brokers can share the work without running a query twice.
+
+A broker claims a lease on a query round before marking it in progress, renews its leases with a heartbeat while
+it works, and marks them done when the round is finished, or releases them if its ticket failed.  A lease whose
+broker stops renewing it expires, and the round it covered is picked up again by another broker.
+
+The coordination backend is pluggable.  SQLiteLeaseBackend is provided for brokers on one host and for testing.
+"""
+from abc import ABC, abstractmethod
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+# seconds a lease is valid without renewal
+LEASE_TTL = 60.0
+# seconds a finished round's lease is remembered, so late query-state listings of the round are not claimed again
+DONE_RETENTION = 3600.0
+
+
+def lease_key(update_type, update_object):
+    # a lease covers one type of update of one round of one query
+    latest_query_result = update_object.get("latest_query_result")
+    nround = latest_query_result["round"] if latest_query_result else 0
+    return '{}:{}:{}'.format(update_type, update_object["query_id"], nround)
+
+
+class LeaseBackend(ABC):
+    """Interface of a lease coordination backend.  All methods must be atomic across brokers."""
+
+    @abstractmethod
+    def claim(self, key, owner, ttl, payload):
+        # take the lease if it is free or expired, returning True on success
+        pass
+
+    @abstractmethod
+    def renew(self, keys, owner, ttl):
+        # extend the leases in keys held by owner, returning the set of keys still held
+        pass
+
+    @abstractmethod
+    def complete(self, key, owner):
+        pass
+
+    @abstractmethod
+    def release(self, key, owner):
+        # give up a lease held by owner before its round is processed, so any broker can claim the round
+        pass
+
+    @abstractmethod
+    def take_expired(self, owner, ttl):
+        # take over every expired lease, returning a list of their payloads
+        pass
+
+
+class SQLiteLeaseBackend(LeaseBackend):
+    def __init__(self, path):
+        """
+        :param path: SQLite database file shared by the brokers
+        """
+        self.path = path
+        with self._transaction() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT, "
+                               "expires REAL, state TEXT, payload TEXT)")
+
+    def claim(self, key, owner, ttl, payload):
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute("SELECT owner, expires, state FROM leases WHERE key = ?", (key,)).fetchone()
+            if row is not None and (row[2] == 'done' or (row[1] > now and row[0] != owner)):
+                return False
+            connection.execute("INSERT OR REPLACE INTO leases VALUES (?, ?, ?, 'held', ?)",
+                               (key, owner, now + ttl, json.dumps(payload)))
+            return True
+
+    def renew(self, keys, owner, ttl):
+        renewed = set()
+        with self._transaction() as connection:
+            for key in keys:
+                cursor = connection.execute("UPDATE leases SET expires = ? WHERE key = ? AND owner = ? "
+                                            "AND state = 'held'", (time.time() + ttl, key, owner))
+                if cursor.rowcount:
+                    renewed.add(key)
+        return renewed
+
+    def complete(self, key, owner):
+        with self._transaction() as connection:
+            connection.execute("UPDATE leases SET state = 'done', expires = ? WHERE key = ? AND owner = ?",
+                               (time.time() + DONE_RETENTION, key, owner))
+            connection.execute("DELETE FROM leases WHERE state = 'done' AND expires < ?", (time.time(),))
+
+    def release(self, key, owner):
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM leases WHERE key = ? AND owner = ? AND state = 'held'", (key, owner))
+
+    def take_expired(self, owner, ttl):
+        now = time.time()
+        with self._transaction() as connection:
+            rows = connection.execute("SELECT key, payload FROM leases WHERE state = 'held' AND expires < ?",
+                                      (now,)).fetchall()
+            for key, __ in rows:
+                connection.execute("UPDATE leases SET owner = ?, expires = ? WHERE key = ?", (owner, now + ttl, key))
+        return [json.loads(payload) for __, payload in rows]
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _transaction(self):
+        return _Transaction(self._connect())
+
+
+class _Transaction:
+    # BEGIN IMMEDIATE takes the database write lock at the start, so a read followed by a write is atomic
+    def __init__(self, connection):
+        self.connection = connection
+        self.connection.isolation_level = None
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        self.connection.close()
+
+
+class LeaseManager:
+    def __init__(self, backend, owner, ttl=LEASE_TTL):
+        """
+        :param backend: instance of a LeaseBackend
+        :param owner: unique id of this broker
+        :param ttl: seconds a lease is valid without renewal.  Leases are renewed every ttl / 3 seconds.
+        """
+        self.backend = backend
+        self.owner = owner
+        self.ttl = ttl
+        self.held = set()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._heartbeat = threading.Thread(target=self._renew_loop, daemon=True)
+
+    def start(self):
+        self._heartbeat.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def claim(self, update_type, update_object):
+        key = lease_key(update_type, update_object)
+        payload = {"update_type": update_type, "update_object": update_object}
+        if not self.backend.claim(key, self.owner, self.ttl, payload):
+            return False
+        with self._lock:
+            self.held.add(key)
+        return True
+
+    def complete(self, update_type, update_object):
+        key = lease_key(update_type, update_object)
+        self.backend.complete(key, self.owner)
+        with self._lock:
+            self.held.discard(key)
+
+    def release(self, update_type, update_object):
+        key = lease_key(update_type, update_object)
+        self.backend.release(key, self.owner)
+        with self._lock:
+            self.held.discard(key)
+
+    def reclaim_expired(self):
+        """
+        Take over the rounds of brokers that stopped renewing their leases.
+        :return: list of (update_type, update_object) to process again
+        """
+        payloads = self.backend.take_expired(self.owner, self.ttl)
+        with self._lock:
+            for payload in payloads:
+                self.held.add(lease_key(payload["update_type"], payload["update_object"]))
+        for payload in payloads:
+            logging.warning('Requeued query {} after its lease expired'.format(payload["update_object"]["query_id"]))
+        return [(payload["update_type"], payload["update_object"]) for payload in payloads]
+
+    def _renew_loop(self):
+        while not self._stopping.wait(self.ttl / 3):
+            with self._lock:
+                keys = set(self.held)
+            try:
+                renewed = self.backend.renew(keys, self.owner, self.ttl)
+            except Exception as e:
+                logging.error('Lease renewal failed: {}'.format(e))
+                continue
+            lost = keys - renewed
+            if lost:
+                logging.error('Leases lost by broker {}: {}'.format(self.owner, sorted(lost)))
+                with self._lock:
+                    self.held -= lost
@@ -0,0 +1,62 @@
+import os
+import tempfile
+import time
+import unittest
+from leases import LeaseBackend, LeaseManager, SQLiteLeaseBackend
+
+
+class LeasesTest(unittest.TestCase):
+    """Tests for leases.py."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        backend = SQLiteLeaseBackend(os.path.join(self.directory.name, 'leases.sqlite'))
+        self.broker_1 = LeaseManager(backend, 'broker-1', ttl=0.2)
+        self.broker_2 = LeaseManager(backend, 'broker-2', ttl=0.2)
+        self.update_object = {"query_id": 7, "latest_query_result": {"round": 2}}
+
+    def tearDown(self):
+        self.broker_1.stop()
+        self.broker_2.stop()
+        self.directory.cleanup()
+
+    def test_claim_is_exclusive(self):
+        self.assertTrue(self.broker_1.claim('revise', self.update_object))
+        self.assertFalse(self.broker_2.claim('revise', self.update_object))
+
+    def test_completed_round_is_not_claimed_again(self):
+        self.broker_1.claim('revise', self.update_object)
+        self.broker_1.complete('revise', self.update_object)
+        self.assertFalse(self.broker_2.claim('revise', self.update_object))
+        # the query may still be finalized from the same round
+        self.assertTrue(self.broker_2.claim('finalize', self.update_object))
+
+    def test_released_round_is_claimed_again(self):
+        self.broker_1.claim('revise', self.update_object)
+        self.broker_1.release('revise', self.update_object)
+        self.assertEqual(self.broker_1.held, set())
+        self.assertTrue(self.broker_2.claim('revise', self.update_object))
+
+    def test_backend_must_implement_interface(self):
+        class PartialBackend(LeaseBackend):
+            def claim(self, key, owner, ttl, payload):
+                return True
+
+        with self.assertRaises(TypeError):
+            PartialBackend()
+
+    def test_heartbeat_keeps_lease(self):
+        self.broker_1.start()
+        self.broker_1.claim('revise', self.update_object)
+        time.sleep(0.5)
+        self.assertEqual(self.broker_2.reclaim_expired(), [])
+
+    def test_expired_lease_is_requeued(self):
+        self.broker_1.claim('revise', self.update_object)
+        time.sleep(0.3)
+        self.assertEqual(self.broker_2.reclaim_expired(), [('revise', self.update_object)])
+        self.assertEqual(self.broker_2.reclaim_expired(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
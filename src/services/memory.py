@@ -0,0 +1,86 @@
+"""Estimates of the peak memory of tickets, for admitting tickets against the broker's memory budget.
+
+A ticket holds the features of every clip of its search set, for every stream and split, as lists of floats parsed
+from JSON, plus the similarities and scores of each clip and the features of the labeled clips used to bootstrap the
+target.  The feature dimension and number of splits of a search set are learned from the tickets that processed it,
+and the bytes per feature value are fitted to the peaks measured for tickets that ran alone in their process.
+"""
+import json
+import logging
+import threading
+
+# a float in a list parsed from JSON: an 8 byte pointer and a 24 byte float object.  Used until enough peaks have
+# been measured to fit the cost.
+BYTES_PER_FEATURE_VALUE = 32
+# lowest fitted cost: a float64 in an array
+MIN_BYTES_PER_FEATURE_VALUE = 8
+# measured peaks needed before the fitted cost replaces BYTES_PER_FEATURE_VALUE, and most recent ones kept
+MIN_CALIBRATION_SAMPLES = 3
+MAX_CALIBRATION_SAMPLES = 100
+# similarities, scores and match entries kept for each clip of the search set, per stream
+BYTES_PER_CLIP_STREAM = 600
+# memory used by a ticket regardless of its search set: API responses, target and bookkeeping
+TICKET_BASE_BYTES = 20 * 2 ** 20
+# assumed for search sets the broker has not processed yet
+DEFAULT_FEATURE_DIMENSION = 1024
+DEFAULT_SPLITS = 3
+
+
+class MemoryEstimator:
+    def __init__(self, nstreams, feature_dimension=DEFAULT_FEATURE_DIMENSION, nsplits=DEFAULT_SPLITS):
+        """
+        :param nstreams: number of feature streams used by the broker, e.g. 2 for rgb and warped_optical_flow
+        :param feature_dimension: length of a feature vector, until one is observed
+        :param nsplits: number of splits per stream, until they are observed
+        """
+        self.nstreams = nstreams
+        self.feature_dimension = feature_dimension
+        self.nsplits = nsplits
+        self.search_sets = {}  # search set: (feature dimension, number of splits)
+        self.calibration = []  # (feature values, clips, measured peak bytes) of finished tickets
+        self.bytes_per_feature_value = BYTES_PER_FEATURE_VALUE
+        self._lock = threading.Lock()
+
+    def estimate(self, search_set, search_set_size, nlabeled=0):
+        """
+        :param search_set: primary key of the ticket's search set
+        :param search_set_size: number of clips in the search set
+        :param nlabeled: number of clips labeled by the user in earlier rounds, whose features are fetched
+        :return: estimated peak memory of the ticket, in bytes
+        """
+        with self._lock:
+            feature_dimension, nsplits = self.search_sets.get(search_set, (self.feature_dimension, self.nsplits))
+            bytes_per_feature_value = self.bytes_per_feature_value
+        nfeature_values = (search_set_size + nlabeled) * self.nstreams * nsplits * feature_dimension
+        return int(TICKET_BASE_BYTES + bytes_per_feature_value * nfeature_values +
+                   BYTES_PER_CLIP_STREAM * search_set_size * self.nstreams)
+
+    def observed(self, search_set, estimate, memory):
+        """
+        Learn from a finished ticket: the feature dimension and splits of its search set, and its measured peak
+        memory, if it was measured.  Once MIN_CALIBRATION_SAMPLES peaks are measured, the bytes per feature value
+        are the ones that account for the measured peaks beyond the memory of the clips and the ticket's base.
+        :param estimate: bytes estimated for the ticket when it was admitted
+        :param memory: the "memory" entry of the ticket's summary, see ticket_summary and process_update in
+                       compute_matches.  Its "peak_traced_bytes" is only there if the ticket ran alone in its process.
+        """
+        if not memory or not memory.get("feature_values"):
+            return
+        with self._lock:
+            self.search_sets[search_set] = (memory["feature_dimension"], memory["splits"])
+            if memory.get("peak_traced_bytes") is not None:
+                self.calibration.append((memory["feature_values"], memory["clips"], memory["peak_traced_bytes"]))
+                del self.calibration[:-MAX_CALIBRATION_SAMPLES]
+                if len(self.calibration) >= MIN_CALIBRATION_SAMPLES:
+                    self.bytes_per_feature_value = self._fitted_bytes_per_feature_value()
+        # one line per ticket, to compare estimates with measured peaks
+        logging.info('memory {}'.format(json.dumps(dict(memory, search_set=search_set, estimate=estimate),
+                                                   sort_keys=True)))
+
+    def _fitted_bytes_per_feature_value(self):
+        # least squares fit through the origin of the measured peaks, less the other memory of each ticket
+        feature_bytes = [(feature_values, peak - TICKET_BASE_BYTES - BYTES_PER_CLIP_STREAM * clips * self.nstreams)
+                         for feature_values, clips, peak in self.calibration]
+        fitted = sum(feature_values * nbytes for feature_values, nbytes in feature_bytes) / \
+            sum(feature_values ** 2 for feature_values, __ in feature_bytes)
+        return max(fitted, MIN_BYTES_PER_FEATURE_VALUE)
@@ -0,0 +1,212 @@
+"""Timing spans for the stages of a ticket, and their export as structured log lines and Prometheus metrics.
+
+process_update opens a TicketTrace, and each stage of the ticket runs in a span of it.  Every finished span is
+written to the log as one JSON line.  The spans are returned in the ticket summary, so the broker process can
+aggregate them in a StageMetrics registry whatever the worker type, and write the registry, with the API request
+telemetry, to a Prometheus text file.
+"""
+from contextlib import contextmanager
+import json
+import logging
+import os
+import threading
+import time
+
+# upper bounds, in seconds, of the stage duration histogram buckets
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, float("inf"))
+METRIC_PREFIX = 'video_query'
+
+# trace of the ticket the current thread is processing
+_current = threading.local()
+# traces of the tickets in progress in this process, for the broker status
+_active = set()
+_active_lock = threading.Lock()
+
+
+@contextmanager
+def span(stage, **attributes):
+    """
+    Time stage as a span of the current thread's ticket trace.  Does nothing outside of a trace.
+    Yields a dictionary of the span's attributes, to which the stage may add attributes it learns while it runs.
+    """
+    trace = getattr(_current, "trace", None)
+    if trace is None:
+        yield dict(attributes)
+        return
+    with trace.span(stage, **attributes) as span_attributes:
+        yield span_attributes
+
+
+class TicketTrace:
+    def __init__(self, query_id, update_type, bytes_received=None):
+        """
+        :param query_id: primary key of the query of the ticket
+        :param update_type: "new", "revise" or "finalize"
+        :param bytes_received: optional function returning the number of API response bytes received so far for
+                               the ticket, used to add a bytes_received attribute to each span
+        """
+        self.query_id = query_id
+        self.update_type = update_type
+        self.bytes_received = bytes_received
+        self.spans = []
+        # objects with span_started(stage) and span_finished(stage, attributes) methods, e.g. a TicketProfiler
+        self.observers = []
+        self.started = None
+        self.stage = None
+        self.stage_started = None
+
+    def __enter__(self):
+        _current.trace = self
+        self.started = time.time()
+        with _active_lock:
+            _active.add(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current.trace = None
+        with _active_lock:
+            _active.discard(self)
+
+    @contextmanager
+    def span(self, stage, **attributes):
+        attributes = dict(attributes)
+        bytes_start = self.bytes_received() if self.bytes_received else None
+        for observer in self.observers:
+            observer.span_started(stage)
+        start = time.time()
+        self.stage, self.stage_started = stage, start
+        try:
+            yield attributes
+        except Exception as e:
+            attributes["error"] = type(e).__name__
+            raise
+        finally:
+            duration = time.time() - start
+            if bytes_start is not None:
+                attributes["bytes_received"] = self.bytes_received() - bytes_start
+            for observer in self.observers:
+                observer.span_finished(stage, attributes)
+            record = {
+                "stage": stage,
+                "query_id": self.query_id,
+                "update_type": self.update_type,
+                "start": start,
+                "duration": duration,
+                "attributes": attributes,
+            }
+            self.spans.append(record)
+            logging.info('span {}'.format(json.dumps(record, sort_keys=True, default=str)))
+
+
+def active_traces():
+    """
+    :return: list of the tickets in progress in this process, with their current stage and elapsed times
+    """
+    now = time.time()
+    with _active_lock:
+        traces = list(_active)
+    return [{
+        "query_id": trace.query_id,
+        "update_type": trace.update_type,
+        "elapsed": now - trace.started,
+        "stage": trace.stage,
+        "stage_elapsed": now - trace.stage_started if trace.stage_started else None,
+    } for trace in traces]
+
+
+class StageMetrics:
+    def __init__(self):
+        # histograms are keyed by (stage, update_type)
+        self.durations = {}
+        self.bytes_received = {}
+        self.tickets = {}  # (update_type, outcome): count
+        self._lock = threading.Lock()
+
+    def record_ticket(self, update_type, summary):
+        """
+        :param update_type: "new", "revise" or "finalize"
+        :param summary: dictionary returned by process_update, or None if the ticket failed
+        """
+        outcome = summary.get("outcome", "processed") if summary else "failed"
+        with self._lock:
+            self.tickets[update_type, outcome] = self.tickets.get((update_type, outcome), 0) + 1
+            for record in (summary or {}).get("spans", []):
+                key = (record["stage"], record["update_type"])
+                if key not in self.durations:
+                    self.durations[key] = [[0] * len(STAGE_BUCKETS), 0.0]
+                histogram = self.durations[key]
+                for k, bound in enumerate(STAGE_BUCKETS):
+                    if record["duration"] <= bound:
+                        histogram[0][k] += 1
+                        break
+                histogram[1] += record["duration"]
+                self.bytes_received[key] = self.bytes_received.get(key, 0) + \
+                    record["attributes"].get("bytes_received", 0)
+
+    def prometheus_text(self, request_telemetry=None):
+        """
+        :param request_telemetry: optional api.telemetry.RequestTelemetry to export with the stage metrics
+        :return: the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            name = METRIC_PREFIX + '_stage_duration_seconds'
+            lines += ['# HELP {} Duration of the stages of tickets.'.format(name), '# TYPE {} histogram'.format(name)]
+            for (stage, update_type), (buckets, total) in sorted(self.durations.items()):
+                labels = 'stage="{}",update_type="{}"'.format(stage, update_type)
+                lines += _histogram_lines(name, labels, STAGE_BUCKETS, buckets, total)
+
+            name = METRIC_PREFIX + '_stage_bytes_received_total'
+            lines += ['# HELP {} API response bytes received by the stages of tickets.'.format(name),
+                      '# TYPE {} counter'.format(name)]
+            for (stage, update_type), nbytes in sorted(self.bytes_received.items()):
+                lines.append('{}{{stage="{}",update_type="{}"}} {}'.format(name, stage, update_type, nbytes))
+
+            name = METRIC_PREFIX + '_tickets_total'
+            lines += ['# HELP {} Tickets finished, by outcome.'.format(name), '# TYPE {} counter'.format(name)]
+            for (update_type, outcome), count in sorted(self.tickets.items()):
+                lines.append('{}{{update_type="{}",outcome="{}"}} {}'.format(name, update_type, outcome, count))
+
+        if request_telemetry is not None:
+            lines += _request_lines(request_telemetry)
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, request_telemetry=None):
+        # write to a temporary file and rename it, so a scraper never reads a partial file
+        temp_file = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_file, 'w') as f:
+            f.write(self.prometheus_text(request_telemetry))
+        os.replace(temp_file, path)
+
+
+def _histogram_lines(name, labels, bounds, buckets, total):
+    # Prometheus buckets are cumulative
+    lines = []
+    cumulative = 0
+    for bound, count in zip(bounds, buckets):
+        cumulative += count
+        le = '+Inf' if bound == float("inf") else repr(bound)
+        lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, le, cumulative))
+    lines.append('{}_sum{{{}}} {}'.format(name, labels, total))
+    lines.append('{}_count{{{}}} {}'.format(name, labels, cumulative))
+    return lines
+
+
+def _request_lines(request_telemetry):
+    # the latency buckets of RequestTelemetry are keyed by their upper bounds
+    snapshot = request_telemetry.snapshot()
+    lines = []
+    name = METRIC_PREFIX + '_api_request_duration_seconds'
+    lines += ['# HELP {} Latency of API requests.'.format(name), '# TYPE {} histogram'.format(name)]
+    for action_name, stats in sorted(snapshot.items()):
+        bounds = sorted(stats["latency_buckets"])
+        lines += _histogram_lines(name, 'action="{}"'.format(action_name), bounds,
+                                  [stats["latency_buckets"][bound] for bound in bounds], stats["latency_sum"])
+    for counter, help_text in (("failures", "Failed API requests."), ("retries", "Retried API requests."),
+                               ("bytes_sent", "Bytes sent in API requests."),
+                               ("bytes_received", "Bytes received in API responses.")):
+        name = '{}_api_request_{}_total'.format(METRIC_PREFIX, counter)
+        lines += ['# HELP {} {}'.format(name, help_text), '# TYPE {} counter'.format(name)]
+        for action_name, stats in sorted(snapshot.items()):
+            lines.append('{}{{action="{}"}} {}'.format(name, action_name, stats[counter]))
+    return lines
@@ -0,0 +1,43 @@
+import unittest
+from metrics import StageMetrics, TicketTrace, span
+
+
+class MetricsTest(unittest.TestCase):
+    """Tests for metrics.py."""
+
+    def test_spans_of_trace(self):
+        received = [100]
+        trace = TicketTrace(7, 'revise', bytes_received=lambda: received[0])
+        with trace:
+            with span('candidate_features', search_set=3) as attributes:
+                received[0] += 250
+                attributes["features"] = 12
+        with span('outside'):
+            pass
+        self.assertEqual([record["stage"] for record in trace.spans], ['candidate_features'])
+        self.assertEqual(trace.spans[0]["attributes"], {"search_set": 3, "features": 12, "bytes_received": 250})
+
+    def test_failed_span_is_recorded(self):
+        trace = TicketTrace(7, 'new')
+        with self.assertRaises(ValueError):
+            with trace, span('similarities'):
+                raise ValueError
+        self.assertEqual(trace.spans[0]["attributes"]["error"], 'ValueError')
+
+    def test_prometheus_histograms(self):
+        metrics = StageMetrics()
+        spans = [{"stage": "similarities", "update_type": "new", "duration": duration, "attributes": {}}
+                 for duration in (0.07, 0.3, 400.0)]
+        metrics.record_ticket('new', {"outcome": "processed", "spans": spans})
+        metrics.record_ticket('new', None)
+        text = metrics.prometheus_text()
+        self.assertIn('video_query_stage_duration_seconds_bucket{stage="similarities",update_type="new",le="0.1"} 1',
+                      text)
+        self.assertIn('video_query_stage_duration_seconds_bucket{stage="similarities",update_type="new",le="0.5"} 2',
+                      text)
+        self.assertIn('video_query_stage_duration_seconds_count{stage="similarities",update_type="new"} 3', text)
+        self.assertIn('video_query_tickets_total{update_type="new",outcome="failed"} 1', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+"""Push notifications that wake the broker as soon as a query changes state, instead of at its next poll.
+
+Whatever carries a notification, its content is only a hint: the broker always claims work from the API
+query-state lists, so a lost, duplicated or malformed notification costs at most one poll.
+
+    WebhookListener     HTTP POST to a local port, e.g. from an API webhook
+    UnixSocketListener  datagram on a Unix socket, sent with send_notification
+    LocalNotifier       in-process stand-in for tests and for running the broker without a notifier
+"""
+from abc import ABC, abstractmethod
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import socket
+import threading
+
+# largest notification read from a Unix socket, in bytes
+MAX_NOTIFICATION_SIZE = 65536
+
+
+class NotificationListener(ABC):
+    """Interface of a notification listener."""
+
+    @abstractmethod
+    def start(self, on_notify):
+        """
+        :param on_notify: function called with the notification, a dictionary (possibly empty), each time one
+                          arrives.  It is called on the listener's thread and should return quickly.
+        """
+
+    @abstractmethod
+    def stop(self):
+        pass
+
+
+class LocalNotifier(NotificationListener):
+    def __init__(self):
+        self.on_notify = None
+
+    def start(self, on_notify):
+        self.on_notify = on_notify
+
+    def stop(self):
+        self.on_notify = None
+
+    def notify(self, notification=None):
+        if self.on_notify is not None:
+            self.on_notify(notification or {})
+
+
+class WebhookListener(NotificationListener):
+    def __init__(self, host='127.0.0.1', port=8766, path='/notify'):
+        """
+        :param port: port to listen on, 0 for any free port
+        :param path: path that accepts POST notifications, with an optional JSON body
+        """
+        self.path = path
+        self.on_notify = None
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self, on_notify):
+        self.on_notify = on_notify
+        self._thread.start()
+        logging.info('Listening for query notifications at http://{}:{}{}'.format(
+            self._server.server_address[0], self.port, self.path))
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler_class(self):
+        listener = self
+
+        class NotifyHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != listener.path:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                length = int(self.headers.get('Content-Length') or 0)
+                listener.on_notify(_parse(self.rfile.read(length)))
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return NotifyHandler
+
+
+class UnixSocketListener(NotificationListener):
+    def __init__(self, path):
+        """
+        :param path: path of the Unix datagram socket.  A stale socket file left by a previous broker is replaced.
+        """
+        self.path = path
+        self.on_notify = None
+        if os.path.exists(path):
+            os.remove(path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(path)
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._receive_loop, daemon=True)
+
+    def start(self, on_notify):
+        self.on_notify = on_notify
+        self._thread.start()
+        logging.info('Listening for query notifications on {}'.format(self.path))
+
+    def stop(self):
+        self._stopping.set()
+        # wake the receive loop, then remove the socket
+        send_notification(self.path, {})
+        self._thread.join(timeout=1)
+        self._socket.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _receive_loop(self):
+        while not self._stopping.is_set():
+            try:
+                data = self._socket.recv(MAX_NOTIFICATION_SIZE)
+            except OSError as e:
+                logging.error('Notification socket failed: {}'.format(e))
+                return
+            if not self._stopping.is_set():
+                self.on_notify(_parse(data))
+
+
+def send_notification(path, notification=None):
+    """
+    Send a notification to a broker's UnixSocketListener, e.g. {"query_id": 12, "process_state": 2}.
+    Returns False if no broker is listening.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as client:
+        try:
+            client.sendto(json.dumps(notification or {}).encode('utf-8'), path)
+        except OSError:
+            return False
+    return True
+
+
+def _parse(data):
+    # the content is only logged, so anything that is not a JSON object is treated as an empty notification
+    try:
+        notification = json.loads(data.decode('utf-8')) if data else {}
+    except ValueError:
+        return {}
+    return notification if isinstance(notification, dict) else {}
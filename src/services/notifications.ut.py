@@ -0,0 +1,57 @@
+import os
+import tempfile
+import threading
+import unittest
+import urllib.request
+from notifications import LocalNotifier, NotificationListener, UnixSocketListener, WebhookListener, send_notification
+
+
+class NotificationsTest(unittest.TestCase):
+    """Tests for notifications.py."""
+
+    def setUp(self):
+        self.received = []
+        self.event = threading.Event()
+
+    def on_notify(self, notification):
+        self.received.append(notification)
+        self.event.set()
+
+    def test_local_notifier(self):
+        notifier = LocalNotifier()
+        notifier.start(self.on_notify)
+        notifier.notify({"query_id": 7})
+        self.assertEqual(self.received, [{"query_id": 7}])
+
+    def test_listener_must_implement_interface(self):
+        class StartOnlyListener(NotificationListener):
+            def start(self, on_notify):
+                pass
+
+        with self.assertRaises(TypeError):
+            StartOnlyListener()
+
+    def test_webhook(self):
+        listener = WebhookListener(port=0)
+        listener.start(self.on_notify)
+        request = urllib.request.Request('http://127.0.0.1:{}/notify'.format(listener.port),
+                                         data=b'{"query_id": 7}', method='POST')
+        with urllib.request.urlopen(request) as response:
+            self.assertEqual(response.status, 204)
+        listener.stop()
+        self.assertEqual(self.received, [{"query_id": 7}])
+
+    def test_unix_socket(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'broker.sock')
+            listener = UnixSocketListener(path)
+            listener.start(self.on_notify)
+            self.assertTrue(send_notification(path, {"query_id": 7}))
+            self.assertTrue(self.event.wait(1))
+            listener.stop()
+            self.assertEqual(self.received, [{"query_id": 7}])
+            self.assertFalse(send_notification(path, {"query_id": 8}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+"""Opt-in CPU and memory profiling of individual tickets.
+
+A ticket is profiled if TICKET_PROFILE is "all", if its query is in TICKET_PROFILE_QUERY_IDS, or at random with
+probability TICKET_PROFILE_SAMPLE_RATE.  A profiled ticket runs under cProfile and tracemalloc, and writes to its own
+directory in TICKET_PROFILE_DIR:
+    profile.pstats      cProfile statistics, for pstats or snakeviz
+    profile.txt         the functions with the most cumulative time
+    allocations.txt     the source lines with the most memory allocated and still held at the end of the ticket
+    stages.json         duration, peak traced memory and RSS of each stage of the ticket
+
+cProfile sees the thread running the ticket, not the threads of the asyncio API client.  tracemalloc traces the
+whole process, so only one ticket at a time is memory profiled; the others get CPU profiles only.
+
+Every ticket that has its process to itself also has its peak memory measured by measure_ticket_memory, for
+calibrating the broker's memory estimates.
+"""
+from contextlib import contextmanager
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import resource
+import threading
+import time
+import tracemalloc
+
+TICKET_PROFILE = os.environ.get('TICKET_PROFILE', 'off')  # 'all' profiles every ticket
+TICKET_PROFILE_QUERY_IDS = {int(query_id) for query_id in os.environ.get('TICKET_PROFILE_QUERY_IDS', '').split(',')
+                            if query_id.strip()}
+TICKET_PROFILE_SAMPLE_RATE = float(os.environ.get('TICKET_PROFILE_SAMPLE_RATE', 0))
+TICKET_PROFILE_DIR = os.environ.get('TICKET_PROFILE_DIR', 'profiles')
+# number of frames kept for each traced allocation, and number of functions and allocation sites reported
+TRACEMALLOC_FRAMES = 10
+# frames kept when only the peak memory of a ticket is measured
+MEASURE_FRAMES = 1
+REPORT_LINES = 40
+
+# sampling has its own generator, so it does not change the sequence of the seeded global random module
+_sampler = random.Random()
+# held by whoever is using tracemalloc: a memory profile or a measurement
+_memory_lock = threading.Lock()
+# tickets running in this process, and the measurement in progress
+_tickets_lock = threading.Lock()
+_running_tickets = 0
+_measurement = None
+
+
+def should_profile(query_id):
+    if TICKET_PROFILE == 'all' or query_id in TICKET_PROFILE_QUERY_IDS:
+        return True
+    return TICKET_PROFILE_SAMPLE_RATE > 0 and _sampler.random() < TICKET_PROFILE_SAMPLE_RATE
+
+
+@contextmanager
+def profile_ticket(trace):
+    """
+    Profile the ticket of trace, a services.metrics.TicketTrace, if it is selected for profiling.
+    """
+    if not should_profile(trace.query_id):
+        yield None
+        return
+    profiler = TicketProfiler(trace.query_id, trace.update_type)
+    trace.observers.append(profiler)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        trace.observers.remove(profiler)
+        try:
+            profiler.write()
+        except OSError as e:
+            logging.warning('Could not write profile of query {}: {}'.format(trace.query_id, e))
+
+
+@contextmanager
+def measure_ticket_memory():
+    """
+    Measure the peak memory allocated while a ticket runs, with tracemalloc.  tracemalloc traces the whole process,
+    so the peak is only the ticket's if no other ticket ran in the process meanwhile and no profile was tracing memory.
+    Yields a dict, to which "peak_traced_bytes" is added when the ticket finishes if it was measured.
+    """
+    global _running_tickets, _measurement
+    measurement = {}
+    with _tickets_lock:
+        _running_tickets += 1
+        if _measurement is not None:
+            # the ticket being measured now shares the process
+            _measurement["shared"] = True
+        measuring = _running_tickets == 1 and not tracemalloc.is_tracing() and _memory_lock.acquire(blocking=False)
+        if measuring:
+            tracemalloc.start(MEASURE_FRAMES)
+            _measurement = measurement
+    try:
+        yield measurement
+    finally:
+        with _tickets_lock:
+            _running_tickets -= 1
+            if measuring:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                _memory_lock.release()
+                _measurement = None
+                if not measurement.pop("shared", False):
+                    measurement["peak_traced_bytes"] = peak
+
+
+class TicketProfiler:
+    def __init__(self, query_id, update_type, directory=None):
+        """
+        :param directory: directory for the profile files.  Default: a new directory in TICKET_PROFILE_DIR.
+        """
+        self.query_id = query_id
+        self.update_type = update_type
+        self.directory = directory or os.path.join(TICKET_PROFILE_DIR, 'query_{}_{}_{}'.format(
+            query_id, update_type, time.strftime('%Y%m%d_%H%M%S')))
+        self.stages = []
+        self.traces_memory = False
+        self._profile = cProfile.Profile()
+        self._snapshot = None
+
+    def start(self):
+        # tracemalloc is process-wide, so it is only used if no other ticket is tracing
+        self.traces_memory = not tracemalloc.is_tracing() and _memory_lock.acquire(blocking=False)
+        if self.traces_memory:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+        if self.traces_memory:
+            # leave out the allocations of the profiler itself
+            self._snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)])
+            tracemalloc.stop()
+            _memory_lock.release()
+
+    def span_started(self, stage):
+        if self.traces_memory:
+            tracemalloc.reset_peak()
+
+    def span_finished(self, stage, attributes):
+        memory = {"max_rss_bytes": max_rss(), "rss_bytes": current_rss()}
+        if self.traces_memory:
+            memory["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
+        self.stages.append(dict(memory, stage=stage))
+        attributes.update(memory)
+
+    def write(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._profile.dump_stats(os.path.join(self.directory, 'profile.pstats'))
+        with open(os.path.join(self.directory, 'profile.txt'), 'w') as f:
+            stats = pstats.Stats(self._profile, stream=f)
+            stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+        with open(os.path.join(self.directory, 'allocations.txt'), 'w') as f:
+            f.write(self._allocation_report())
+        with open(os.path.join(self.directory, 'stages.json'), 'w') as f:
+            json.dump({"query_id": self.query_id, "update_type": self.update_type,
+                       "traces_memory": self.traces_memory, "stages": self.stages}, f, indent=2)
+        logging.info('Wrote profile of query {} to {}'.format(self.query_id, self.directory))
+
+    def _allocation_report(self):
+        if self._snapshot is None:
+            return 'Memory was not traced: another ticket was being memory profiled at the same time.\n'
+        report = io.StringIO()
+        for statistic in self._snapshot.statistics('lineno')[:REPORT_LINES]:
+            report.write('{}\n'.format(statistic))
+        report.write('\nLargest allocation site, traceback:\n')
+        for statistic in self._snapshot.statistics('traceback')[:1]:
+            report.write('\n'.join(statistic.traceback.format()) + '\n')
+        return report.getvalue()
+
+
+def max_rss():
+    # peak resident set size of the whole process since it started, which never decreases; ru_maxrss is in kilobytes
+    # on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def current_rss():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,67 @@
+import json
+import os
+import tempfile
+import threading
+import tracemalloc
+import unittest
+from unittest import mock
+import profiling
+from profiling import TicketProfiler, measure_ticket_memory, should_profile
+
+
+class ProfilingTest(unittest.TestCase):
+    """Tests for profiling.py."""
+
+    def test_should_profile_allow_list(self):
+        with mock.patch.object(profiling, 'TICKET_PROFILE_QUERY_IDS', {7}):
+            self.assertTrue(should_profile(7))
+            self.assertFalse(should_profile(8))
+
+    def test_profile_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = TicketProfiler(7, 'new', directory=directory)
+            profiler.start()
+            attributes = {}
+            profiler.span_started('similarities')
+            squares = [k * k for k in range(10000)]
+            profiler.span_finished('similarities', attributes)
+            profiler.stop()
+            profiler.write()
+            self.assertEqual(len(squares), 10000)
+            self.assertIn('peak_traced_bytes', attributes)
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ['allocations.txt', 'profile.pstats', 'profile.txt', 'stages.json'])
+            with open(os.path.join(directory, 'stages.json'), 'r') as f:
+                self.assertEqual(json.load(f)["stages"][0]["stage"], 'similarities')
+
+    def test_measure_ticket_memory(self):
+        with measure_ticket_memory() as measured:
+            data = bytearray(4 * 2 ** 20)
+            del data
+        self.assertGreaterEqual(measured["peak_traced_bytes"], 4 * 2 ** 20)
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_shared_process_not_measured(self):
+        # a ticket that another ticket joins is not measured, and neither is the one that joins
+        started, finish = threading.Event(), threading.Event()
+        results = {}
+
+        def other_ticket():
+            with measure_ticket_memory() as measured:
+                started.set()
+                finish.wait(10)
+            results["other"] = measured
+
+        with measure_ticket_memory() as measured:
+            thread = threading.Thread(target=other_ticket)
+            thread.start()
+            started.wait(10)
+        finish.set()
+        thread.join()
+        self.assertEqual(measured, {})
+        self.assertEqual(results["other"], {})
+        self.assertFalse(tracemalloc.is_tracing())
+
+
+if __name__ == '__main__':
+    unittest.main()
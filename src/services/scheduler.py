@@ -0,0 +1,48 @@
+"""Single long-running loop that polls for broker work at an adaptive interval
+"""
+import logging
+import threading
+
+
+class BrokerScheduler:
+    def __init__(self, poll, min_interval=0.5, max_interval=5.0, backoff=2.0):
+        """
+        :param poll: function called once per cycle, returning True if it found work to do
+        :param min_interval: seconds to wait before the next poll after work was found
+        :param max_interval: longest wait between polls while idle
+        :param backoff: factor by which the wait grows after each idle poll
+        """
+        self.poll = poll
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self._wake = threading.Event()
+        self._stopping = False
+
+    def run(self):
+        # poll until stop() is called.  An exception in one poll is logged and does not end the loop.
+        while not self._stopping:
+            # a trigger that arrives while poll runs is kept, and ends the wait that follows
+            self._wake.clear()
+            try:
+                found_work = self.poll()
+            except Exception as e:
+                logging.error(e, exc_info=True)
+                found_work = False
+            if found_work:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * self.backoff, self.max_interval)
+            self._wake.wait(self.interval)
+        logging.info('Broker scheduler stopped')
+
+    def trigger(self):
+        # poll now, rather than at the end of the current wait, and start again from the shortest interval
+        self.interval = self.min_interval
+        self._wake.set()
+
+    def stop(self):
+        # the poll in progress, if any, is completed before run() returns
+        self._stopping = True
+        self._wake.set()
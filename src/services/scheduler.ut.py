@@ -0,0 +1,48 @@
+import threading
+import time
+import unittest
+from scheduler import BrokerScheduler
+
+
+class BrokerSchedulerTest(unittest.TestCase):
+    """Tests for scheduler.py."""
+
+    def setUp(self):
+        self.polls = []
+        self.scheduler = BrokerScheduler(self.poll, min_interval=0.01, max_interval=0.08)
+        self.thread = threading.Thread(target=self.scheduler.run)
+
+    def tearDown(self):
+        self.scheduler.stop()
+        self.thread.join()
+
+    def poll(self):
+        self.polls.append(time.time())
+        return len(self.polls) < 3
+
+    def test_backs_off_while_idle(self):
+        self.thread.start()
+        time.sleep(0.4)
+        self.assertEqual(self.scheduler.interval, 0.08)
+
+    def test_trigger_polls_immediately(self):
+        # intervals far longer than the test waits, so only the trigger can start the second poll
+        polled = threading.Event()
+
+        def poll():
+            self.polls.append(time.time())
+            polled.set()
+            return False
+
+        self.scheduler = BrokerScheduler(poll, min_interval=60.0, max_interval=60.0)
+        self.thread = threading.Thread(target=self.scheduler.run)
+        self.thread.start()
+        self.assertTrue(polled.wait(5.0))
+        polled.clear()
+        self.scheduler.trigger()
+        self.assertTrue(polled.wait(5.0))
+        self.assertEqual(len(self.polls), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
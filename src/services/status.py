@@ -0,0 +1,92 @@
+"""Local HTTP endpoint for the status of a running broker, for autoscaling and for spotting stuck tickets.
+
+    GET /status     JSON document returned by the broker's status function
+    GET /metrics    Prometheus text, if the broker gives a metrics function
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import threading
+
+# caches reported in the status, registered by the components that own them
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def register_cache(name, stats):
+    """
+    :param name: name of the cache in the status document
+    :param stats: function returning a dictionary of the cache's statistics, with "hits" and "misses" counts and
+                  any others, e.g. "size"
+    """
+    with _caches_lock:
+        _caches[name] = stats
+
+
+def cache_stats():
+    with _caches_lock:
+        caches = dict(_caches)
+    report = {}
+    for name, stats in caches.items():
+        report[name] = dict(stats())
+        lookups = report[name].get('hits', 0) + report[name].get('misses', 0)
+        report[name]['hit_rate'] = report[name].get('hits', 0) / lookups if lookups else None
+    return report
+
+
+class StatusServer:
+    def __init__(self, status, metrics=None, host='127.0.0.1', port=8765):
+        """
+        :param status: function returning the JSON-serializable status of the broker
+        :param metrics: optional function returning the broker's metrics as Prometheus text
+        :param host: interface to listen on.  The default only accepts local connections.
+        :param port: port to listen on, 0 for any free port
+        """
+        self.status = status
+        self.metrics = metrics
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        logging.info('Broker status at http://{}:{}/status'.format(*self._server.server_address[:2]))
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler_class(self):
+        server = self
+
+        class StatusHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                try:
+                    if self.path == '/status':
+                        body = json.dumps(server.status(), indent=2, sort_keys=True, default=str)
+                        self._reply(200, 'application/json', body)
+                    elif self.path == '/metrics' and server.metrics is not None:
+                        self._reply(200, 'text/plain; version=0.0.4', server.metrics())
+                    else:
+                        self._reply(404, 'text/plain', 'Not found\n')
+                except Exception as e:
+                    logging.error('Broker status request failed: {}'.format(e), exc_info=True)
+                    self._reply(500, 'text/plain', 'Error: {}\n'.format(e))
+
+            def _reply(self, code, content_type, body):
+                content = body.encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                # status requests are frequent; keep them out of the broker log
+                pass
+
+        return StatusHandler
@@ -0,0 +1,39 @@
+import json
+import unittest
+import urllib.error
+import urllib.request
+from status import StatusServer, cache_stats, register_cache
+
+
+class StatusServerTest(unittest.TestCase):
+    """Tests for status.py."""
+
+    def setUp(self):
+        self.server = StatusServer(lambda: {"in_flight": [{"query_id": 7, "stage": "similarities"}]},
+                                   metrics=lambda: 'video_query_tickets_total 3\n', port=0)
+        self.server.start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.port)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_status(self):
+        with urllib.request.urlopen(self.url + '/status') as response:
+            self.assertEqual(json.loads(response.read())["in_flight"][0]["stage"], 'similarities')
+
+    def test_metrics(self):
+        with urllib.request.urlopen(self.url + '/metrics') as response:
+            self.assertEqual(response.read(), b'video_query_tickets_total 3\n')
+
+    def test_unknown_path(self):
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            urllib.request.urlopen(self.url + '/other')
+        self.assertEqual(context.exception.code, 404)
+
+    def test_cache_hit_rate(self):
+        register_cache('features', lambda: {"hits": 3, "misses": 1, "size": 10})
+        self.assertEqual(cache_stats()["features"], {"hits": 3, "misses": 1, "size": 10, "hit_rate": 0.75})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+"""Priority, cost and per-user fair-share ordering of claimed queries waiting for a broker worker
+"""
+import logging
+import math
+import threading
+import time
+
+# priority class of each update type; lower classes are started first.  Revise and new rounds have a user waiting.
+PRIORITY_CLASSES = {'revise': 0, 'new': 0, 'finalize': 1}
+BATCH_CLASS = 1
+# search set size assumed for search sets the broker has not processed yet, in clips
+DEFAULT_SEARCH_SET_SIZE = 10000
+# relative cost of writing one match to the API, compared to scoring one clip of the search set
+MATCH_WRITE_COST = 50
+# seconds for a user's recorded usage to decay by half
+USAGE_HALF_LIFE = 600.0
+
+
+class PendingTicket:
+    def __init__(self, update_type, update_object, user, cost, memory=None):
+        self.update_type = update_type
+        self.update_object = update_object
+        self.user = user
+        self.cost = cost
+        self.memory = memory  # estimated peak memory, in bytes
+        self.priority = PRIORITY_CLASSES[update_type]
+        self.enqueued = time.time()
+        self.started = None
+
+
+class TicketQueue:
+    def __init__(self, batch_workers, usage_half_life=USAGE_HALF_LIFE, memory_estimator=None, memory_budget=None):
+        """
+        :param batch_workers: maximum number of batch (finalize) tickets running at the same time, so some
+                              workers are always left for interactive rounds
+        :param usage_half_life: seconds for a user's recorded worker time to decay by half
+        :param memory_estimator: optional services.MemoryEstimator of the peak memory of each ticket
+        :param memory_budget: optional bytes that the estimated peak memory of the running tickets may not exceed
+
+        Tickets are started by priority class first.  Within a class, the user with the least recent worker time
+        goes first, and among that user's tickets the cheapest one.
+        The next ticket waits while its estimated memory does not fit in what is left of the budget, rather than
+        being overtaken, so large tickets are not starved.  A ticket larger than the whole budget runs alone.
+        """
+        self.batch_workers = batch_workers
+        self.usage_half_life = usage_half_life
+        self.memory_estimator = memory_estimator
+        self.memory_budget = memory_budget
+        self.pending = []
+        self.running = []
+        self.search_set_sizes = {}
+        self._usage = {}  # user: (worker seconds, time of last update)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self.pending)
+
+    def push(self, update_type, update_object):
+        # the query-state responses carry no user in older API versions, in which case all queries share one user
+        user = update_object.get("user")
+        ticket = PendingTicket(update_type, update_object, user, self.estimate_cost(update_type, update_object),
+                               self.estimate_memory(update_object))
+        with self._lock:
+            self.pending.append(ticket)
+        return ticket
+
+    def pop_next(self):
+        """
+        :return: the PendingTicket to start next, or None if nothing may start now
+        """
+        with self._lock:
+            nbatch = sum(1 for ticket in self.running if ticket.priority == BATCH_CLASS)
+            candidates = [ticket for ticket in self.pending
+                          if ticket.priority != BATCH_CLASS or nbatch < self.batch_workers]
+            if not candidates:
+                return None
+            ticket = min(candidates, key=lambda t: (t.priority, self._user_usage(t.user), t.cost, t.enqueued))
+            if not self._fits_in_memory(ticket):
+                return None
+            if self.memory_budget is not None and ticket.memory is not None and ticket.memory > self.memory_budget:
+                logging.warning('Query {} needs about {} MB, more than the memory budget; running it alone'.format(
+                    ticket.update_object["query_id"], ticket.memory // 2 ** 20))
+            self.pending.remove(ticket)
+            ticket.started = time.time()
+            self.running.append(ticket)
+            return ticket
+
+    def drain(self):
+        # remove and return every pending ticket, e.g. to hand them back when the broker stops
+        with self._lock:
+            pending, self.pending = self.pending, []
+        return pending
+
+    def finished(self, ticket, summary=None):
+        """
+        :param ticket: PendingTicket returned by pop_next
+        :param summary: dictionary returned by process_update, used to learn the size of the ticket's search set
+        """
+        elapsed = time.time() - ticket.started
+        with self._lock:
+            self.running.remove(ticket)
+            usage = self._user_usage(ticket.user)
+            self._usage[ticket.user] = (usage + elapsed, time.time())
+            if summary and summary.get("search_set_size"):
+                self.search_set_sizes[summary["search_set"]] = summary["search_set_size"]
+        if summary and self.memory_estimator is not None:
+            self.memory_estimator.observed(summary["search_set"], ticket.memory, summary.get("memory"))
+
+    def snapshot(self):
+        """
+        :return: number of pending tickets per update type, and a list of the running tickets
+        """
+        with self._lock:
+            pending = {}
+            for ticket in self.pending:
+                pending[ticket.update_type] = pending.get(ticket.update_type, 0) + 1
+            running = [{"query_id": ticket.update_object["query_id"], "update_type": ticket.update_type,
+                        "user": ticket.user, "started": ticket.started, "memory_estimate": ticket.memory}
+                       for ticket in self.running]
+        return pending, running
+
+    def estimate_cost(self, update_type, update_object):
+        # cost, in units of clips scored: every clip of the search set is scored, then matches are written.
+        # Finalize writes every match above the threshold, assumed here to be the whole search set.
+        search_set_size = self.search_set_sizes.get(update_object["search_set"], DEFAULT_SEARCH_SET_SIZE)
+        if update_type == 'finalize':
+            nmatches = search_set_size
+        else:
+            nmatches = update_object["number_of_matches_to_review"]
+        return search_set_size + MATCH_WRITE_COST * nmatches
+
+    def estimate_memory(self, update_object):
+        if self.memory_estimator is None:
+            return None
+        search_set = update_object["search_set"]
+        search_set_size = self.search_set_sizes.get(search_set, DEFAULT_SEARCH_SET_SIZE)
+        return self.memory_estimator.estimate(search_set, search_set_size, len(update_object.get("user_matches") or {}))
+
+    def _fits_in_memory(self, ticket):
+        # called with the lock held
+        if self.memory_budget is None or ticket.memory is None or not self.running:
+            return True
+        reserved = sum(running.memory or 0 for running in self.running)
+        return reserved + ticket.memory <= self.memory_budget
+
+    def _user_usage(self, user):
+        # worker seconds used by user, decayed exponentially with time
+        usage, updated = self._usage.get(user, (0.0, time.time()))
+        return usage * math.exp(-math.log(2) * (time.time() - updated) / self.usage_half_life)
@@ -0,0 +1,99 @@
+import unittest
+from memory import BYTES_PER_CLIP_STREAM, BYTES_PER_FEATURE_VALUE, MAX_CALIBRATION_SAMPLES, \
+    MIN_BYTES_PER_FEATURE_VALUE, MIN_CALIBRATION_SAMPLES, TICKET_BASE_BYTES, MemoryEstimator
+from ticket_queue import TicketQueue
+
+
+class TicketQueueTest(unittest.TestCase):
+    """Tests for ticket_queue.py."""
+
+    def setUp(self):
+        self.queue = TicketQueue(batch_workers=1)
+
+    def tearDown(self):
+        pass
+
+    def push(self, update_type, user, query_id):
+        update_object = {"query_id": query_id, "search_set": 1, "number_of_matches_to_review": 20, "user": user}
+        return self.queue.push(update_type, update_object)
+
+    def test_drain(self):
+        self.push('revise', 'a', 1)
+        self.push('new', 'b', 2)
+        running = self.queue.pop_next()
+        self.assertEqual([ticket.update_object["query_id"] for ticket in self.queue.drain()],
+                         [3 - running.update_object["query_id"]])
+        self.assertEqual(len(self.queue), 0)
+        self.assertIsNone(self.queue.pop_next())
+
+    def test_interactive_before_batch(self):
+        self.push('finalize', 'a', 1)
+        self.push('revise', 'a', 2)
+        self.assertEqual(self.queue.pop_next().update_type, 'revise')
+
+    def test_batch_workers_limit(self):
+        self.push('finalize', 'a', 1)
+        self.push('finalize', 'b', 2)
+        self.assertIsNotNone(self.queue.pop_next())
+        self.assertIsNone(self.queue.pop_next())
+
+    def test_fair_share(self):
+        first = self.push('revise', 'a', 1)
+        self.queue.finished(self.queue.pop_next(), {"search_set": 1, "search_set_size": 100})
+        self.assertEqual(first.user, 'a')
+        self.push('revise', 'a', 2)
+        self.push('revise', 'b', 3)
+        self.assertEqual(self.queue.pop_next().user, 'b')
+
+    def test_memory_budget(self):
+        estimator = MemoryEstimator(nstreams=2)
+        one_ticket = estimator.estimate(1, 10000)
+        self.queue = TicketQueue(batch_workers=1, memory_estimator=estimator, memory_budget=int(1.5 * one_ticket))
+        self.push('revise', 'a', 1)
+        self.push('revise', 'b', 2)
+        first = self.queue.pop_next()
+        self.assertIsNone(self.queue.pop_next())
+        self.queue.finished(first)
+        self.assertIsNotNone(self.queue.pop_next())
+
+    def test_memory_estimate_learns_search_set(self):
+        estimator = MemoryEstimator(nstreams=2)
+        self.queue = TicketQueue(batch_workers=1, memory_estimator=estimator)
+        ticket = self.push('revise', 'a', 1)
+        self.queue.pop_next()
+        memory = {"clips": 100, "feature_values": 100 * 2 * 1 * 8, "feature_dimension": 8, "splits": 1,
+                  "process_max_rss_bytes": 0}
+        self.queue.finished(ticket, {"search_set": 1, "search_set_size": 100, "memory": memory})
+        self.assertEqual(estimator.search_sets[1], (8, 1))
+        self.assertLess(self.push('revise', 'a', 2).memory, ticket.memory)
+        # only measured peaks calibrate the estimates
+        self.assertEqual(estimator.calibration, [])
+        ticket = self.push('revise', 'a', 3)
+        self.queue.pop_next()
+        self.queue.finished(ticket, {"search_set": 1, "search_set_size": 100,
+                                     "memory": dict(memory, peak_traced_bytes=2 ** 20)})
+        self.assertEqual(estimator.calibration, [(1600, 100, 2 ** 20)])
+
+    def test_memory_estimate_calibrated(self):
+        estimator = MemoryEstimator(nstreams=2)
+        self.queue = TicketQueue(batch_workers=1, memory_estimator=estimator)
+        memory = {"clips": 1000, "feature_values": 1000 * 2 * 1 * 8, "feature_dimension": 8, "splits": 1,
+                  "process_max_rss_bytes": 0}
+        # each feature value took 12 bytes beyond the memory of the clips and the ticket's base
+        peak = TICKET_BASE_BYTES + BYTES_PER_CLIP_STREAM * 1000 * 2 + 12 * memory["feature_values"]
+        for nsample in range(MIN_CALIBRATION_SAMPLES):
+            self.assertEqual(estimator.bytes_per_feature_value, BYTES_PER_FEATURE_VALUE)
+            ticket = self.push('revise', 'a', nsample)
+            self.queue.pop_next()
+            self.queue.finished(ticket, {"search_set": 1, "search_set_size": 1000,
+                                         "memory": dict(memory, peak_traced_bytes=peak)})
+        self.assertAlmostEqual(estimator.bytes_per_feature_value, 12)
+        self.assertEqual(estimator.estimate(1, 1000), peak)
+        # the fitted cost is not lower than that of a float64 in an array
+        for nsample in range(MAX_CALIBRATION_SAMPLES):
+            estimator.observed(1, 0, dict(memory, peak_traced_bytes=0))
+        self.assertEqual(estimator.bytes_per_feature_value, MIN_BYTES_PER_FEATURE_VALUE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+"""Pool of workers that process broker tickets concurrently
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+import logging
+import threading
+
+
+class TicketWorkerPool:
+    def __init__(self, nworkers=4, worker_type='thread', on_done=None):
+        """
+        :param nworkers: number of tickets processed at the same time
+        :param worker_type: 'thread' or 'process'
+        :param on_done: function called with no arguments each time a ticket finishes, e.g. to trigger a poll
+        """
+        if worker_type not in ('thread', 'process'):
+            raise Exception("Error: worker_type should be one of 'thread' or 'process'")
+        executor_class = ProcessPoolExecutor if worker_type == 'process' else ThreadPoolExecutor
+        self._executor = executor_class(max_workers=nworkers)
+        self.nworkers = nworkers
+        self.worker_type = worker_type
+        self.on_done = on_done
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def available(self):
+        # number of tickets that can be started without waiting for a worker
+        with self._lock:
+            return self.nworkers - self.in_flight
+
+    def utilization(self):
+        with self._lock:
+            return self.in_flight / self.nworkers
+
+    def submit(self, fn, *args, callback=None):
+        """
+        Run fn(*args) on a worker.  callback, if given, is called with the result of fn, or None if fn failed,
+        before the worker is counted as free again.
+        """
+        with self._lock:
+            self.in_flight += 1
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(partial(self._done, callback))
+        return future
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _done(self, callback, future):
+        failed = future.exception() is not None
+        if failed:
+            logging.error('Ticket failed: {}'.format(future.exception()), exc_info=future.exception())
+        try:
+            if callback is not None:
+                callback(None if failed else future.result())
+        except Exception as e:
+            logging.error('Ticket callback failed: {}'.format(e), exc_info=True)
+        finally:
+            # the worker is free again even if the callback failed
+            with self._lock:
+                self.in_flight -= 1
+            if self.on_done is not None:
+                self.on_done()
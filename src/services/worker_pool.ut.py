@@ -0,0 +1,73 @@
+import logging
+import threading
+import unittest
+from worker_pool import TicketWorkerPool
+
+
+def fail():
+    raise ValueError('ticket failed')
+
+
+class TicketWorkerPoolTest(unittest.TestCase):
+    """Tests for worker_pool.py."""
+
+    def setUp(self):
+        self.done = threading.Event()
+        self.pool = TicketWorkerPool(nworkers=2, on_done=self.done.set)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_available(self):
+        release = threading.Event()
+        self.pool.submit(release.wait, 5.0)
+        self.assertEqual(self.pool.available(), 1)
+        self.assertEqual(self.pool.utilization(), 0.5)
+        release.set()
+        self.assertTrue(self.done.wait(5.0))
+        self.assertEqual(self.pool.available(), 2)
+
+    def test_callback_receives_result(self):
+        results = []
+        self.pool.submit(pow, 2, 3, callback=results.append)
+        self.assertTrue(self.done.wait(5.0))
+        self.assertEqual(results, [8])
+
+    def test_callback_receives_none_on_failure(self):
+        results = []
+        logging.disable(logging.ERROR)
+        try:
+            self.pool.submit(fail, callback=results.append)
+            self.assertTrue(self.done.wait(5.0))
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(results, [None])
+        self.assertEqual(self.pool.available(), 2)
+
+    def test_worker_freed_when_callback_fails(self):
+        def callback(result):
+            raise ValueError('callback failed')
+
+        logging.disable(logging.ERROR)
+        try:
+            self.pool.submit(pow, 2, 3, callback=callback)
+            self.assertTrue(self.done.wait(5.0))
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(self.pool.available(), 2)
+
+    def test_process_workers(self):
+        pool = TicketWorkerPool(nworkers=1, worker_type='process', on_done=self.done.set)
+        results = []
+        pool.submit(pow, 2, 3, callback=results.append)
+        self.assertTrue(self.done.wait(30.0))
+        pool.shutdown()
+        self.assertEqual(results, [8])
+
+    def test_invalid_worker_type(self):
+        with self.assertRaises(Exception):
+            TicketWorkerPool(worker_type='fiber')
+
+
+if __name__ == '__main__':
+    unittest.main()